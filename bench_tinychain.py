@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+⛼  tinychain benchmarks
+
+Usage:
+  bench_tinychain.py transport [options]
+  bench_tinychain.py reorg [options]
+  bench_tinychain.py suite [options] [<name>...]
+
+Options:
+  -h --help              Show help
+  -c, --clients N        Concurrent client connections [default: 200]
+  -m, --msgs N           Round trips per connection [default: 50]
+  -d, --depths DEPTHS    Comma-separated reorg depths [default: 1,10,100]
+  -j, --json PATH        Write suite results to this file as JSON
+  -b, --baseline PATH    Compare suite results to those in this file
+                         [default: bench_baseline.json]
+  -t, --tolerance PCT    Slowdown past the baseline to fail on [default: 25]
+
+`transport` measures how many ping/pong round trips per second the threaded
+and asyncio listeners serve to many concurrent connections. Clients run in
+this process too, so compare the two numbers rather than trusting either.
+
+`reorg` times the switch from an active chain of each depth to a side
+branch which overtakes it, on a minimal-difficulty chain of its own.
+
+`suite` times each hot path (or only those named) against fixed synthetic
+data: a block of signed txns spending outputs of a custom genesis block.
+Each result is the time per operation in the fastest of repeated runs. Any
+which is slower than in the baseline file by more than the tolerance is
+reported, and makes the command exit nonzero. Refresh the baseline, on the
+machine that checks against it, with `suite --json bench_baseline.json`.
+
+"""
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from typing import NamedTuple, Callable, Dict, Iterable
+
+import ecdsa
+from docopt import docopt
+
+import tinychain as t
+
+
+def run_clients(port: int, num_clients: int, num_msgs: int) -> float:
+    """Return round trips per second across `num_clients` connections."""
+    ready = threading.Barrier(num_clients + 1)
+    errors = []
+
+    def client():
+        try:
+            with socket.create_connection(('127.0.0.1', port)) as s:
+                ready.wait()
+
+                for nonce in range(num_msgs):
+                    s.sendall(t.encode_socket_data(t.PingMsg(nonce)))
+                    assert t.read_all_from_socket(s) == t.PongMsg(nonce)
+        except Exception as e:
+            errors.append(e)
+            ready.abort()
+
+    threads = [threading.Thread(target=client) for _ in range(num_clients)]
+    [th.start() for th in threads]
+
+    # Only time the traffic, not the connection setup.
+    ready.wait()
+    start = time.time()
+    [th.join() for th in threads]
+    elapsed = time.time() - start
+
+    if errors:
+        raise errors[0]
+
+    return num_clients * num_msgs / elapsed
+
+
+def bench_transport(num_clients: int, num_msgs: int):
+    server = t.ThreadedTCPServer(('127.0.0.1', 0), t.TCPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        threaded = run_clients(
+            server.server_address[1], num_clients, num_msgs)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    server = t.start_async_server('127.0.0.1', 0)
+
+    try:
+        asyncio_ = run_clients(
+            server.sockets[0].getsockname()[1], num_clients, num_msgs)
+    finally:
+        t.event_loop.call_soon_threadsafe(server.close)
+
+    print(f'{num_clients} clients x {num_msgs} round trips')
+    print(f'  threaded: {threaded:10.0f} msgs/s')
+    print(f'  asyncio:  {asyncio_:10.0f} msgs/s')
+
+
+def mine_block(prev_block_hash: str, height: int, timestamp: int,
+               pay_to_addr: str, bits: int = 1, txns=()) -> t.Block:
+    coinbase = t.Transaction.create_coinbase(
+        pay_to_addr, t.get_block_subsidy(), height)
+    txns = [coinbase, *txns]
+    block = t.Block(
+        version=0, prev_block_hash=prev_block_hash,
+        merkle_hash=t.get_merkle_root_of_txns(txns).val,
+        timestamp=timestamp, bits=bits, nonce=0, txns=txns)
+
+    return solve_block(block)
+
+
+def solve_block(block: t.Block) -> t.Block:
+    while int(block.id, 16) > (1 << (256 - block.bits)):
+        block = block._replace(nonce=block.nonce + 1)
+
+    return block
+
+
+def mine_branch(prev_block: t.Block, length: int, start_height: int,
+                start_time: int, pay_to_addr: str = None) -> [t.Block]:
+    pay_to_addr = pay_to_addr or t.pubkey_to_address(os.urandom(33))
+    branch = [prev_block]
+
+    for i in range(length):
+        branch.append(mine_block(
+            branch[-1].id, start_height + i, start_time + i, pay_to_addr))
+
+    return branch[1:]
+
+
+def bench_reorg(depths: [int]):
+    start_time = int(time.time()) - 10 * max(depths) - 1000
+    genesis = mine_block(None, 0, start_time, 'genesis')
+
+    for depth in depths:
+        node = t.Node('reorg', genesis)
+        old_branch = mine_branch(genesis, depth, 1, start_time + 1)
+        # `reorg_if_necessary()` doesn't count the fork block toward the
+        # branch's length, so it needs two more blocks to overtake.
+        new_branch = mine_branch(genesis, depth + 2, 1, start_time + 1)
+
+        for block in old_branch + new_branch[:-1]:
+            node.connect_block(block)
+
+        # Connecting the new branch's last block sets off the reorg.
+        start = time.perf_counter()
+        node.connect_block(new_branch[-1])
+        elapsed = time.perf_counter() - start
+
+        assert node.active_chain[-1] == new_branch[-1]
+        print(f'reorg depth {depth:4}: {elapsed * 1000:8.2f} ms')
+
+
+# The suite's synthetic data is built from these, so it's identical each run.
+SUITE_TIMESTAMP = 1_500_000_000
+SUITE_NUM_TXNS = 63
+SUITE_SIGNING_KEY = ecdsa.SigningKey.from_secret_exponent(
+    0xbe1, curve=ecdsa.SECP256k1)
+SUITE_ADDRESS = t.pubkey_to_address(
+    SUITE_SIGNING_KEY.get_verifying_key().to_string())
+
+
+class SuiteData(NamedTuple):
+    # Pays SUITE_NUM_TXNS outputs to SUITE_ADDRESS.
+    genesis: t.Block
+    # Coinbase-only blocks atop `genesis` so its outputs have matured.
+    chain: Iterable[t.Block]
+    # Each spends one of the genesis outputs.
+    txns: Iterable[t.Transaction]
+    # Holds `txns`, atop `chain`.
+    block: t.Block
+
+
+def make_spend(outpoint: t.OutPoint, value: int) -> t.Transaction:
+    txout = t.TxOut(value=value, to_address=SUITE_ADDRESS)
+    pk = SUITE_SIGNING_KEY.get_verifying_key().to_string()
+    spend_msg = t.build_spend_message(outpoint, pk, 0, [txout])
+    txin = t.TxIn(
+        to_spend=outpoint, unlock_pk=pk, sequence=0,
+        unlock_sig=SUITE_SIGNING_KEY.sign_deterministic(spend_msg))
+
+    return t.Transaction(txins=[txin], txouts=[txout], locktime=0)
+
+
+def make_suite_data() -> SuiteData:
+    genesis_txn = t.Transaction(
+        txins=[t.TxIn(None, b'suite', None, 0)],
+        txouts=[t.TxOut(value=10_000, to_address=SUITE_ADDRESS)
+                for _ in range(SUITE_NUM_TXNS)])
+    genesis = solve_block(t.Block(
+        version=0, prev_block_hash=None,
+        merkle_hash=t.get_merkle_root_of_txns([genesis_txn]).val,
+        timestamp=SUITE_TIMESTAMP, bits=1, nonce=0, txns=[genesis_txn]))
+
+    chain = [genesis]
+    for height in range(1, t.Params.COINBASE_MATURITY + 1):
+        chain.append(mine_block(
+            chain[-1].id, height, SUITE_TIMESTAMP + height, SUITE_ADDRESS))
+
+    txns = [make_spend(t.OutPoint(genesis_txn.id, i), 9_000)
+            for i in range(SUITE_NUM_TXNS)]
+    # The fees go unclaimed, which is allowed.
+    block = mine_block(chain[-1].id, len(chain), SUITE_TIMESTAMP + len(chain),
+                       SUITE_ADDRESS, txns=txns)
+
+    return SuiteData(genesis, chain[1:], txns, block)
+
+
+def make_suite_node(data: SuiteData, with_mempool=False) -> t.Node:
+    """A node whose tip is the suite's `chain`, ready to take its `block`."""
+    node = t.Node('bench', data.genesis, filter_capacity=1000)
+    genesis_txn = data.genesis.txns[0]
+
+    for i, txout in enumerate(genesis_txn.txouts):
+        node.add_to_utxo(txout, genesis_txn, i, True, 1)
+
+    for block in data.chain:
+        node.connect_block(block)
+
+    if with_mempool:
+        for txn in data.txns:
+            node.accept_to_mempool(txn)
+
+    return node
+
+
+class Benchmark(NamedTuple):
+    # Returns the arguments for one run of `run`; this isn't timed.
+    setup: Callable
+    run: Callable
+    # Given what `run` returned, how many operations it did, if not one.
+    count_ops: Callable = None
+
+
+def suite_benchmarks(data: SuiteData) -> Dict[str, Benchmark]:
+    serialized_block = t.serialize(data.block)
+    txids = [tx.id for tx in data.block.txns]
+    frame = t.encode_socket_data(data.block)
+    unsolved_block = data.block._replace(bits=16, nonce=0)
+    empty_template = data.block._replace(txns=[])
+    # Only read from, so shared by every run of the benchmarks which do.
+    node = make_suite_node(data)
+
+    def reorg_setup():
+        # As in `bench_reorg()`, the new branch needs two more blocks.
+        node = make_suite_node(data)
+        old_branch = mine_branch(data.chain[-1], 10, len(data.chain) + 1,
+                                 SUITE_TIMESTAMP + 100, 'old')
+        new_branch = mine_branch(data.chain[-1], 12, len(data.chain) + 1,
+                                 SUITE_TIMESTAMP + 100, 'new')
+
+        for block in old_branch + new_branch[:-1]:
+            node.connect_block(block)
+
+        return node, new_branch[-1]
+
+    def socket_setup():
+        reader, writer = socket.socketpair()
+        threading.Thread(target=writer.sendall, args=(frame,)).start()
+        return reader, writer
+
+    def read_socket(reader, writer):
+        try:
+            assert t.read_all_from_socket(reader) == data.block
+        finally:
+            reader.close()
+            writer.close()
+
+    return {
+        'serialize': Benchmark(tuple, lambda: t.serialize(data.block)),
+        'deserialize': Benchmark(
+            tuple, lambda: t.deserialize(serialized_block)),
+        'txn_id': Benchmark(tuple, lambda: data.txns[0].id),
+        'merkle_root': Benchmark(
+            tuple, lambda: t.get_merkle_root.__wrapped__(*txids)),
+        'validate_txn': Benchmark(
+            tuple, lambda: node.validate_txn(data.txns[0])),
+        'validate_block': Benchmark(
+            tuple, lambda: node.validate_block(data.block)),
+        'connect_block': Benchmark(
+            lambda: (make_suite_node(data),),
+            lambda node: node.connect_block(data.block)),
+        'select_from_mempool': Benchmark(
+            lambda: (make_suite_node(data, with_mempool=True),),
+            lambda node: node.select_from_mempool(empty_template)),
+        'try_reorg': Benchmark(
+            reorg_setup, lambda node, block: node.connect_block(block)),
+        'mine_hash': Benchmark(
+            tuple, lambda: t.mine(unsolved_block),
+            lambda block: block.nonce + 1),
+        'read_all_from_socket': Benchmark(socket_setup, read_socket),
+    }
+
+
+def time_benchmark(benchmark: Benchmark, min_secs=0.5, min_runs=3) -> float:
+    """
+    Seconds per operation in the fastest run. As with `timeit`, slower runs
+    say more about what else the machine was doing than about the code.
+    """
+    per_op = []
+    total = 0.
+
+    while total < min_secs or len(per_op) < min_runs:
+        args = benchmark.setup()
+        start = time.perf_counter()
+        result = benchmark.run(*args)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        per_op.append(elapsed / (
+            benchmark.count_ops(result) if benchmark.count_ops else 1))
+
+    return min(per_op)
+
+
+def compare_results(results: Dict[str, float], baseline: Dict[str, float],
+                    tolerance: float) -> [str]:
+    """The benchmarks more than `tolerance` (a fraction) slower than before."""
+    return [
+        name for name, secs in results.items()
+        if name in baseline and secs > baseline[name] * (1 + tolerance)]
+
+
+def bench_suite(names: [str], json_path: str, baseline_path: str,
+                tolerance: float) -> bool:
+    data = make_suite_data()
+    benchmarks = suite_benchmarks(data)
+    names = names or list(benchmarks)
+    baseline = {}
+
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    for name in names:
+        results[name] = secs = time_benchmark(benchmarks[name])
+        line = f'{name:22} {secs * 1e6:12.1f} us/op'
+
+        if name in baseline:
+            change = secs / baseline[name] - 1
+            line += f'   {change:+8.1%} vs baseline'
+
+        print(line)
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    regressions = compare_results(results, baseline, tolerance)
+    if regressions:
+        print(f'slower than baseline: {", ".join(regressions)}')
+
+    return not regressions
+
+
+def main(args):
+    # Every message is otherwise logged at INFO.
+    t.logger.setLevel(logging.WARNING)
+
+    if args['transport']:
+        bench_transport(int(args['--clients']), int(args['--msgs']))
+    elif args['reorg']:
+        bench_reorg([int(d) for d in args['--depths'].split(',')])
+    elif args['suite']:
+        ok = bench_suite(
+            args['<name>'], args['--json'], args['--baseline'],
+            float(args['--tolerance']) / 100)
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -6,17 +6,34 @@ Usage:
   client.py balance [options] [--raw]
   client.py send [options] <addr> <val>
   client.py status [options] <txid> [--csv]
+  client.py snapshot [options] <path>
+  client.py stats [options]
+  client.py profile [options] [<seconds>] [--trace]
+  client.py wallet [options] [--fee FEE]
 
 Options:
   -h --help            Show help
   -w, --wallet PATH    Use a particular wallet file (e.g. `-w ./wallet2.dat`)
   -n, --node HOSTNAME  The hostname of node to use for RPC (default: localhost)
   -p, --port PORT      Port node is listening on (default: 9999)
+  --trace              Also trace connect_block, validate_block, etc.
+  --fee FEE            Fee to pay on each payment [default: 0]
+
+`wallet` keeps running against a connection to the node (reconnecting if
+it's lost), with a local cache of the wallet's UTXOs kept up to date by the
+node's pushed events.
+It reads commands from stdin, one per line:
+
+  balance                       Print the confirmed and spendable balance.
+  send <addr> <val> [...]       Pay one or more addresses, in one batch.
 
 """
 import logging
 import os
+import queue
 import socket
+import threading
+from typing import Dict, Iterable, Tuple, Union
 
 from docopt import docopt
 
@@ -44,6 +61,14 @@ def main(args):
         send_value(args)
     elif args['status']:
         txn_status(args)
+    elif args['snapshot']:
+        dump_snapshot(args)
+    elif args['stats']:
+        print(t.render_prometheus(send_msg(t.GetStatsMsg())), end='')
+    elif args['profile']:
+        profile_node(args)
+    elif args['wallet']:
+        run_wallet(args)
 
 
 def get_balance(args):
@@ -70,9 +95,9 @@ def txn_status(args):
         print(f'{txid}:in_mempool,,' if as_csv else 'Found in mempool')
         return
 
-    chain = send_msg(t.GetActiveChainMsg())
+    blocks = stream_msg(t.GetBlockRangeMsg())
 
-    for tx, block, height in t.txn_iterator(chain):
+    for tx, block, height in t.txn_iterator(blocks):
         if tx.id == txid:
             print(
                 f'{txid}:mined,{block.id},{height}' if as_csv else
@@ -82,6 +107,38 @@ def txn_status(args):
     print(f'{txid}:not_found,,' if as_csv else 'Not found')
 
 
+def dump_snapshot(args):
+    """
+    Write the node's UTXO set to a snapshot file other nodes can bootstrap
+    from.
+
+    Prints the hash to add to `Params.ASSUMEUTXO_SNAPSHOTS`.
+    """
+    snapshot = send_msg(t.GetUTXOSnapshotMsg())
+    snapshot_hash = t.dump_utxo_snapshot(snapshot, args['<path>'])
+
+    print(f'{snapshot.base_block_id}:{snapshot_hash}')
+
+
+def profile_node(args):
+    """
+    Profile the node for a while (10 seconds by default, at most
+    MAX_PROFILE_SECS).
+
+    Prints where on the node's filesystem the results were written.
+    """
+    result = send_msg(t.ProfileMsg(
+        seconds=int(args['<seconds>'] or 10), trace=args['--trace']))
+
+    if not result:
+        logger.error('node is already running a profile')
+        return
+
+    print(result.stacks_path)
+    if result.trace_path:
+        print(result.trace_path)
+
+
 def send_value(args: dict):
     """
     Send value to some address.
@@ -91,9 +148,12 @@ def send_value(args: dict):
     my_coins = list(sorted(
         find_utxos_for_address(args), key=lambda i: (i.value, i.height)))
 
+    total = 0
+
     for coin in my_coins:
         selected.add(coin)
-        if sum(i.value for i in selected) > val:
+        total += coin.value
+        if total > val:
             break
 
     txout = t.TxOut(value=val, to_address=to_addr)
@@ -104,7 +164,10 @@ def send_value(args: dict):
 
     logger.info(f'built txn {txn}')
     logger.info(f'broadcasting txn {txn.id}')
-    send_msg(txn)
+    [result] = send_msg(t.TxBatchMsg([txn]))
+
+    if result.rejection:
+        logger.error(f'txn {txn.id} rejected: {result.rejection}')
 
 
 def send_msg(data: bytes, node_hostname=None, port=None):
@@ -117,20 +180,466 @@ def send_msg(data: bytes, node_hostname=None, port=None):
         return t.read_all_from_socket(s)
 
 
-def find_utxos_for_address(args: dict):
-    utxo_set = dict(send_msg(t.GetUTXOsMsg()))
-    return [u for u in utxo_set.values() if u.to_address == args['my_addr']]
+def stream_msg(data):
+    """Send a message and lazily yield the items the node streams back."""
+    node_hostname = getattr(send_msg, 'node_hostname', 'localhost')
+    port = getattr(send_msg, 'port', 9999)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.connect((node_hostname, port))
+        s.sendall(t.encode_socket_data(data))
+        yield from t.read_stream_from_socket(s)
+
+
+def find_utxos_for_address(args: dict, send=send_msg):
+    utxos, cursor = [], None
 
+    while True:
+        page = send(
+            t.GetUTXOPageMsg(after=cursor, to_address=args['my_addr']))
+        utxos.extend(page.utxos)
 
-def make_txin(signing_key, outpoint: t.OutPoint, txout: t.TxOut) -> t.TxIn:
+        if not page.next_cursor:
+            return utxos
+
+        cursor = page.next_cursor
+
+
+def make_txin(signing_key, outpoint: t.OutPoint,
+              *txouts: t.TxOut) -> t.TxIn:
     sequence = 0
     pk = signing_key.verifying_key.to_string()
-    spend_msg = t.build_spend_message(outpoint, pk, sequence, [txout])
+    spend_msg = t.build_spend_message(outpoint, pk, sequence, list(txouts))
 
     return t.TxIn(
         to_spend=outpoint, unlock_pk=pk,
         unlock_sig=signing_key.sign(spend_msg), sequence=sequence)
 
 
+# Wallet service
+# ----------------------------------------------------------------------------
+
+# Give up on a reply from the node after this long.
+REQUEST_TIMEOUT_SECS = 30
+
+
+class InsufficientFundsError(t.BaseException):
+    pass
+
+
+class WalletService:
+    """
+    A wallet which keeps running against a connection to a node, and
+    reconnects (and resyncs) should it lose that. Its UTXOs are fetched
+    once and then kept current from the events the node pushes (see
+    `t.SubscribeMsg`) rather than downloaded for each balance or payment,
+    and the balances are kept as running totals.
+
+    Coins spent by payments we've sent are held back until the payment
+    confirms or drops out of the mempool, and change from a payment can be
+    spent at once, so payments can go out back to back.
+    """
+
+    def __init__(self, signing_key, address: str, host: str = 'localhost',
+                 port: int = 9999, fee: int = 0):
+        self.signing_key = signing_key
+        self.address = address
+        self.fee = fee
+
+        self.node_address = (host, int(port))
+        self.request_lock = threading.Lock()
+
+        # The connection, and the replies read off it; both are replaced on
+        # reconnecting so that nothing late from the old one is taken.
+        self.sock = None
+        self.replies = queue.Queue()
+        self.closed = True  # Whether we must reconnect before requesting.
+
+        # Held while reading or changing any of the below.
+        self.lock = threading.RLock()
+
+        # Confirmed UTXOs at our address, and their total value.
+        self.utxos: Dict[t.OutPoint, t.UnspentTxOut] = {}
+        self.balance = 0
+
+        # Payments we've sent which haven't yet confirmed or been dropped,
+        # the outpoints they spend, and the change they pay us.
+        self.pending: Dict[str, t.Transaction] = {}
+        self.pending_spends: Dict[t.OutPoint, str] = {}
+        self.pending_change: Dict[t.OutPoint, t.UnspentTxOut] = {}
+
+        # Pending payments which have left the node's mempool. Whether they
+        # confirmed is only known once the tip changes, so they're settled
+        # then.
+        self.left_mempool = set()
+
+        # The value of every coin we can spend: confirmed UTXOs and pending
+        # change, less what pending payments spend.
+        self.spendable = 0
+
+        self.height = -1
+        self.seq = 0
+        self.stale = True  # Whether we must resync before trusting the above.
+        self.syncing_events = None  # Events held back while we resync.
+
+        self.sync()
+
+    def connect(self):
+        """Connect to the node, reading its replies and events from now on."""
+        sock = socket.create_connection(self.node_address)
+
+        with self.lock:
+            self.sock, self.replies, self.closed = sock, queue.Queue(), False
+
+        threading.Thread(
+            target=self.read_forever, args=(sock, self.replies),
+            daemon=True).start()
+
+    def close(self):
+        with self.lock:
+            self.closed = self.stale = True
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes `read_forever()`.
+        except OSError:
+            pass
+        self.sock.close()
+
+    def request(self, msg) -> object:
+        """Send a message and wait for the reply, which comes in order."""
+        with self.request_lock:
+            if self.closed:
+                raise ConnectionError('connection to node closed')
+
+            try:
+                self.sock.sendall(t.encode_socket_data(msg))
+                reply = self.replies.get(timeout=REQUEST_TIMEOUT_SECS)
+            except OSError:
+                self.close()
+                raise
+            except queue.Empty:
+                # A late reply would be taken for the next request's, so we
+                # reconnect (on resyncing) rather than wait on this one.
+                self.close()
+                raise ConnectionError(
+                    f'no reply from node within {REQUEST_TIMEOUT_SECS}s; '
+                    'disconnected') from None
+
+        if reply is ConnectionError:
+            raise ConnectionError('connection to node closed')
+        return reply
+
+    def read_forever(self, sock: socket.socket, replies: queue.Queue):
+        while True:
+            try:
+                msg = t.read_all_from_socket(sock)
+            except (OSError, t.ProtocolError):
+                msg = None
+
+            with self.lock:
+                if sock is not self.sock:
+                    return  # We've since reconnected.
+                elif msg is None:
+                    self.closed = self.stale = True
+                    replies.put(ConnectionError)
+                    return
+                elif isinstance(
+                        msg, (t.TipEvent, t.MempoolEvent, t.UTXOEvent)):
+                    if self.syncing_events is not None:
+                        self.syncing_events.append(msg)
+                    else:
+                        self.apply_event(msg)
+                    continue
+                elif isinstance(msg, t.ChainView):
+                    # Our (re)subscription took: events numbered from here
+                    # are the ones that count. (We only ever get a ChainView
+                    # in reply to a SubscribeMsg.)
+                    if self.syncing_events is not None:
+                        self.syncing_events = []
+                    else:
+                        self.seq = 0
+
+            replies.put(msg)
+
+    def sync(self):
+        """
+        (Re)build the UTXO cache from scratch, subscribing to changes, and
+        reconnecting first if need be.
+        """
+        with self.request_lock:
+            if self.closed:
+                self.connect()
+
+        with self.lock:
+            self.syncing_events = []
+
+        view = self.subscribe()
+        utxos = find_utxos_for_address(
+            {'my_addr': self.address}, self.request)
+        in_mempool = set(self.request(t.GetMempoolMsg())) if self.pending \
+            else set()
+
+        with self.lock:
+            self.height = view.height
+            self.seq = 0
+            self.stale = False
+            self.utxos = {u.outpoint: u for u in utxos}
+            self.balance = sum(u.value for u in utxos)
+
+            self.pending = {txid: txn for txid, txn in self.pending.items()
+                            if txid in in_mempool}
+            self.pending_spends = {
+                txin.to_spend: txid for txid, txn in self.pending.items()
+                for txin in txn.txins}
+            self.pending_change = {
+                c.outpoint: c for c in map(change_utxo, self.pending.values())
+                if c and c.outpoint not in self.utxos}
+            self.left_mempool = set()
+            self.spendable = sum(
+                c.value for c in self.coins()
+                if c.outpoint not in self.pending_spends)
+
+            events, self.syncing_events = self.syncing_events, None
+            for event in events:
+                self.apply_event(event)
+
+    def subscribe(self) -> t.ChainView:
+        """
+        Watch our address and pending payments, which needn't pay us (if
+        they pay no change) but which we need to see leave the mempool.
+        """
+        with self.lock:
+            txids = list(self.pending)
+
+        return self.request(
+            t.SubscribeMsg(txids=txids, addresses=[self.address]))
+
+    def coins(self) -> Iterable[t.UnspentTxOut]:
+        yield from self.utxos.values()
+        yield from self.pending_change.values()
+
+    def apply_event(self, event):
+        if self.stale:
+            return
+        elif event.seq != self.seq + 1:
+            logger.warning(f'missed events {self.seq + 1}..{event.seq - 1}; '
+                           'will resync')
+            self.stale = True
+            return
+
+        self.seq = event.seq
+
+        if isinstance(event, t.TipEvent):
+            self.height = event.height
+
+            for txid in self.left_mempool:
+                self.settle(txid)
+            self.left_mempool.clear()
+        elif isinstance(event, t.MempoolEvent):
+            if event.txn is None and event.txid in self.pending:
+                self.left_mempool.add(event.txid)
+            else:
+                self.left_mempool.discard(event.txid)
+        elif event.spent:
+            self.remove_utxo(event.utxo)
+        else:
+            self.add_utxo(event.utxo)
+
+    def add_utxo(self, utxo: t.UnspentTxOut):
+        if utxo.outpoint in self.utxos:
+            return
+
+        self.utxos[utxo.outpoint] = utxo
+        self.balance += utxo.value
+
+        # Change we've already counted as spendable has just confirmed.
+        if self.pending_change.pop(utxo.outpoint, None) is None and \
+                utxo.outpoint not in self.pending_spends:
+            self.spendable += utxo.value
+
+    def remove_utxo(self, utxo: t.UnspentTxOut):
+        if self.utxos.pop(utxo.outpoint, None) is None:
+            return
+
+        self.balance -= utxo.value
+
+        if utxo.outpoint not in self.pending_spends:
+            self.spendable -= utxo.value
+
+    def settle(self, txid: str):
+        """
+        Forget a pending payment, releasing what it spent if it didn't
+        confirm (if it did, those UTXOs are already gone).
+        """
+        txn = self.pending.pop(txid, None)
+        if not txn:
+            return
+
+        for txin in txn.txins:
+            if self.pending_spends.get(txin.to_spend) == txid:
+                del self.pending_spends[txin.to_spend]
+                coin = self.utxos.get(txin.to_spend) or \
+                    self.pending_change.get(txin.to_spend)
+                self.spendable += coin.value if coin else 0
+
+        change = change_utxo(txn)
+        change = change and self.pending_change.pop(change.outpoint, None)
+        if change and change.outpoint not in self.pending_spends:
+            self.spendable -= change.value
+
+    def is_mature(self, coin: t.UnspentTxOut) -> bool:
+        return not coin.is_coinbase or (
+            self.height + 1 - coin.height >= t.Params.COINBASE_MATURITY)
+
+    def make_payment(self, to_addr: str, value: int) -> t.Transaction:
+        """Build and sign a payment, holding back the coins it spends."""
+        needed = value + self.fee
+
+        if needed > self.spendable:
+            raise InsufficientFundsError(
+                f'{needed} needed but only {self.spendable} spendable')
+
+        selected, total = [], 0
+
+        for coin in sorted(self.coins(), key=lambda c: (c.value, c.height)):
+            if coin.outpoint in self.pending_spends or \
+                    not self.is_mature(coin):
+                continue
+
+            selected.append(coin)
+            total += coin.value
+            if total >= needed:
+                break
+        else:
+            raise InsufficientFundsError(
+                f'{needed} needed but only {total} mature and unspent')
+
+        txouts = [t.TxOut(value=value, to_address=to_addr)]
+        if total > needed:
+            txouts.append(
+                t.TxOut(value=total - needed, to_address=self.address))
+
+        txn = t.Transaction(
+            txins=[make_txin(self.signing_key, coin.outpoint, *txouts)
+                   for coin in selected],
+            txouts=txouts)
+
+        self.pending[txn.id] = txn
+        for coin in selected:
+            self.pending_spends[coin.outpoint] = txn.id
+            self.spendable -= coin.value
+
+        change = change_utxo(txn)
+        if change:
+            self.pending_change[change.outpoint] = change
+            self.spendable += change.value
+
+        return txn
+
+    def send(self, payments: Iterable[Tuple[str, int]],
+             ) -> Iterable[t.TxnResult]:
+        """
+        Make each (address, value) payment, submitting them all in one batch.
+        Later payments may spend change from earlier ones.
+        """
+        if self.stale:
+            self.sync()
+
+        txns = []
+
+        with self.lock:
+            try:
+                for to_addr, value in payments:
+                    txns.append(self.make_payment(to_addr, value))
+            except InsufficientFundsError:
+                for txn in txns:
+                    self.settle(txn.id)
+                raise
+
+        # Payments without change don't pay our address, so are watched
+        # by txid, from before they reach the mempool.
+        if any(not change_utxo(txn) for txn in txns):
+            self.subscribe()
+
+        results = self.request(t.TxBatchMsg(txns))
+
+        with self.lock:
+            for result in results:
+                if result.rejection:
+                    self.settle(result.txid)
+
+        return results
+
+    def get_balance(self) -> Tuple[int, int]:
+        """Confirmed and spendable balances."""
+        if self.stale:
+            self.sync()
+
+        with self.lock:
+            return self.balance, self.spendable
+
+
+def change_utxo(txn: t.Transaction) -> Union[None, t.UnspentTxOut]:
+    """The change a wallet payment pays back to us (if any), unconfirmed."""
+    if len(txn.txouts) < 2:
+        return None
+
+    return t.UnspentTxOut(
+        *txn.txouts[1], txid=txn.id, txout_idx=1, is_coinbase=False,
+        height=-1)
+
+
+def run_wallet(args):
+    wallet = WalletService(
+        args['signing_key'], args['my_addr'],
+        getattr(send_msg, 'node_hostname', 'localhost'),
+        getattr(send_msg, 'port', 9999), int(args['--fee']))
+    coin = t.Params.BELUSHIS_PER_COIN
+
+    for line in iter(input_line, None):
+        cmd, *params = line.split()
+
+        if cmd == 'balance':
+            try:
+                balance, spendable = wallet.get_balance()
+            except ConnectionError as e:
+                logger.error(f'{line}: {e}')
+                continue
+
+            print(f'{balance / coin} ⛼  ({spendable / coin} spendable)',
+                  flush=True)
+        elif cmd == 'send' and params and len(params) % 2 == 0:
+            try:
+                payments = [(addr, int(val))
+                            for addr, val in zip(params[::2], params[1::2])]
+                results = wallet.send(payments)
+            except InsufficientFundsError as e:
+                logger.error(e.msg)
+                continue
+            except (ValueError, ConnectionError) as e:
+                logger.error(f'{line}: {e}')
+                continue
+
+            for result in results:
+                print(f'{result.txid}:rejected:{result.rejection}'
+                      if result.rejection else result.txid, flush=True)
+        else:
+            logger.error(f'unknown command: {line}')
+
+    wallet.close()
+
+
+def input_line():
+    """The next non-blank line of stdin, or None at its end."""
+    while True:
+        try:
+            line = input().strip()
+        except EOFError:
+            return None
+
+        if line:
+            return line
+
+
 if __name__ == '__main__':
     main(docopt(__doc__, version='tinychain client 0.1'))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+⛼  tinychain network simulator
+
+Usage:
+  sim_tinychain.py [options]
+
+Options:
+  -h --help                Show help
+  -n, --nodes N            Nodes in the network [default: 100]
+  -p, --peers N            Peers each node connects out to [default: 8]
+  -b, --blocks N           Blocks to mine, across the network [default: 50]
+  -i, --interval SECS      Mean time between blocks [default: 60]
+  -l, --latency MS         One-way latency of every link [default: 100]
+  -w, --bandwidth KBPS     Throughput of every link, in KB/s [default: 1000]
+  -s, --seed N             Seed for the topology and miners [default: 0]
+
+Runs many tinychain nodes in this process, each a `tinychain.Node`, which
+exchange messages over an in-memory transport instead of sockets. Time is
+simulated: each message arrives after the link's latency plus the time to
+push its frame through the link's bandwidth, behind whatever's already on
+that link. Block discovery is a Poisson process with every node holding an
+equal share of the hashrate, at a difficulty trivial enough to solve at once.
+Blocks carry only their coinbase.
+
+Reported are how long blocks take to reach each node's active chain, the
+share of mined blocks which end up off the best chain, and how often nodes
+reorganize.
+
+"""
+import heapq
+import logging
+import random
+import time
+from functools import partial
+from typing import NamedTuple, Iterable, Dict
+
+from docopt import docopt
+
+import tinychain as t
+
+
+class SimResult(NamedTuple):
+    num_nodes: int
+    blocks_mined: int
+    stale_blocks: int
+    reorgs: int
+    deepest_reorg: int
+    # Seconds from when a block is mined to when it's on each other node's
+    # active chain, for every (block, node) pair where it got there.
+    propagation_delays: Iterable[float]
+    bytes_sent: int
+    converged: bool
+
+    @property
+    def orphan_rate(self) -> float:
+        return self.stale_blocks / self.blocks_mined if self.blocks_mined \
+            else 0.
+
+
+class SimSocket:
+    """Stands in for the socket a message arrived on, to reply over."""
+
+    def __init__(self, network: 'Network', src: str, dst: str):
+        self.network = network
+        self.src = src
+        self.dst = dst
+
+    def sendall(self, data: bytes):
+        self.network.transmit(self.src, self.dst, data)
+
+
+class Network:
+
+    def __init__(self, num_nodes: int, num_peers: int, latency: float,
+                 bandwidth: float, rng: random.Random,
+                 start_time: int = None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rng = rng
+        self.now = 0.
+
+        # Far enough back that no block is ever from the future.
+        self.start_time = start_time or int(time.time()) - 365 * 24 * 60 * 60
+        self.genesis = mine_genesis(self.start_time)
+        self.nodes: Dict[str, t.Node] = {
+            f'node{i}': t.Node(f'node{i}', self.genesis, filter_capacity=1000)
+            for i in range(num_nodes)}
+
+        names = list(self.nodes)
+        for name, node in self.nodes.items():
+            node.module.send_to_peer = partial(self.send_to_peer, node)
+            others = [n for n in names if n != name]
+            for peer in rng.sample(others, min(num_peers, len(others))):
+                node.peer_hostnames.add(peer)
+                self.nodes[peer].peer_hostnames.add(name)
+
+        self.events = []
+        self.num_events = 0
+        # When each (src, dst) link finishes sending what's queued on it.
+        self.busy_until: Dict[tuple, float] = {}
+        self.bytes_sent = 0
+
+        # block id -> (miner, when it was mined)
+        self.mined: Dict[str, tuple] = {}
+        # node name -> {block id -> when it first joined its active chain}
+        self.arrivals = {name: {} for name in self.nodes}
+        # node name -> ids of its active chain, as of its last event
+        self.chain_ids = {name: [self.genesis.id] for name in self.nodes}
+        self.reorg_depths = []
+
+    def schedule(self, when: float, fnc, *args):
+        # The counter breaks ties so events at the same time run in order.
+        heapq.heappush(self.events, (when, self.num_events, fnc, args))
+        self.num_events += 1
+
+    def run(self, until: float = None):
+        while self.events and (until is None or self.events[0][0] <= until):
+            self.now, _, fnc, args = heapq.heappop(self.events)
+            fnc(*args)
+
+    def send_to_peer(self, node: t.Node, data, peer=None):
+        """Replaces each node's `send_to_peer()`."""
+        peer = peer or self.rng.choice(list(node.peer_hostnames))
+        self.transmit(node.name, peer, t.encode_socket_data(data))
+
+    def transmit(self, src: str, dst: str, frame: bytes):
+        start = max(self.now, self.busy_until.get((src, dst), 0.))
+        sent = start + len(frame) / self.bandwidth
+        self.busy_until[(src, dst)] = sent
+        self.bytes_sent += len(frame)
+        self.schedule(sent + self.latency, self.deliver, src, dst, frame)
+
+    def deliver(self, src: str, dst: str, frame: bytes):
+        node = self.nodes[dst]
+        # Decoded by the node, into its own message classes.
+        msg = node.deserialize(frame[t.FRAME_HEADER.size:])
+
+        node.handle_msg(msg, SimSocket(self, dst, src), src)
+        self.record_tip_change(node)
+
+    def mine_block(self):
+        node = self.nodes[self.rng.choice(list(self.nodes))]
+        tip = node.active_chain[-1]
+        # Blocks must be later than the median time past, which a burst of
+        # blocks within a second would otherwise fail.
+        timestamp = max(
+            self.start_time + int(self.now),
+            node.get_block_index(tip.id).median_time_past + 1)
+        block = node.mine(node.assemble_block(
+            t.pubkey_to_address(node.name.encode()), timestamp=timestamp))
+
+        self.mined[block.id] = (node.name, self.now)
+        node.connect_block(block)
+        self.record_tip_change(node)
+
+    def record_tip_change(self, node: t.Node):
+        chain = node.active_chain
+        chain_ids = self.chain_ids[node.name]
+
+        if chain[-1].id == chain_ids[-1]:
+            return
+
+        fork_height = min(len(chain), len(chain_ids)) - 1
+        while chain[fork_height].id != chain_ids[fork_height]:
+            fork_height -= 1
+
+        # The old tip is no longer in the active chain: we reorganized.
+        if fork_height < len(chain_ids) - 1:
+            self.reorg_depths.append(len(chain_ids) - 1 - fork_height)
+
+        del chain_ids[fork_height + 1:]
+        arrivals = self.arrivals[node.name]
+
+        for block in chain[fork_height + 1:]:
+            chain_ids.append(block.id)
+            arrivals.setdefault(block.id, self.now)
+
+    def result(self) -> SimResult:
+        tips = {n.active_chain[-1].id for n in self.nodes.values()}
+        best_chain = max(
+            (n.active_chain for n in self.nodes.values()), key=len)
+        best_ids = {b.id for b in best_chain}
+
+        delays = [
+            arrivals[block_id] - mined_at
+            for name, arrivals in self.arrivals.items()
+            for block_id, (miner, mined_at) in self.mined.items()
+            if block_id in arrivals and name != miner]
+
+        return SimResult(
+            num_nodes=len(self.nodes),
+            blocks_mined=len(self.mined),
+            stale_blocks=len(set(self.mined) - best_ids),
+            reorgs=len(self.reorg_depths),
+            deepest_reorg=max(self.reorg_depths, default=0),
+            propagation_delays=delays,
+            bytes_sent=self.bytes_sent,
+            converged=len(tips) == 1,
+        )
+
+
+def mine_genesis(timestamp: int, bits: int = 1) -> t.Block:
+    coinbase = t.Transaction.create_coinbase(
+        t.pubkey_to_address(b'genesis'), t.get_block_subsidy(), 0)
+    block = t.Block(
+        version=0, prev_block_hash=None,
+        merkle_hash=t.get_merkle_root_of_txns([coinbase]).val,
+        timestamp=timestamp, bits=bits, nonce=0, txns=[coinbase])
+
+    while int(block.id, 16) > (1 << (256 - bits)):
+        block = block._replace(nonce=block.nonce + 1)
+
+    return block
+
+
+def simulate(num_nodes: int, num_peers: int, num_blocks: int,
+             block_interval: float, latency: float, bandwidth: float,
+             seed: int = 0) -> SimResult:
+    """
+    Mine `num_blocks` blocks across a random network, then let them settle.
+    `latency` is in seconds and `bandwidth` in bytes per second.
+    """
+    rng = random.Random(seed)
+    network = Network(num_nodes, num_peers, latency, bandwidth, rng)
+
+    when = 0.
+    for _ in range(num_blocks):
+        when += rng.expovariate(1 / block_interval)
+        network.schedule(when, network.mine_block)
+
+    network.run()
+    return network.result()
+
+
+def report(result: SimResult):
+    delays = sorted(result.propagation_delays) or [0.]
+
+    def percentile(p):
+        return delays[min(len(delays) - 1, int(len(delays) * p))] * 1000
+
+    print(f'{result.num_nodes} nodes, {result.blocks_mined} blocks mined')
+    print(f'  propagation: median {percentile(0.5):8.1f} ms   '
+          f'90th {percentile(0.9):8.1f} ms   max {percentile(1):8.1f} ms')
+    print(f'  orphan rate: {result.orphan_rate:8.2%} '
+          f'({result.stale_blocks} blocks off the best chain)')
+    print(f'  reorgs:      {result.reorgs / result.num_nodes:8.2f} per node '
+          f'(deepest {result.deepest_reorg})')
+    print(f'  traffic:     {result.bytes_sent / 1e6:8.2f} MB')
+    print(f'  converged:   {result.converged}')
+
+
+def main(args):
+    # Every block is otherwise logged at INFO, and orphans at ERROR.
+    t.logger.setLevel(logging.CRITICAL)
+
+    report(simulate(
+        num_nodes=int(args['--nodes']),
+        num_peers=int(args['--peers']),
+        num_blocks=int(args['--blocks']),
+        block_interval=float(args['--interval']),
+        latency=float(args['--latency']) / 1000,
+        bandwidth=float(args['--bandwidth']) * 1000,
+        seed=int(args['--seed']),
+    ))
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
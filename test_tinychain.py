@@ -1,4 +1,10 @@
+import json
+import logging
+import socket
+import sys
+import threading
 import time
+import urllib.request
 
 import pytest
 import ecdsa
@@ -26,6 +32,13 @@ def test_merkle_trees():
     assert root.children[0].val == t.sha256d(fooh + barh)
     assert root.children[1].val == t.sha256d(bazh + bazh)
 
+    # An odd number of nodes on a higher level is padded out too.
+    root = t.get_merkle_root('foo', 'bar', 'baz', 'qux', 'quux')
+    quuxh = t.sha256d('quux')
+
+    assert root.children[1].children[0].val == t.sha256d(quuxh + quuxh)
+    assert root.children[1].children[1] == root.children[1].children[0]
+
 
 def test_serialization():
     op1 = t.OutPoint(txid='c0ffee', txout_idx=0)
@@ -69,28 +82,27 @@ def test_build_spend_message():
 
 
 def test_get_median_time_past():
-    t.active_chain = []
-    assert t.get_median_time_past(10) == 0
+    node = _node('mtp')
+    assert node.get_median_time_past(10) == 0
 
     timestamps = [1, 30, 60, 90, 400]
-    t.active_chain = [_dummy_block(timestamp=t) for t in timestamps]
+    node.active_chain.extend(_dummy_block(timestamp=t) for t in timestamps)
 
-    assert t.get_median_time_past(1) == 400
-    assert t.get_median_time_past(3) == 90
-    assert t.get_median_time_past(2) == 90
-    assert t.get_median_time_past(5) == 60
+    assert node.get_median_time_past(1) == 400
+    assert node.get_median_time_past(3) == 90
+    assert node.get_median_time_past(2) == 90
+    assert node.get_median_time_past(5) == 60
 
 
 def test_dependent_txns_in_single_block():
-    t.active_chain = []
-    t.mempool = {}
-    assert t.connect_block(chain1[0]) == t.ACTIVE_CHAIN_IDX
-    assert t.connect_block(chain1[1]) == t.ACTIVE_CHAIN_IDX
+    node = _node('dependent')
+    assert node.connect_block(chain1[0]) == t.ACTIVE_CHAIN_IDX
+    assert node.connect_block(chain1[1]) == t.ACTIVE_CHAIN_IDX
 
-    assert len(t.active_chain) == 2
-    assert len(t.utxo_set) == 2
+    assert len(node.active_chain) == 2
+    assert len(node.utxo_set) == 2
 
-    utxo1 = t.utxo_set[list(t.utxo_set.keys())[0]]
+    utxo1 = node.utxo_set[list(node.utxo_set.keys())[0]]
     txout1 = TxOut(value=901, to_address=utxo1.to_address)
     txin1 = make_txin(signing_key, utxo1.outpoint, txout1)
     txn1 = t.Transaction(txins=[txin1], txouts=[txout1], locktime=0)
@@ -104,21 +116,21 @@ def test_dependent_txns_in_single_block():
     # Assert that we don't accept this txn -- too early to spend the coinbase.
 
     with pytest.raises(t.TxnValidationError) as excinfo:
-        t.validate_txn(txn2)
+        node.validate_txn(txn2)
         assert 'UTXO not ready' in str(excinfo.value)
 
-    t.connect_block(chain1[2])
+    node.connect_block(chain1[2])
 
     # Now the coinbase has matured to spending.
-    t.add_txn_to_mempool(txn1)
-    assert txn1.id in t.mempool
+    node.add_txn_to_mempool(txn1)
+    assert txn1.id in node.mempool
 
     # In txn2, we're attempting to spend more than is available (9001 vs. 901).
 
-    assert not t.add_txn_to_mempool(txn2)
+    assert not node.add_txn_to_mempool(txn2)
 
     with pytest.raises(t.TxnValidationError) as excinfo:
-        t.validate_txn(txn2)
+        node.validate_txn(txn2)
         assert 'Spend value is more than available' in str(excinfo.value)
 
     # Recreate the transaction with an acceptable value.
@@ -126,20 +138,20 @@ def test_dependent_txns_in_single_block():
     txin2 = make_txin(signing_key, t.OutPoint(txn1.id, 0), txout2)
     txn2 = t.Transaction(txins=[txin2], txouts=[txout2], locktime=0)
 
-    t.add_txn_to_mempool(txn2)
-    assert txn2.id in t.mempool
+    node.add_txn_to_mempool(txn2)
+    assert txn2.id in node.mempool
 
-    block = t.assemble_and_solve_block(t.pubkey_to_address(
+    block = node.assemble_and_solve_block(t.pubkey_to_address(
         signing_key.get_verifying_key().to_string()))
 
-    assert t.connect_block(block) == t.ACTIVE_CHAIN_IDX
+    assert node.connect_block(block) == t.ACTIVE_CHAIN_IDX
 
-    assert t.active_chain[-1] == block
+    assert node.active_chain[-1] == block
     assert block.txns[1:] == [txn1, txn2]
-    assert txn1.id not in t.mempool
-    assert txn2.id not in t.mempool
-    assert t.OutPoint(txn1.id, 0) not in t.utxo_set  # Spent by txn2.
-    assert t.OutPoint(txn2.id, 0) in t.utxo_set
+    assert txn1.id not in node.mempool
+    assert txn2.id not in node.mempool
+    assert t.OutPoint(txn1.id, 0) not in node.utxo_set  # Spent by txn2.
+    assert t.OutPoint(txn2.id, 0) in node.utxo_set
 
 
 def test_pubkey_to_address():
@@ -151,74 +163,1161 @@ def test_pubkey_to_address():
 
 
 def test_reorg():
-    t.active_chain = []
+    node = t.Node('reorg', chain1[0])
 
-    for block in chain1:
-        assert t.connect_block(block) == t.ACTIVE_CHAIN_IDX
+    for block in chain1[1:]:
+        assert node.connect_block(block) == t.ACTIVE_CHAIN_IDX
 
-    t.side_branches = []
-    t.mempool = {}
-    t.utxo_set = {}
-    _add_to_utxo_for_chain(t.active_chain)
+    node.utxo_set.clear()
+    _add_to_utxo_for_chain(node, node.active_chain)
 
     def assert_no_change():
-        assert t.active_chain == chain1
-        assert t.mempool == {}
-        assert [k.txid[:6] for k in t.utxo_set] == [
+        assert node.active_chain == chain1
+        assert node.mempool == {}
+        assert [k.txid[:6] for k in node.utxo_set] == [
             '8b7bfc', 'b8a642', '6708b9']
 
-    assert len(t.utxo_set) == 3
+    assert len(node.utxo_set) == 3
 
     # No reorg necessary when side branches are empty.
 
-    assert not t.reorg_if_necessary()
+    assert not node.reorg_if_necessary()
 
     # No reorg necessary when side branch is shorter than the main chain.
 
     for block in chain2[1:2]:
-        assert t.connect_block(block) == 1
+        assert node.connect_block(block) == 1
 
-    assert not t.reorg_if_necessary()
-    assert t.side_branches == [chain2[1:2]]
+    assert not node.reorg_if_necessary()
+    assert node.side_branches == [chain2[1:2]]
     assert_no_change()
 
     # No reorg necessary when side branch is as long as the main chain.
 
-    assert t.connect_block(chain2[2]) == 1
+    assert node.connect_block(chain2[2]) == 1
 
-    assert not t.reorg_if_necessary()
-    assert t.side_branches == [chain2[1:3]]
+    assert not node.reorg_if_necessary()
+    assert node.side_branches == [chain2[1:3]]
     assert_no_change()
 
     # No reorg necessary when side branch is a longer but invalid chain.
 
     # Block doesn't connect to anything because it's invalid.
-    assert t.connect_block(chain3_faulty[3]) is None
-    assert not t.reorg_if_necessary()
+    assert node.connect_block(chain3_faulty[3]) is None
+    assert not node.reorg_if_necessary()
 
     # No change in side branches for an invalid block.
-    assert t.side_branches == [chain2[1:3]]
+    assert node.side_branches == [chain2[1:3]]
     assert_no_change()
 
     # Reorg necessary when a side branch is longer than the main chain.
 
-    assert t.connect_block(chain2[3]) == 1
-    assert t.connect_block(chain2[4]) == 1
+    assert node.connect_block(chain2[3]) == 1
+    assert node.connect_block(chain2[4]) == 1
 
     # Chain1 was reorged into side_branches.
-    assert [len(c) for c in t.side_branches] == [2]
-    assert [b.id for b in t.side_branches[0]] == [b.id for b in chain1[1:]]
-    assert t.side_branches == [chain1[1:]]
-    assert t.mempool == {}
-    assert [k.txid[:6] for k in t.utxo_set] == [
+    assert [len(c) for c in node.side_branches] == [2]
+    assert [b.id for b in node.side_branches[0]] == [
+        b.id for b in chain1[1:]]
+    assert node.side_branches == [chain1[1:]]
+    assert node.mempool == {}
+    assert [k.txid[:6] for k in node.utxo_set] == [
         '8b7bfc', 'b8a642', '6708b9', '543683', '53f3c1']
 
 
-def _add_to_utxo_for_chain(chain):
+def test_block_index(monkeypatch):
+    monkeypatch.setattr(t.Params, 'DIFFICULTY_PERIOD_IN_BLOCKS', 3)
+    node = _node('index', chain1)
+
+    tip = node.block_index[chain1[-1].id]
+    assert tip.height == 2
+    assert tip.chain_work == 3 * 2 ** 24
+    assert tip.recent_timestamps == tuple(b.timestamp for b in chain1[::-1])
+    assert tip.median_time_past == node.get_median_time_past(11)
+    assert tip.period_start_timestamp == chain1[0].timestamp
+
+    # The last block of a period triggers a retarget; this period went by
+    # much faster than targeted, so difficulty rises.
+    assert node.get_next_work_required(chain1[1].id) == 24
+    assert node.get_next_work_required(chain1[2].id) == 25
+
+    # A chain set up wholesale is indexed without recursing per ancestor.
+    node = t.Node('wholesale', chain1[0])
+
+    for i in range(sys.getrecursionlimit()):
+        node.active_chain.append(chain1[1]._replace(
+            prev_block_hash=node.active_chain[-1].id, nonce=i))
+
+    tip = node.get_block_index(node.active_chain[-1].id)
+    assert tip.height == len(node.active_chain) - 1
+    assert len(node.block_index) == len(node.active_chain)
+
+
+def test_utxo_snapshot(tmpdir, monkeypatch):
+    node = _node('snapshot', chain1)
+
+    path = str(tmpdir.join('utxo.snapshot'))
+    snapshot_hash = node.dump_utxo_snapshot(node.make_utxo_snapshot(), path)
+    utxos = dict(node.utxo_set)
+
+    # Snapshots must be vouched for by `Params`.
+    with pytest.raises(t.UTXOSnapshotError):
+        node.load_utxo_snapshot(path)
+
+    monkeypatch.setitem(
+        t.Params.ASSUMEUTXO_SNAPSHOTS, chain1[-1].id, snapshot_hash)
+    snapshot = node.load_utxo_snapshot(path)
+
+    assert node.utxo_set == utxos
+    assert [b.id for b in node.active_chain] == [b.id for b in chain1]
+    assert not any(b.txns for b in node.active_chain)
+
+    # History which doesn't match the snapshot is rejected...
+    assert not node.verify_snapshot_history(snapshot, iter(chain2))
+    assert not any(b.txns for b in node.active_chain[1:])
+    assert not node.snapshot_verified.is_set()
+
+    # ...while the real history fills in the missing block bodies.
+    assert node.verify_snapshot_history(snapshot, iter(chain1))
+    assert node.active_chain == chain1
+    assert node.snapshot_verified.is_set()
+
+
+def test_pruning(monkeypatch):
+    monkeypatch.setattr(t.Params, 'MIN_BLOCKS_TO_KEEP', 1)
+    node = _node('pruning', chain1, PRUNE_DEPTH=1)
+
+    # Headers and UTXOs survive, but only the tip keeps its body.
+    assert [b.id for b in node.active_chain] == [b.id for b in chain1]
+    assert [bool(b.txns) for b in node.active_chain] == [False, False, True]
+    assert list(node.block_undo) == [chain1[2].id]
+    assert len(node.utxo_set) == 3
+    assert node.pruned_height == 2
+
+    node_sock, peer_sock = socket.socketpair()
+
+    with node_sock, peer_sock:
+        node.GetBlocksMsg(chain1[0].id).handle(node_sock, 'peer')
+        assert t.read_all_from_socket(peer_sock) == t.InvMsg(
+            [], pruned_height=2)
+
+
+def test_range_queries():
+    node = _node('range', chain1)
+    node.GetBlockRangeMsg.CHUNK_SIZE = 2
+
+    node_sock, client_sock = socket.socketpair()
+
+    with node_sock, client_sock:
+        node.GetBlockRangeMsg(1).handle(node_sock, 'client')
+        assert list(t.read_stream_from_socket(client_sock)) == chain1[1:]
+
+        # Page through UTXOs, filtering by address.
+        addr = chain1[-1].txns[0].txouts[0].to_address
+        pages = []
+        cursor = None
+
+        while True:
+            node.GetUTXOPageMsg(
+                after=cursor, limit=1, to_address=addr).handle(
+                    node_sock, 'client')
+            pages.append(t.read_all_from_socket(client_sock))
+            cursor = pages[-1].next_cursor
+
+            if not cursor:
+                break
+
+    assert [len(p.utxos) for p in pages] == [1, 1, 0]
+    assert sorted(u for p in pages for u in p.utxos) == sorted(
+        u for u in node.utxo_set.values() if u.to_address == addr)
+
+    # Pages come off an index which is kept in order as the set changes.
+    utxos = t.UTXOSet(node.utxo_set.values())
+    first, *rest = sorted(utxos)
+    utxos.pop(first)
+    del utxos[rest[-1]]
+    utxos[rest[0]] = utxos[rest[0]]._replace(to_address='1')
+
+    assert utxos.outpoints == sorted(utxos) == rest[:-1]
+    assert dict(utxos.by_address) == {
+        a: sorted(op for op, u in utxos.items() if u.to_address == a)
+        for a in {u.to_address for u in utxos.values()}}
+    assert utxos.page(first, 5) == [utxos[op] for op in rest[:-1]]
+    assert utxos.page(rest[0], 5, '1') == []
+
+
+def test_mempool_conflicts():
+    node = _node('conflicts', chain1)
+    utxo = node.utxo_set[t.OutPoint(chain1[0].txns[0].id, 0)]
+
+    def spend(outpoint, value):
+        txout = TxOut(value=value, to_address=utxo.to_address)
+        return t.Transaction(
+            txins=[make_txin(signing_key, outpoint, txout)], txouts=[txout])
+
+    txn = spend(utxo.outpoint, 901)
+    child = spend(t.OutPoint(txn.id, 0), 900)
+    double_spend = spend(utxo.outpoint, 902)
+
+    node.add_txn_to_mempool(txn)
+    node.add_txn_to_mempool(child)
+    assert list(node.mempool) == [txn.id, child.id]
+
+    # Conflicts are turned away at the door.
+    with pytest.raises(t.TxnValidationError) as excinfo:
+        node.validate_txn(double_spend)
+    assert 'already spent by mempool txn' in excinfo.value.msg
+
+    node.add_txn_to_mempool(double_spend)
+    assert double_spend.id not in node.mempool
+
+    # Confirming the double spend evicts the txn it conflicts with, along
+    # with that txn's descendants.
+    assert node.evict_mempool_conflicts(double_spend) == [txn.id, child.id]
+    assert node.mempool == {}
+    assert not node.mempool_spends
+
+
+def test_bounded_mempool(monkeypatch):
+    node = _node('bounded', chain1)
+    utxo = node.utxo_set[t.OutPoint(chain1[0].txns[0].id, 0)]
+
+    def spend(outpoint, value):
+        txout = TxOut(value=value, to_address=utxo.to_address)
+        return t.Transaction(
+            txins=[make_txin(signing_key, outpoint, txout)], txouts=[txout])
+
+    parent = spend(utxo.outpoint, utxo.value - 100_000)
+    child = spend(t.OutPoint(parent.id, 0), utxo.value - 100_010)
+    size = len(t.serialize(parent)) + len(t.serialize(child))
+
+    # The low fee-rate child doesn't fit.
+    monkeypatch.setattr(t.Params, 'MAX_MEMPOOL_SIZE_BYTES', size - 1)
+    node.add_txn_to_mempool(parent)
+    node.add_txn_to_mempool(child)
+
+    assert list(node.mempool) == [parent.id]
+    assert node.mempool_bytes == len(t.serialize(parent))
+
+    # The bar to entry rises above the evicted fee rate, then decays.
+    child_fee_rate = 10 * 1000 // len(t.serialize(child))
+    assert t.Params.INCREMENTAL_RELAY_FEE_RATE < \
+        node.get_mempool_min_fee_rate() <= \
+        child_fee_rate + t.Params.INCREMENTAL_RELAY_FEE_RATE
+
+    node_sock, client_sock = socket.socketpair()
+
+    with node_sock, client_sock:
+        node.GetMempoolStatsMsg().handle(node_sock, 'client')
+        stats = t.read_all_from_socket(client_sock)
+
+    assert (stats.size, stats.bytes, stats.evictions) == (
+        1, len(t.serialize(parent)), 1)
+
+    # Stale txns are expired along with their descendants.
+    monkeypatch.setattr(t.Params, 'MEMPOOL_EXPIRY_SECS', -1)
+    assert node.expire_mempool() == [parent.id]
+    assert node.mempool == {}
+    assert node.mempool_bytes == 0
+
+
+def test_mempool_persistence(tmpdir):
+    node = _node('persistence', chain1)
+    utxo = node.utxo_set[t.OutPoint(chain1[0].txns[0].id, 0)]
+
+    def spend(outpoint, value):
+        txout = TxOut(value=value, to_address=utxo.to_address)
+        return t.Transaction(
+            txins=[make_txin(signing_key, outpoint, txout)], txouts=[txout])
+
+    parent = spend(utxo.outpoint, 901)
+    child = spend(t.OutPoint(parent.id, 0), 900)
+
+    assert t.sort_txns_topologically([child, parent]) == [parent, child]
+
+    node.add_txn_to_mempool(parent)
+    node.add_txn_to_mempool(child)
+    entry_time = node.mempool_entries[parent.id].time
+
+    path = str(tmpdir.join('mempool.dat'))
+    assert node.dump_mempool(path) == 2
+
+    # Simulate a restart.
+    node.remove_from_mempool(parent.id, with_descendants=True)
+    assert node.mempool == {}
+
+    assert node.load_mempool(path) == 2
+    assert list(node.mempool) == [parent.id, child.id]
+    assert node.mempool_entries[parent.id].time == int(entry_time)
+
+    # Txns which no longer validate are dropped on load.
+    node.remove_from_mempool(parent.id, with_descendants=True)
+    node.rm_from_utxo(*utxo.outpoint)
+    orphans = list(node.orphan_txns)
+
+    assert node.load_mempool(path) == 0
+    assert node.mempool == {}
+    assert node.orphan_txns == orphans
+
+
+def test_tx_batch():
+    node = _node('batch', chain1)
+    utxo = node.utxo_set[t.OutPoint(chain1[0].txns[0].id, 0)]
+
+    def spend(outpoint, value):
+        txout = TxOut(value=value, to_address=utxo.to_address)
+        return t.Transaction(
+            txins=[make_txin(signing_key, outpoint, txout)], txouts=[txout])
+
+    parent = spend(utxo.outpoint, 901)
+    child = spend(t.OutPoint(parent.id, 0), 900)
+    double_spend = spend(utxo.outpoint, 902)
+
+    sent = []
+    node.peer_hostnames.add('peer')
+    node.module.send_to_peer = lambda data, peer=None: sent.append(data)
+
+    node_sock, client_sock = socket.socketpair()
+
+    with node_sock, client_sock:
+        # Children may come before their parents.
+        node.TxBatchMsg([child, parent, double_spend]).handle(
+            node_sock, 'client')
+        results = t.read_all_from_socket(client_sock)
+
+    assert [r.txid for r in results] == [
+        child.id, parent.id, double_spend.id]
+    assert [r.rejection for r in results][:2] == [None, None]
+    assert 'already spent by mempool txn' in results[2].rejection
+    assert list(node.mempool) == [parent.id, child.id]
+
+    # Accepted txns are announced together.
+    assert sent == [
+        t.InvMsg([], node.pruned_height, txids=[parent.id, child.id])]
+
+
+def test_peer_sessions():
+    node = _node('sessions', chain1)
+    server = node.ThreadedTCPServer(('127.0.0.1', 0), node.TCPHandler)
+    node.module.PORT = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        # We're our own peer here: the reply to our getblocks comes back
+        # over the same session, telling us there's nothing new.
+        node.ibd_done.clear()
+        node.send_to_peer(node.GetBlocksMsg(chain1[-1].id), '127.0.0.1')
+        assert node.ibd_done.wait(5)
+
+        session = node.peer_sessions['127.0.0.1']
+        sock = session.sock
+        node.send_to_peer(node.PingMsg(1), '127.0.0.1')
+        assert session.flush(5)
+
+        # Both messages went over the one pooled connection.
+        assert list(node.peer_sessions) == ['127.0.0.1']
+        assert session.sock is sock
+
+        # Dropped sessions are re-established on demand.
+        session.disconnect()
+        node.send_to_peer(node.PingMsg(2), '127.0.0.1')
+        assert session.flush(5)
+        assert session.connected and session.sock is not sock
+        assert session.num_dropped == 0
+    finally:
+        for session in node.peer_sessions.values():
+            session.disconnect()
+        server.shutdown()
+        server.server_close()
+
+    # Unreachable peers are backed off from rather than retried inline.
+    session.disconnect()
+
+    with pytest.raises(OSError):
+        session.connect()
+    with pytest.raises(t.PeerUnavailableError):
+        session.connect()
+
+
+def test_relay_queue():
+    node = _node('relay', RELAY_QUEUE_DEPTH=2)
+
+    # Relaying to a dead peer returns immediately rather than retrying.
+    session = node.get_peer_session('127.0.0.1')
+    session.next_connect_at = time.time() + 60
+    session.sender = 'stub'  # Hold everything in the queue.
+
+    start = time.time()
+    node.send_to_peer(chain1[0], '127.0.0.1')
+    node.send_to_peer(chain1[0].txns[0], '127.0.0.1')
+    node.send_to_peer(chain1[1], '127.0.0.1')
+    assert time.time() - start < 1
+
+    # Txns are dropped before blocks when the queue overflows.
+    assert [m for _, m in session.send_queue] == [chain1[0], chain1[1]]
+    assert session.num_dropped == 1
+
+    # Messages to a peer we're backing off from are dropped by the sender.
+    session.sender = None
+    node.send_to_peer(chain1[2], '127.0.0.1')
+    assert session.flush(5)
+    assert not session.send_queue
+    assert session.num_dropped == 4
+
+
+def test_asyncio_transport():
+    node = _node('asyncio', chain1, USE_ASYNCIO=True)
+    server = node.start_async_server('127.0.0.1', 0)
+    node.module.PORT = server.sockets[0].getsockname()[1]
+
+    try:
+        # Plain blocking clients are served by the event loop...
+        assert node.request_from_peer(node.PingMsg(7), '127.0.0.1') == \
+            t.PongMsg(7)
+
+        # ...and so are outbound sessions, including handlers' replies.
+        node.ibd_done.clear()
+        node.send_to_peer(node.GetBlocksMsg(chain1[-1].id), '127.0.0.1')
+        assert node.ibd_done.wait(5)
+
+        session = node.peer_sessions['127.0.0.1']
+        assert isinstance(session, node.AsyncPeerSession)
+
+        node.send_to_peer(node.PingMsg(1), '127.0.0.1')
+        assert session.flush(5)
+        assert session.connected and session.num_dropped == 0
+    finally:
+        session.disconnect()
+        node.event_loop.call_soon_threadsafe(server.close)
+
+
+def test_framing():
+    node = t.Node('framing')
+    sock, peer_sock = socket.socketpair()
+    msg = t.InvMsg(chain1 * 10)
+    data = t.encode_socket_data(msg)
+
+    with sock, peer_sock:
+        assert t.FRAME_HEADER.unpack(data[:4]) == (len(data) - 4,)
+
+        # Frames arriving in dribs and drabs are read whole, and only them.
+        def send_slowly():
+            for i in range(0, len(data), 1000):
+                sock.sendall(data[i:i + 1000])
+            sock.sendall(t.encode_socket_data(t.PingMsg(1)))
+
+        threading.Thread(target=send_slowly).start()
+        assert node.read_all_from_socket(peer_sock) == msg
+        assert node.read_all_from_socket(peer_sock) == t.PingMsg(1)
+
+        # Oversized frames are refused before being buffered.
+        node.module.MAX_MESSAGE_SIZE = 100
+        sock.sendall(data[:200])
+        with pytest.raises(t.ProtocolError):
+            node.read_all_from_socket(peer_sock)
+
+    # As are frames cut off partway through.
+    sock, peer_sock = socket.socketpair()
+
+    with peer_sock:
+        sock.sendall(t.encode_socket_data(t.PingMsg(1))[:-1])
+        sock.close()
+
+        with pytest.raises(t.ProtocolError):
+            node.read_all_from_socket(peer_sock)
+
+
+def test_inventory_relay():
+    node = _node('inventory', chain1)
+
+    sent = []
+    node.peer_hostnames.update({'peer1', 'peer2'})
+    node.module.send_to_peer = \
+        lambda data, peer=None: sent.append((peer, data))
+
+    # New objects are announced by id, and only once per peer.
+    node.mark_inventory_known('peer2', [chain1[2].id])
+    node.relay_inventory(block_ids=[chain1[2].id])
+    node.relay_inventory(block_ids=[chain1[2].id])
+    assert sent == [
+        ('peer1', t.InvMsg([], node.pruned_height, [chain1[2].id]))]
+
+    unknown_block_id, unknown_txid = 'ab' * 32, 'cd' * 32
+    node_sock, peer_sock = socket.socketpair()
+
+    with node_sock, peer_sock:
+        # Of what's announced, only what we lack is requested...
+        node.InvMsg([], 0, [chain1[1].id, unknown_block_id], [unknown_txid]) \
+            .handle(node_sock, 'peer1')
+        assert t.read_all_from_socket(peer_sock) == t.GetDataMsg(
+            [unknown_block_id], [unknown_txid])
+
+        # ...and only from the first peer to announce it.
+        node.InvMsg([], 0, [unknown_block_id]).handle(node_sock, 'peer2')
+
+        # Requests are answered with the objects themselves.
+        txn = chain1[1].txns[0]
+        node.mempool[txn.id] = txn
+        node.GetDataMsg([chain1[1].id], [txn.id, unknown_txid]).handle(
+            node_sock, 'peer2')
+        assert t.read_all_from_socket(peer_sock) == chain1[1]
+        assert t.read_all_from_socket(peer_sock) == t.TxBatchMsg(
+            [txn], reply=False)
+
+    # Peers aren't told about what they've announced or requested.
+    assert unknown_block_id in node.peer_inventory['peer1']
+    assert txn.id in node.peer_inventory['peer2']
+
+
+def test_compact_blocks():
+    def make_txn(i):
+        return Transaction(
+            txins=[TxIn(t.OutPoint('ff' * 32, i), b'sig', b'pk', 0)],
+            txouts=[TxOut(value=i, to_address='1')])
+
+    txns = [chain1[1].txns[0]] + [make_txn(i) for i in range(3)]
+    block = chain1[1]._replace(
+        merkle_hash=t.get_merkle_root_of_txns(txns).val, txns=txns)
+
+    # The peer has the block; we've only the txns in our mempool.
+    node, peer = t.Node('node'), t.Node('peer', chain1[0])
+    peer.active_chain.extend(chain1[1:] + [block])
+    connected = []
+    node.module.connect_block = connected.append
+
+    compact_block = node.CompactBlockMsg.from_block(block)
+    assert len(t.serialize(compact_block)) < len(t.serialize(block))
+
+    # Blocks whose txns are all in the mempool are rebuilt outright...
+    node.mempool.update((tx.id, tx) for tx in txns[1:])
+    compact_block.handle(None, 'peer')
+    assert connected == [block]
+
+    # ...otherwise only the missing txns are requested.
+    node.mempool.clear()
+    node.mempool.update((tx.id, tx) for tx in txns[1:3])
+    node_sock, peer_sock = socket.socketpair()
+
+    with node_sock, peer_sock:
+        compact_block.handle(node_sock, 'peer')
+        request = peer.read_all_from_socket(peer_sock)
+        assert request == t.GetBlockTxnMsg(block.id, [3])
+
+        request.handle(peer_sock, 'node')
+        node.read_all_from_socket(node_sock).handle(node_sock, 'peer')
+
+    assert connected == [block, block]
+    assert not node.partial_blocks
+
+    # Requests for txns the block doesn't have go unanswered.
+    sent = []
+    sock = peer.PeerSession('node')
+    sock.sendall = sent.append
+
+    for indexes in ([-1], [len(txns)], [1, 'x']):
+        peer.GetBlockTxnMsg(block.id, indexes).handle(sock, 'node')
+    assert not sent
+
+
+def test_recently_seen_filter():
+    bloom = t.RollingBloomFilter(10)
+
+    for i in range(25):
+        bloom.add(str(i))
+
+    # The last `capacity` items are always remembered; older ones roll off.
+    assert all(str(i) in bloom for i in range(15, 25))
+    assert '0' not in bloom
+    bloom.reset()
+    assert '24' not in bloom
+
+    node = t.Node('seen', filter_capacity=100)
+    session = node.PeerSession('peer')
+    txn = chain1[1].txns[0]
+    payload = t.serialize(txn).encode()
+
+    # Txns we've dealt with are dropped before being decoded.
+    assert session.decode(payload) == txn
+    node.recent_rejects.add(txn.id)
+    assert session.decode(payload) is None
+    assert session.decode(t.serialize(chain1[1]).encode()) == chain1[1]
+
+    # Blocks we've seen are dropped before being validated.
+    connected = []
+    node.module.connect_block = connected.append
+    node.recently_seen.add(chain1[1].id)
+    node.handle_msg(chain1[1], session, 'peer')
+    node.handle_msg(chain1[2], session, 'peer')
+    assert connected == [chain1[2]]
+
+
+def test_mutated_block_not_cached():
+    node = _node('mutated', chain1[:2])
+    session = node.PeerSession('peer')
+
+    # Repeating the last txn leaves the merkle root, and so the id, as is.
+    real = chain1[2]
+    mutated = real._replace(txns=real.txns + real.txns[-1:])
+    assert mutated.id == real.id
+
+    node.handle_msg(mutated, session, 'peer')
+    assert node.active_chain == chain1[:2]
+    assert real.id not in node.recently_seen
+
+    # A bad header can't be mended, so that's remembered.
+    bad_pow = real._replace(nonce=real.nonce + 1)
+    node.handle_msg(bad_pow, session, 'peer')
+    assert bad_pow.id in node.recently_seen
+
+    node.handle_msg(real, session, 'peer')
+    assert node.active_chain == chain1
+
+
+def test_compression():
+    node = t.Node('compression')
+    msg = t.InvMsg(chain1 * 5)
+    frame = t.encode_socket_data(msg)
+    node_sock, peer_sock = socket.socketpair()
+
+    with node_sock, peer_sock:
+        session = node.PeerSession('peer', sock=node_sock)
+
+        # Nothing's compressed until the peer says it can take it...
+        session.send(msg)
+        assert t.recv_exactly(peer_sock, len(frame)) == frame
+
+        # ...which it does as the session starts, and we answer in kind.
+        node.FeaturesMsg(['zlib']).handle(session, 'peer')
+        assert node.read_all_from_socket(peer_sock) == t.FeaturesMsg(['zlib'])
+
+        session.send(msg)
+        (wire_len,) = t.FRAME_HEADER.unpack(t.recv_exactly(peer_sock, 4))
+        payload = t.recv_exactly(peer_sock, wire_len)
+        assert payload[0] == t.ZLIB_HEADER_BYTE
+        assert wire_len * 3 < len(frame)
+        assert t.deserialize(node.decode_payload(payload)) == msg
+
+        # Small messages go as they are.
+        session.send(t.PingMsg(1))
+        assert node.read_all_from_socket(peer_sock) == t.PingMsg(1)
+
+    stats = node.net_stats
+    assert stats['bytes_sent_uncompressed'] - stats['bytes_sent'] == \
+        len(frame) - (wire_len + 4)
+    assert stats['bytes_recv'] < stats['bytes_recv_uncompressed']
+
+
+def test_rwlock():
+    lock = t.RWLock()
+    both_reading = threading.Barrier(2, timeout=5)
+
+    def read():
+        with lock.shared:
+            both_reading.wait()
+
+    # Readers share the lock...
+    reader = threading.Thread(target=read)
+    reader.start()
+    read()
+    reader.join()
+
+    # ...but not with a writer, who may read too, but not the reverse.
+    acquired = threading.Event()
+
+    def read_once():
+        with lock.shared:
+            acquired.set()
+
+    with lock:
+        reader = threading.Thread(target=read_once)
+        reader.start()
+
+        with lock, lock.shared:
+            assert not acquired.wait(0.05)
+
+    assert acquired.wait(5)
+    reader.join()
+
+    with lock.shared, pytest.raises(RuntimeError):
+        lock.acquire()
+
+    stats = {s.mode: s for s in lock.stats()}
+    assert stats['exclusive'].acquisitions == 1
+    assert stats['shared'].acquisitions == 4
+    assert stats['shared'].max_wait_us >= 50_000
+
+    # The published view of the chain needs no lock to read.
+    node = t.Node('view', chain1[0])
+    node.active_chain.extend(chain1[1:])
+    view = node.publish_chain_view()
+    assert view == t.ChainView(
+        chain1[-1].id, len(chain1) - 1,
+        node.get_block_index(chain1[-1].id).chain_work)
+
+
+def test_reorg_engine():
+    node = _node('engine', chain1)
+    node.utxo_set.clear()
+    _add_to_utxo_for_chain(node, node.active_chain)
+    utxos_before = dict(node.utxo_set)
+
+    bad_txn = Transaction(
+        txins=[TxIn(t.OutPoint('ff' * 32, 0), b'sig', b'pk', 0)],
+        txouts=[TxOut(value=1, to_address='1')])
+    bad_block = chain2[3]._replace(txns=[chain2[3].txns[0], bad_txn])
+    node.side_branches.append(chain2[1:3] + [bad_block])
+
+    # A branch which turns out invalid leaves the chain state untouched and
+    # is cut back to its last valid block.
+    assert not node.apply_reorg(node.ReorgPlan(
+        1, 0, chain1[:0:-1], node.side_branches[0]))
+    assert node.active_chain == chain1
+    assert node.utxo_set == utxos_before
+    assert node.side_branches == [chain2[1:3]]
+
+    # Reorgs don't relay the blocks they connect again.
+    sent = []
+    node.peer_hostnames.add('peer')
+    node.module.send_to_peer = lambda data, peer=None: sent.append(data)
+
+    for block in chain2[3:]:
+        assert node.connect_block(block) == 1
+
+    assert node.active_chain == chain2
+    assert node.side_branches == [chain1[1:]]
+    assert [m.header.id for m in sent] == [b.id for b in chain2[3:]]
+    assert set(node.block_undo) >= {b.id for b in chain2[1:]}
+    assert not set(node.block_undo) & {b.id for b in chain1[1:]}
+
+
+def test_node_simulator():
+    import sim_tinychain
+
+    before = (list(t.active_chain), dict(t.block_index))
+    result = sim_tinychain.simulate(
+        num_nodes=12, num_peers=3, num_blocks=8, block_interval=5,
+        latency=0.1, bandwidth=100_000, seed=1)
+
+    assert result.converged
+    assert result.blocks_mined == 8
+    assert 0 <= result.stale_blocks < 8
+    assert result.propagation_delays
+    assert min(result.propagation_delays) >= 0.1
+
+    # The nodes kept to themselves.
+    assert (t.active_chain, t.block_index) == before
+
+
+def test_node_isolation():
+    a, b = t.Node('a', chain1[0]), t.Node('b', chain1[0])
+
+    # Each node keeps a chain of its own...
+    assert a.connect_block(chain1[1]) == t.ACTIVE_CHAIN_IDX
+    assert a.active_chain == chain1[:2] and b.active_chain == [chain1[0]]
+    assert chain1[1].id in a.block_index and not b.block_index
+    assert chain1[1].id not in t.block_index
+
+    # ...and a lock of its own, so nodes don't wait on each other.
+    assert a.chain_lock is not b.chain_lock and a.metrics is not b.metrics
+    held, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with a.chain_lock:
+            held.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+
+    try:
+        assert held.wait(5)
+        assert b.connect_block(chain1[1]) == t.ACTIVE_CHAIN_IDX
+        assert holder.is_alive()
+    finally:
+        release.set()
+        holder.join()
+
+    # What passes between nodes, or out of them, is the same everywhere.
+    assert a.Block is b.Block is t.Block
+    assert a.TxnValidationError is t.TxnValidationError
+    assert a.InvMsg is not b.InvMsg
+
+
+def test_bench_suite():
+    import bench_tinychain as bench
+
+    data = bench.make_suite_data()
+    benchmarks = bench.suite_benchmarks(data)
+
+    # The synthetic block is valid atop the suite's chain.
+    node = bench.make_suite_node(data)
+    assert node.connect_block(data.block) == t.ACTIVE_CHAIN_IDX
+
+    node, block = benchmarks['try_reorg'].setup()
+    node.connect_block(block)
+    assert node.active_chain[-1] == block
+
+    for name in ('txn_id', 'mine_hash', 'read_all_from_socket'):
+        assert bench.time_benchmark(
+            benchmarks[name], min_secs=0, min_runs=1) > 0
+
+    assert bench.compare_results(
+        {'a': 1.3, 'b': 1.2, 'c': 9}, {'a': 1.0, 'b': 1.0}, 0.25) == ['a']
+
+
+def test_regtest_workload():
+    import workload_tinychain as workload
+
+    kwargs = dict(num_blocks=4, num_txns=3, fan_in=2, fan_out=2, depth=2,
+                  num_mempool=2, fork_depth=1)
+    generated = workload.generate(**kwargs)
+
+    assert t.Params is t.NETWORKS[t.NETWORK]
+    assert [len(b.txns) for b in generated.blocks] == [1, 3, 4, 4]
+    assert len(generated.mempool) == 2
+    assert len(generated.fork) == 3
+    assert workload.generate(**kwargs) == generated
+
+    # Replay it into a fresh regtest node.
+    node = t.Node(
+        'replay', t.regtest_genesis_block, params=t.RegtestParams)
+
+    for block in generated.blocks:
+        assert node.connect_block(block) == t.ACTIVE_CHAIN_IDX
+
+    assert not any(r.rejection
+                   for r in node.add_txns_to_mempool(generated.mempool))
+
+    for block in generated.fork:
+        node.connect_block(block)
+
+    assert node.active_chain[-1] == generated.fork[-1]
+    assert len(node.active_chain) == 1 + 4 - 1 + 3
+
+
+def test_metrics():
+    registry = t.MetricsRegistry()
+    sent = registry.counter('sent_total', 'Sent', labels=('type',))
+    took = registry.histogram('took_us', 'Took', buckets=(10, 100))
+    registry.gauge('things', 'Things', lambda: 3)
+
+    sent.inc('Block')
+    sent.inc('Block', amount=2)
+    took.observe(50)
+    took.observe(500)
+
+    assert t.render_prometheus(registry.collect()).splitlines() == [
+        '# HELP sent_total Sent',
+        '# TYPE sent_total counter',
+        'sent_total{type="Block"} 3',
+        '# HELP took_us Took',
+        '# TYPE took_us histogram',
+        'took_us_bucket{le="10"} 0',
+        'took_us_bucket{le="100"} 1',
+        'took_us_bucket{le="+Inf"} 2',
+        'took_us_sum 550',
+        'took_us_count 2',
+        '# HELP things Things',
+        '# TYPE things gauge',
+        'things 3',
+    ]
+
+    # Node-wide metrics come back from a GetStatsMsg intact.
+    node = _node('metrics')
+
+    def get_stats():
+        families = t.deserialize(t.serialize(node.metrics.collect()))
+        return {f.name: f for f in families}
+
+    def count(family, **labels):
+        return sum(s.value for s in family.samples
+                   if dict(map(tuple, s.labels)).items() >= {
+                       'le': '+Inf', **labels}.items())
+
+    before = get_stats()
+
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    level = t.logger.level
+    t.logger.addHandler(handler)
+    t.logger.setLevel(logging.INFO)
+
+    try:
+        for block in chain1:
+            node.connect_block(block)
+    finally:
+        t.logger.removeHandler(handler)
+        t.logger.setLevel(level)
+
+    after = get_stats()
+    connects = after['tinychain_connect_block_microseconds']
+    holds = after['tinychain_lock_hold_microseconds']
+
+    assert count(connects) - count(
+        before['tinychain_connect_block_microseconds']) == len(chain1)
+    assert count(holds, lock='chain_lock', mode='exclusive') > count(
+        before['tinychain_lock_hold_microseconds'],
+        lock='chain_lock', mode='exclusive')
+    assert after['tinychain_chain_height'].samples[0].value == 2
+    assert after['tinychain_utxo_set_size'].samples[0].value == 3
+
+    # Txouts aren't logged one by one unless debugging.
+    assert records
+    assert not [r for r in records if 'outpoint' in r.getMessage()]
+
+    server = node.start_metrics_server('127.0.0.1', 0)
+    try:
+        with urllib.request.urlopen(
+                f'http://127.0.0.1:{server.server_address[1]}/metrics') as r:
+            assert b'\ntinychain_chain_height 2\n' in r.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_profile(tmpdir, caplog):
+    node = _node('profile', chain1, PROFILE_DIR=str(tmpdir))
+    done = threading.Event()
+
+    def connect_forever():
+        while not done.is_set():
+            node.connect_block(chain1[-1])  # Already seen; returns at once.
+
+    connector = threading.Thread(target=connect_forever, name='connector')
+    connector.start()
+
+    try:
+        result = node.run_profile(0.3, trace=True)
+    finally:
+        done.set()
+        connector.join()
+
+    assert result.num_samples > 0
+    assert result.stacks_path.startswith(str(tmpdir))
+    assert node.trace_events is None  # Spans are only kept while tracing.
+
+    with open(result.stacks_path) as f:
+        stacks = [line.rsplit(' ', 1) for line in f.read().splitlines()]
+
+    assert any(stack.startswith('connector;') and 'connect_block' in stack
+               for stack, count in stacks)
+    assert sum(int(count) for _, count in stacks) >= result.num_samples
+
+    with open(result.trace_path) as f:
+        events = json.load(f)['traceEvents']
+
+    spans = [e for e in events if e['ph'] == 'X']
+    assert len(spans) == result.num_spans > 0
+    assert {e['name'] for e in spans} == {'connect_block'}
+    assert {e['tid'] for e in spans} == {connector.ident}
+    assert {'tid': connector.ident, 'args': {'name': 'connector'}}.items() \
+        <= [e for e in events if e['ph'] == 'M' and
+            e['tid'] == connector.ident][0].items()
+
+    # Only one profile runs at a time.
+    with node.profile_lock:
+        assert node.run_profile(0.01) is None
+
+    # Peers get the result once the profile's done, however long they ask
+    # for; where it's written is up to the node.
+    node.module.MAX_PROFILE_SECS = 0.1
+    replies = []
+    session = node.PeerSession('peer')
+    session.send = replies.append
+
+    node.ProfileMsg(seconds=3600).handle(session, 'peer')
+    assert not replies
+    deadline = time.time() + 5
+    while not replies:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    assert replies[0].stacks_path.startswith(str(tmpdir))
+    assert 'path' not in node.ProfileMsg._fields
+
+    # A peer which hangs up meanwhile just misses out.
+    def hung_up(result):
+        raise t.PeerUnavailableError('inbound session closed')
+
+    with caplog.at_level(logging.WARNING):
+        node.start_profile(0.01, on_done=hung_up).join()
+    assert 'dropped result: inbound session closed' in caplog.text
+
+
+def test_subscriptions():
+    node = _node('subscriptions', chain1[:1])
+    coinbases = [b.txns[0] for b in chain1]
+    watched = coinbases[1].txouts[0].to_address
+    node_sock, client_sock = socket.socketpair()
+
+    with node_sock, client_sock:
+        session = node.PeerSession('client', sock=node_sock)
+        node.handle_msg(
+            node.SubscribeMsg(addresses=[watched]), session, 'client')
+
+        for block in chain1[1:]:
+            node.connect_block(block)
+
+        # A txn paying a watched address is watched, in and out of the
+        # mempool; a txn spending from an unwatched one isn't.
+        txout = TxOut(value=901, to_address=watched)
+        txn = Transaction(txins=[make_txin(
+            signing_key, t.OutPoint(coinbases[0].id, 0), txout)],
+            txouts=[txout])
+        node.add_to_mempool(txn)
+        node.remove_from_mempool(txn.id)
+
+        node.disconnect_block(chain1[-1])
+        assert session.flush(5)
+
+        events = [t.read_all_from_socket(client_sock) for _ in range(8)]
+
+        session.disconnect()
+
+    assert events[0][:2] == (chain1[0].id, 0)  # The ChainView.
+    assert [e.seq for e in events[1:]] == list(range(1, 8))
+    assert [type(e) for e in events[1:]] == [
+        t.UTXOEvent, t.TipEvent, t.UTXOEvent, t.TipEvent,
+        t.MempoolEvent, t.MempoolEvent, t.UTXOEvent]
+
+    utxo1, tip1, utxo2, tip2, entered, left, disconnected = events[1:]
+    assert (utxo1.utxo.txid, utxo1.spent) == (coinbases[1].id, False)
+    assert (tip1.header, tip1.height) == (chain1[1]._replace(txns=[]), 1)
+    assert (utxo2.utxo.txid, utxo2.spent) == (coinbases[2].id, False)
+    assert (tip2.header.id, tip2.height) == (chain1[2].id, 2)
+    assert entered.txn == txn and (left.txid, left.txn) == (txn.id, None)
+    assert (disconnected.utxo, disconnected.spent) == (utxo2.utxo, True)
+
+    # Subscriptions go away with their sessions.
+    node.notify_tip(chain1[1], 1)
+    assert not node.subscriptions
+
+    # Subscribing waits out a chain update that's underway.
+    replies = []
+    session = node.PeerSession('client')
+    session.enqueue = replies.append
+    subscriber = threading.Thread(
+        target=node.SubscribeMsg().handle, args=(session, 'client'))
+
+    with node.chain_lock:
+        subscriber.start()
+        subscriber.join(0.2)
+        assert subscriber.is_alive() and not node.subscriptions
+
+    subscriber.join()
+    assert replies == [node.get_chain_view()]
+    assert session in node.subscriptions
+
+
+def test_wallet_service(monkeypatch):
+    import client
+
+    monkeypatch.setattr(t.Params, 'COINBASE_MATURITY', 0)  # For the client.
+    node = t.Node('wallet', t.regtest_genesis_block, params=t.RegtestParams)
+    node.module.send_to_peer = lambda data, peer=None: None
+    my_addr = t.pubkey_to_address(signing_key.get_verifying_key().to_string())
+    other_addr = t.pubkey_to_address(b'other')
+
+    def mine():
+        block = node.mine(node.assemble_block(
+            my_addr, timestamp=node.active_chain[-1].timestamp + 1))
+        assert node.connect_block(block) == t.ACTIVE_CHAIN_IDX
+        return block
+
+    def wait_for(condition):
+        deadline = time.time() + 5
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+    value = mine().txns[0].txouts[0].value
+
+    server = node.ThreadedTCPServer(('127.0.0.1', 0), node.TCPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wallet = client.WalletService(
+        signing_key, my_addr, '127.0.0.1', server.server_address[1],
+        fee=10)
+
+    try:
+        assert wallet.get_balance() == (value, value)
+
+        # Payments can go out back to back, the second spending the
+        # change from the first before it's confirmed.
+        results = wallet.send([(other_addr, 1000), (other_addr, 2000)])
+        assert [r.rejection for r in results] == [None, None]
+        assert set(node.mempool) == {r.txid for r in results}
+        assert wallet.get_balance() == (value, value - 3020)
+
+        # Payments that can't all be made hold nothing back.
+        with pytest.raises(client.InsufficientFundsError):
+            wallet.send([(other_addr, 1000), (other_addr, value)])
+        assert wallet.get_balance() == (value, value - 3020)
+
+        # Confirmations arrive as events, not a fresh download.
+        mine()
+        wait_for(lambda: not wallet.pending)
+        assert wallet.get_balance() == (2 * value - 3000,) * 2
+        assert not wallet.pending_spends and not wallet.pending_change
+
+        # Missing an event makes the wallet resync.
+        wallet.seq += 1
+        mine()
+        wait_for(lambda: wallet.stale)
+        assert wallet.get_balance() == (3 * value - 3000,) * 2
+        assert not wallet.stale and wallet.height == 3
+
+        # A payment spending coins exactly pays no change, so it's
+        # watched by txid instead.
+        [result] = wallet.send([(other_addr, value - 3030)])
+        assert len(node.mempool[result.txid].txouts) == 1
+        assert wallet.get_balance() == (3 * value - 3000, 2 * value + 20)
+        mine()
+        wait_for(lambda: not wallet.pending)
+        assert not wallet.stale
+        assert wallet.get_balance() == (3 * value + 30,) * 2
+
+        # A reply that doesn't come in time can't be taken for a later
+        # request's: we reconnect and resync instead.
+        monkeypatch.setattr(client, 'REQUEST_TIMEOUT_SECS', 0.1)
+        old_sock = wallet.sock
+        with pytest.raises(ConnectionError):
+            wallet.request(t.GetBlockTxnMsg('00' * 32, [0]))
+        assert wallet.stale and wallet.closed
+        monkeypatch.setattr(client, 'REQUEST_TIMEOUT_SECS', 5)
+        assert wallet.get_balance() == (3 * value + 30,) * 2
+        assert wallet.sock is not old_sock and not wallet.stale
+
+        # As we do when the node hangs up on us.
+        for session in list(node.subscriptions):
+            if session.connected:
+                session.sock.shutdown(socket.SHUT_RDWR)
+        wait_for(lambda: wallet.closed)
+        mine()
+        assert wallet.get_balance() == (4 * value + 30,) * 2
+    finally:
+        wallet.close()
+        server.shutdown()
+        server.server_close()
+
+
+def _node(name, chain=(), **settings):
+    """A node with `settings` in place, having connected `chain` afresh."""
+    node = t.Node(name)
+    node.active_chain.clear()
+    vars(node.module).update(settings)
+
+    for block in chain:
+        assert node.connect_block(block) == t.ACTIVE_CHAIN_IDX
+
+    return node
+
+
+def _add_to_utxo_for_chain(node, chain):
     for block in chain:
         for tx in block.txns:
             for i, txout in enumerate(tx.txouts):
-                t.add_to_utxo(txout, tx, i, tx.is_coinbase, len(chain))
+                node.add_to_utxo(txout, tx, i, tx.is_coinbase, len(chain))
 
 
 signing_key = ecdsa.SigningKey.from_string(
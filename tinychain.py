@@ -30,7 +30,8 @@ An incomplete list of unrealistic simplifications:
 - Transaction types are limited to P2PKH.
 
 - Initial Block Download eschews `getdata` and instead returns block payloads
-  directly in `inv`.
+  directly in `inv`. (New blocks and txns are announced by id and fetched
+  with `getdata`, though.)
 
 - Peer "discovery" is done through environment variable hardcoding. In
   bitcoin core, this is done with DNS seeds.
@@ -64,6 +65,19 @@ import socketserver
 import socket
 import random
 import os
+import collections
+import struct
+import asyncio
+import concurrent.futures
+import signal
+import sys
+import heapq
+import bisect
+import math
+import zlib
+import contextlib
+import types
+import http.server
 from functools import lru_cache, wraps
 from typing import (
     Iterable, NamedTuple, Dict, Mapping, Union, get_type_hints, Tuple,
@@ -124,11 +138,72 @@ class Params:
     # initial difficulty target necessary for mining a block.
     INITIAL_DIFFICULTY_BITS = 24
 
+    # Keep every block at the initial difficulty.
+    #
+    # #realname fPowNoRetargeting
+    POW_NO_RETARGETING = False
+
     # The number of blocks after which the mining subsidy will halve.
     #
     # #realname SubsidyHalvingInterval
     HALVE_SUBSIDY_AFTER_BLOCKS_NUM = 210_000
 
+    # Once the serialized txns in the mempool exceed this size, evict the
+    # lowest fee-rate txns until they don't.
+    #
+    # #realname DEFAULT_MAX_MEMPOOL_SIZE
+    MAX_MEMPOOL_SIZE_BYTES = 50 * 1000 * 1000
+
+    # Txns which have sat in the mempool this long are dropped.
+    #
+    # This is "336 hours" in bitcoin core.
+    #
+    # #realname DEFAULT_MEMPOOL_EXPIRY
+    MEMPOOL_EXPIRY_SECS = 60 * 60 * 24
+
+    # Fee rates are in Belushis per 1000 bytes of serialized txn. After an
+    # eviction, the fee rate needed to enter the mempool rises to the evicted
+    # rate plus this, then decays by half every ROLLING_FEE_HALFLIFE_SECS.
+    #
+    # #realname DEFAULT_INCREMENTAL_RELAY_FEE
+    INCREMENTAL_RELAY_FEE_RATE = 1000
+
+    # #realname ROLLING_FEE_HALFLIFE
+    ROLLING_FEE_HALFLIFE_SECS = 60 * 60 * 12
+
+    # Pruned nodes always keep the bodies and undo data of at least this many
+    # of the most recent blocks so that they're still able to reorg.
+    #
+    # This is "288" in bitcoin core.
+    MIN_BLOCKS_TO_KEEP = 12
+
+    # UTXO snapshots we're willing to bootstrap from, keyed by the id of the
+    # tip block they were taken at and mapping to the snapshot's hash.
+    #
+    # #realname m_assumeutxo_data
+    ASSUMEUTXO_SNAPSHOTS: Dict[str, str] = {}
+
+
+class RegtestParams(Params):
+    """
+    For local testing and load generation: any nonce has even odds of
+    solving a block, and coinbases can be spent in the very next block.
+
+    #realname CRegTestParams
+    """
+    COINBASE_MATURITY = 0
+
+    INITIAL_DIFFICULTY_BITS = 1
+
+    POW_NO_RETARGETING = True
+
+
+NETWORKS = {'main': Params, 'regtest': RegtestParams}
+
+# Run with the parameters (and genesis block) of this network.
+NETWORK = os.environ.get('TC_NETWORK', 'main')
+Params = NETWORKS[NETWORK]
+
 
 # Used to represent the specific output within a transaction.
 OutPoint = NamedTuple('OutPoint', [('txid', str), ('txout_idx', int)])
@@ -255,6 +330,395 @@ class Block(NamedTuple):
     def id(self) -> str: return sha256d(self.header())
 
 
+# Metrics
+# ----------------------------------------------------------------------------
+
+class MetricSample(NamedTuple):
+    labels: Iterable[Iterable[str]]  # (name, value) pairs
+    value: int
+
+
+class MetricFamily(NamedTuple):
+    """A metric's values, one per distinct set of labels."""
+    name: str
+    kind: str  # 'counter', 'gauge' or 'histogram'
+    help: str
+    samples: Iterable[MetricSample]
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help_: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # Label values -> this metric's value for them.
+
+    def _labels(self, label_values, **extra) -> Iterable[Iterable[str]]:
+        return [[k, str(v)] for k, v in (
+            *zip(self.label_names, label_values), *extra.items())]
+
+    def collect(self) -> MetricFamily:
+        with self.lock:
+            values = list(self.values.items())
+
+        return MetricFamily(self.name, self.kind, self.help, [
+            MetricSample(self._labels(label_values), value)
+            for label_values, value in sorted(values)])
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount: int = 1):
+        with self.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+
+class GaugeMetric(Metric):
+    """A value which goes up and down, either set or read from `fnc`."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_: str, fnc: Callable = None):
+        super().__init__(name, help_)
+        self.fnc = fnc
+
+    def set(self, value: int):
+        with self.lock:
+            self.values[()] = value
+
+    def collect(self) -> MetricFamily:
+        if self.fnc:
+            self.set(self.fnc())
+
+        return super().collect()
+
+
+class HistogramMetric(Metric):
+    """
+    Counts observations (durations, in microseconds, unless otherwise noted)
+    in cumulative buckets, Prometheus-style.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_: str, labels: Iterable[str] = (),
+                 buckets: Iterable[int] = (
+                     10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: int, *label_values):
+        with self.lock:
+            counts = self.values.get(label_values)
+            if not counts:
+                # Bucket counts, then the sum and count of all observations.
+                counts = self.values[label_values] = \
+                    [0] * (len(self.buckets) + 2)
+
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """Observe how long a block of code (or decorated function) takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                int((time.perf_counter() - start) * 1e6), *label_values)
+
+    def collect(self) -> MetricFamily:
+        with self.lock:
+            values = [(k, list(v)) for k, v in self.values.items()]
+
+        samples = []
+        for label_values, counts in sorted(values):
+            for le, count in zip(self.buckets, counts):
+                samples.append(MetricSample(
+                    self._labels(label_values, le=le), count))
+            samples.append(MetricSample(
+                self._labels(label_values, le='+Inf'), counts[-1]))
+            samples.append(MetricSample(
+                self._labels(label_values, stat='sum'), counts[-2]))
+            samples.append(MetricSample(
+                self._labels(label_values, stat='count'), counts[-1]))
+
+        return MetricFamily(self.name, self.kind, self.help, samples)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> CounterMetric:
+        return self.register(CounterMetric(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> GaugeMetric:
+        return self.register(GaugeMetric(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> HistogramMetric:
+        return self.register(HistogramMetric(*args, **kwargs))
+
+    def collect(self) -> Iterable[MetricFamily]:
+        return [m.collect() for m in self.metrics.values()]
+
+
+def render_prometheus(families: Iterable[MetricFamily]) -> str:
+    """
+    Format metrics in the Prometheus text exposition format. A histogram's
+    sum and count come labeled `stat="sum"` and `stat="count"`; they're
+    written out as `_sum` and `_count` series.
+    """
+    def series(name, labels, value):
+        label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+        return f'{name}{{{label_str}}} {value}' if labels else \
+            f'{name} {value}'
+
+    lines = []
+    for family in families:
+        lines.append(f'# HELP {family.name} {family.help}')
+        lines.append(f'# TYPE {family.name} {family.kind}')
+
+        for sample in family.samples:
+            labels = [tuple(label) for label in sample.labels]
+            name = family.name
+
+            if family.kind == 'histogram':
+                stats = [value for key, value in labels if key == 'stat']
+                name += f'_{stats[0]}' if stats else '_bucket'
+                labels = [(key, value) for key, value in labels
+                          if key != 'stat']
+
+            lines.append(series(name, labels, sample.value))
+
+    return '\n'.join(lines) + '\n'
+
+
+# Every metric this node keeps; see GetStatsMsg and METRICS_PORT.
+metrics = MetricsRegistry()
+
+# Serve metrics over HTTP, in the Prometheus text format, on this port.
+METRICS_PORT = int(os.environ.get('TC_METRICS_PORT', 0))
+
+
+class MetricsHTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render_prometheus(metrics.collect()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # Don't log every scrape.
+
+
+# `http.server.ThreadingHTTPServer` is 3.7+.
+class MetricsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(host: str, port: int) -> http.server.HTTPServer:
+    server = MetricsHTTPServer((host, port), MetricsHTTPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Gauges are read when metrics are collected, so these track whichever
+# node is active (see `Node`).
+metrics.gauge('tinychain_chain_height', 'Height of the active chain',
+              lambda: len(active_chain) - 1)
+metrics.gauge('tinychain_utxo_set_size', 'Unspent txouts',
+              lambda: len(utxo_set))
+metrics.gauge('tinychain_mempool_txns', 'Txns in the mempool',
+              lambda: len(mempool))
+metrics.gauge('tinychain_mempool_bytes', 'Serialized size of the mempool',
+              lambda: mempool_bytes)
+metrics.gauge('tinychain_orphan_txns', 'Txns waiting on their inputs',
+              lambda: len(orphan_txns))
+metrics.gauge('tinychain_orphan_blocks', 'Blocks waiting on their parent',
+              lambda: len(orphan_blocks))
+
+
+# Profiling
+# ----------------------------------------------------------------------------
+
+# Where profiles are written, named after when they started.
+PROFILE_DIR = os.environ.get('TC_PROFILE_DIR', '.')
+
+# How long to profile for on SIGUSR1.
+PROFILE_SECS = int(os.environ.get('TC_PROFILE_SECS', 30))
+
+# The longest profile a peer can ask for with a ProfileMsg.
+MAX_PROFILE_SECS = 300
+
+# How often to sample every thread's stack while profiling.
+PROFILE_INTERVAL_SECS = 0.005
+
+# The most spans we'll hold onto over a single profile.
+MAX_TRACE_EVENTS = 1_000_000
+
+# Spans of `traced` functions, recorded only while a profile is tracing.
+trace_events: Union[None, collections.deque] = None
+
+# Held for as long as a profile runs; there's only ever one at once.
+profile_lock = threading.Lock()
+
+
+def traced(fnc):
+    """Record a span for each call of `fnc` while a profile is tracing."""
+    @wraps(fnc)
+    def traced_fnc(*args, **kwargs):
+        if trace_events is None:
+            return fnc(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return fnc(*args, **kwargs)
+        finally:
+            events = trace_events
+            if events is not None:
+                events.append((
+                    fnc.__name__, threading.get_ident(),
+                    start, time.perf_counter()))
+
+    return traced_fnc
+
+
+def collapse_stack(thread_name: str, frame) -> str:
+    """A stack as one line of Brendan Gregg's collapsed format, root first."""
+    funcs = []
+
+    while frame:
+        code = frame.f_code
+        funcs.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:'
+                     f'{code.co_firstlineno})')
+        frame = frame.f_back
+
+    return ';'.join([thread_name, *reversed(funcs)])
+
+
+class ProfileResult(NamedTuple):
+    stacks_path: str  # Sampled stacks, collapsed, for flamegraph.pl et al.
+    trace_path: str  # Spans in the Chrome trace event format, if tracing.
+    num_samples: int
+    num_spans: int
+
+
+def run_profile(seconds: float,
+                trace: bool = False) -> Union[None, ProfileResult]:
+    """
+    Sample the stack of every thread (mining, server, validation, ...) for
+    `seconds`, and if `trace`, record spans of `traced` functions meanwhile.
+    Results are written to PROFILE_DIR once done. Returns None if a profile
+    is already running.
+    """
+    global trace_events
+
+    if not profile_lock.acquire(blocking=False):
+        logger.warning('[profile] already running a profile')
+        return None
+
+    path = os.path.join(PROFILE_DIR, time.strftime('tinychain-%Y%m%d-%H%M%S'))
+    stacks = collections.Counter()
+    num_samples = 0
+    thread_names = {}
+    me = threading.get_ident()
+    logger.info(f'[profile] profiling for {seconds}s into {path}')
+
+    try:
+        if trace:
+            trace_events = collections.deque(maxlen=MAX_TRACE_EVENTS)
+        epoch = time.perf_counter()
+
+        while time.perf_counter() - epoch < seconds:
+            thread_names.update(
+                (th.ident, th.name) for th in threading.enumerate())
+
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stacks[collapse_stack(
+                        thread_names.get(ident, str(ident)), frame)] += 1
+            num_samples += 1
+
+            time.sleep(PROFILE_INTERVAL_SECS)
+    finally:
+        events, trace_events = trace_events, None
+        # Copied in one go, as calls already underway may still append.
+        spans = list(events or ())
+        profile_lock.release()
+
+    with open(path + '.stacks', 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+
+    trace_path = None
+    if trace:
+        trace_path = path + '.trace.json'
+        write_chrome_trace(trace_path, spans, epoch, thread_names)
+
+    logger.info(f'[profile] wrote {num_samples} samples to {path}')
+    return ProfileResult(
+        path + '.stacks', trace_path, num_samples, len(spans))
+
+
+def write_chrome_trace(path: str, spans, epoch: float, thread_names):
+    """Open the file in chrome://tracing or https://ui.perfetto.dev."""
+    pid = os.getpid()
+    events = [
+        {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ident,
+         'args': {'name': name}}
+        for ident, name in thread_names.items()]
+    events.extend(
+        {'name': name, 'cat': 'tinychain', 'ph': 'X', 'pid': pid, 'tid': ident,
+         'ts': int((start - epoch) * 1e6), 'dur': int((end - start) * 1e6)}
+        for name, ident, start, end in spans)
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def start_profile(seconds: float = None, on_done: Callable = None,
+                  **kwargs) -> threading.Thread:
+    """
+    Profile in the background, e.g. from a signal handler, passing the result
+    of `run_profile()` to `on_done` (if given) once finished.
+    """
+    def profile():
+        result = run_profile(seconds or PROFILE_SECS, **kwargs)
+
+        if not on_done:
+            return
+
+        try:
+            on_done(result)
+        except Exception as e:  # E.g. the peer which asked has hung up.
+            logger.warning(
+                f'[profile] dropped result: {getattr(e, "msg", e)}')
+
+    thread = threading.Thread(target=profile, name='profiler', daemon=True)
+    thread.start()
+    return thread
+
+
 # Chain
 # ----------------------------------------------------------------------------
 
@@ -270,6 +734,11 @@ genesis_block = Block(
             value=5000000000,
             to_address='143UVyz7ooiAv1pMqbwPPpnH4BV9ifJGFF')], locktime=None)])
 
+regtest_genesis_block = genesis_block._replace(bits=1, nonce=4)
+
+if NETWORK == 'regtest':
+    genesis_block = regtest_genesis_block
+
 # The highest proof-of-work, valid blockchain.
 #
 # #realname chainActive
@@ -278,8 +747,140 @@ active_chain: Iterable[Block] = [genesis_block]
 # Branches off of the main chain.
 side_branches: Iterable[Iterable[Block]] = []
 
-# Synchronize access to the active chain and side branches.
-chain_lock = threading.RLock()
+
+class LockStats(NamedTuple):
+    mode: str  # 'exclusive' or 'shared'
+    acquisitions: int
+    total_wait_us: int
+    max_wait_us: int
+
+
+lock_wait_us = metrics.histogram(
+    'tinychain_lock_wait_microseconds', 'Time spent waiting to take a lock',
+    labels=('lock', 'mode'))
+lock_hold_us = metrics.histogram(
+    'tinychain_lock_hold_microseconds', 'Time a lock was held for',
+    labels=('lock', 'mode'))
+
+
+class RWLock:
+    """
+    A lock which any number of readers may hold at once, or one writer.
+
+    `with lock:` takes it exclusively (and reentrantly); `with lock.shared:`
+    takes it for reading. A writer may also read, but a reader can't go on
+    to write. Waiting writers hold off new readers so they aren't starved,
+    though a thread already reading may always read more.
+
+    Time spent waiting for the lock is tallied by mode; see `stats()`. Wait
+    and hold times also go into the `lock_wait_us` and `lock_hold_us`
+    metrics, labeled with the lock's name.
+    """
+
+    def __init__(self, name: str = 'rwlock'):
+        self.name = name
+        self.cond = threading.Condition(threading.Lock())
+        self.writer = None
+        self.write_depth = 0
+        self.write_since = 0.
+        self.waiting_writers = 0
+        self.readers: Dict[int, int] = {}  # Thread id -> hold depth.
+        self.read_since: Dict[int, float] = {}
+        self.shared = _SharedLock(self)
+        self.wait_stats = {
+            mode: LockStats(mode, 0, 0, 0) for mode in ('exclusive', 'shared')}
+
+    def _record_wait(self, mode: str, waited_secs: float):
+        wait_us = int(waited_secs * 1e6)
+        s = self.wait_stats[mode]
+        self.wait_stats[mode] = s._replace(
+            acquisitions=s.acquisitions + 1,
+            total_wait_us=s.total_wait_us + wait_us,
+            max_wait_us=max(s.max_wait_us, wait_us))
+        lock_wait_us.observe(wait_us, self.name, mode)
+
+    def _record_hold(self, mode: str, since: float):
+        lock_hold_us.observe(
+            int((time.perf_counter() - since) * 1e6), self.name, mode)
+
+    def acquire(self):
+        me = threading.get_ident()
+
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+                return
+            elif me in self.readers:
+                raise RuntimeError("can't upgrade a shared hold to exclusive")
+
+            start = time.perf_counter()
+            self.waiting_writers += 1
+
+            try:
+                self.cond.wait_for(
+                    lambda: self.writer is None and not self.readers)
+            finally:
+                self.waiting_writers -= 1
+
+            self.writer, self.write_depth = me, 1
+            self.write_since = time.perf_counter()
+            self._record_wait('exclusive', self.write_since - start)
+
+    def release(self):
+        with self.cond:
+            self.write_depth -= 1
+
+            if not self.write_depth:
+                self.writer = None
+                self.cond.notify_all()
+                self._record_hold('exclusive', self.write_since)
+
+    def acquire_shared(self):
+        me = threading.get_ident()
+
+        with self.cond:
+            if self.writer != me and me not in self.readers:
+                start = time.perf_counter()
+                self.cond.wait_for(
+                    lambda: self.writer is None and not self.waiting_writers)
+                self._record_wait('shared', time.perf_counter() - start)
+
+            if me not in self.readers:
+                self.read_since[me] = time.perf_counter()
+
+            self.readers[me] = self.readers.get(me, 0) + 1
+
+    def release_shared(self):
+        me = threading.get_ident()
+
+        with self.cond:
+            self.readers[me] -= 1
+
+            if not self.readers[me]:
+                del self.readers[me]
+                self.cond.notify_all()
+                self._record_hold('shared', self.read_since.pop(me))
+
+    def stats(self) -> Iterable[LockStats]:
+        with self.cond:
+            return list(self.wait_stats.values())
+
+    def __enter__(self): self.acquire()
+
+    def __exit__(self, *args): self.release()
+
+
+class _SharedLock:
+    def __init__(self, rwlock: RWLock): self.rwlock = rwlock
+
+    def __enter__(self): self.rwlock.acquire_shared()
+
+    def __exit__(self, *args): self.rwlock.release_shared()
+
+
+# Synchronize access to the active chain and side branches. Only changes to
+# chain state take this exclusively; queries take `chain_lock.shared`.
+chain_lock = RWLock('chain_lock')
 
 
 def with_lock(lock):
@@ -294,22 +895,28 @@ def with_lock(lock):
 
 orphan_blocks: Iterable[Block] = []
 
+# The UTXOs spent by each block in the active chain, used to undo the block
+# during a reorg.
+#
+# #realname CBlockUndo
+block_undo: Dict[str, Iterable[UnspentTxOut]] = {}
+
 # Used to signify the active chain in `locate_block`.
 ACTIVE_CHAIN_IDX = 0
 
 
-@with_lock(chain_lock)
+@with_lock(chain_lock.shared)
 def get_current_height(): return len(active_chain)
 
 
-@with_lock(chain_lock)
+@with_lock(chain_lock.shared)
 def txn_iterator(chain):
     return (
         (txn, block, height)
         for height, block in enumerate(chain) for txn in block.txns)
 
 
-@with_lock(chain_lock)
+@with_lock(chain_lock.shared)
 def locate_block(block_hash: str, chain=None) -> (Block, int, int):
     chains = [chain] if chain else [active_chain, *side_branches]
 
@@ -320,15 +927,143 @@ def locate_block(block_hash: str, chain=None) -> (Block, int, int):
     return (None, None, None)
 
 
+# The number of blocks whose timestamps median-time-past is taken over.
+#
+# #realname nMedianTimeSpan
+MEDIAN_TIME_SPAN = 11
+
+
+class BlockIndex(NamedTuple):
+    """
+    Metadata derived from a block and its ancestors, computed once when the
+    block connects so that consensus checks needn't walk the chain.
+
+    #realname CBlockIndex
+    """
+    height: int
+    bits: int
+
+    # The total work (2 ** bits per block) of this block and its ancestors.
+    chain_work: int
+
+    # Timestamps of this block and up to `MEDIAN_TIME_SPAN - 1` ancestors,
+    # newest first.
+    recent_timestamps: Tuple[int, ...]
+
+    # The timestamp of the block which began this block's difficulty period.
+    period_start_timestamp: int
+
+    @property
+    def median_time_past(self) -> int:
+        return self.recent_timestamps[len(self.recent_timestamps) // 2]
+
+
+# Derived metadata for every block we've connected, keyed by block id.
+block_index: Dict[str, BlockIndex] = {}
+
+
+def index_block(block: Block) -> BlockIndex:
+    prev = get_block_index(block.prev_block_hash)
+    height = prev.height + 1 if prev else 0
+
+    block_index[block.id] = entry = BlockIndex(
+        height=height,
+        bits=block.bits,
+        chain_work=(prev.chain_work if prev else 0) + 2 ** block.bits,
+        recent_timestamps=(
+            block.timestamp,
+            *(prev.recent_timestamps if prev else ()))[:MEDIAN_TIME_SPAN],
+        period_start_timestamp=(
+            block.timestamp
+            if height % Params.DIFFICULTY_PERIOD_IN_BLOCKS == 0
+            else prev.period_start_timestamp),
+    )
+    return entry
+
+
+def get_block_index(block_hash: str) -> Union[None, BlockIndex]:
+    """Look up a block's metadata, indexing it first if we must."""
+    if not block_hash:
+        return None
+    elif block_hash in block_index:
+        return block_index[block_hash]
+
+    # Gather the block and whichever of its ancestors are unindexed (which
+    # is all of them on a chain that was set up wholesale), then index them
+    # oldest first; this would otherwise recurse once per ancestor.
+    unindexed = []
+
+    while block_hash and block_hash not in block_index:
+        block, height, chain_idx = locate_block(block_hash)
+        if not block:
+            break
+
+        chain = (active_chain if chain_idx == ACTIVE_CHAIN_IDX else
+                 side_branches[chain_idx - 1])
+
+        # Ancestors mostly sit right before a block in its chain, so walk
+        # back through it rather than searching for each one.
+        while True:
+            unindexed.append(block)
+            block_hash = block.prev_block_hash
+
+            if height == 0 or block_hash in block_index or \
+                    chain[height - 1].id != block_hash:
+                break
+
+            height -= 1
+            block = chain[height]
+
+    entry = None
+    for block in reversed(unindexed):
+        entry = index_block(block)
+
+    return entry
+
+
+class ChainView(NamedTuple):
+    """
+    A summary of the active chain, republished whenever its tip changes so
+    that it can be read without taking `chain_lock` at all.
+    """
+    tip_id: str
+    height: int
+    chain_work: int
+
+
+# The latest `ChainView`; unannotated, as it's rebound under `global`.
+chain_view = None
+
+
+def publish_chain_view() -> ChainView:
+    global chain_view
+
+    old_view = chain_view
+    tip = active_chain[-1]
+    index = get_block_index(tip.id)
+    chain_view = ChainView(
+        tip.id, len(active_chain) - 1, index.chain_work if index else 0)
+
+    if not old_view or old_view.tip_id != chain_view.tip_id:
+        notify_tip(tip, chain_view.height)
+
+    return chain_view
+
+
+def get_chain_view() -> ChainView: return chain_view or publish_chain_view()
+
+
+connect_block_us = metrics.histogram(
+    'tinychain_connect_block_microseconds',
+    'Time to connect a block, once holding chain_lock')
+
+
+@traced
 @with_lock(chain_lock)
-def connect_block(block: Union[str, Block],
-                  doing_reorg=False,
-                  ) -> Union[None, Block]:
+@connect_block_us.time()
+def connect_block(block: Union[str, Block]) -> Union[None, Block]:
     """Accept a block and return the chain index we append it to."""
-    # Only exit early on already seen in active_chain when reorging.
-    search_chain = active_chain if doing_reorg else None
-
-    if locate_block(block.id, chain=search_chain)[0]:
+    if locate_block(block.id)[0]:
         logger.debug(f'ignore block already seen: {block.id}')
         return None
 
@@ -339,8 +1074,14 @@ def connect_block(block: Union[str, Block],
         if e.to_orphan:
             logger.info(f"saw orphan block {block.id}")
             orphan_blocks.append(e.to_orphan)
+        elif e.bad_header:
+            # Only the header is covered by the id; a bad body may just be
+            # a mangled copy of a good block, so don't rule that one out.
+            recently_seen.add(block.id)
         return None
 
+    recently_seen.add(block.id)
+
     # If `validate_block()` returned a non-existent chain index, we're
     # creating a new side branch.
     if chain_idx != ACTIVE_CHAIN_IDX and len(side_branches) < chain_idx:
@@ -353,27 +1094,35 @@ def connect_block(block: Union[str, Block],
     chain = (active_chain if chain_idx == ACTIVE_CHAIN_IDX else
              side_branches[chain_idx - 1])
     chain.append(block)
+    index_block(block)
 
     # If we added to the active chain, perform upkeep on utxo_set and mempool.
     if chain_idx == ACTIVE_CHAIN_IDX:
+        spent = []
+
         for tx in block.txns:
-            mempool.pop(tx.id, None)
+            remove_from_mempool(tx.id)
+            evict_mempool_conflicts(tx)
 
             if not tx.is_coinbase:
                 for txin in tx.txins:
+                    spent.append(utxo_set[txin.to_spend])
                     rm_from_utxo(*txin.to_spend)
             for i, txout in enumerate(tx.txouts):
                 add_to_utxo(txout, tx, i, tx.is_coinbase, len(chain))
 
-    if (not doing_reorg and reorg_if_necessary()) or \
-            chain_idx == ACTIVE_CHAIN_IDX:
+        block_undo[block.id] = spent
+
+    if reorg_if_necessary() or chain_idx == ACTIVE_CHAIN_IDX:
         mine_interrupt.set()
+        recent_rejects.reset()
         logger.info(
             f'block accepted '
             f'height={len(active_chain) - 1} txns={len(block.txns)}')
 
-    for peer in peer_hostnames:
-        send_to_peer(block, peer)
+    prune_block_bodies()
+    publish_chain_view()
+    relay_block(block)
 
     return chain_idx
 
@@ -383,15 +1132,33 @@ def disconnect_block(block, chain=None):
     chain = chain or active_chain
     assert block == chain[-1], "Block being disconnected must be tip."
 
-    for tx in block.txns:
-        mempool[tx.id] = tx
+    undo = block_undo.pop(block.id, None)
+    utxo_changes = []
 
+    for tx in block.txns:
         # Restore UTXO set to what it was before this block.
-        for txin in tx.txins:
-            if txin.to_spend:  # Account for degenerate coinbase txins.
-                add_to_utxo(*find_txout_for_txin(txin, chain))
+        if undo is None:
+            for txin in tx.txins:
+                if txin.to_spend:  # Account for degenerate coinbase txins.
+                    add_to_utxo(*find_txout_for_txin(txin, chain))
         for i in range(len(tx.txouts)):
-            rm_from_utxo(tx.id, i)
+            utxo_changes.append(
+                (utxo_set.pop(OutPoint(tx.id, i), None), None))
+
+    # Outputs created and spent within this block stay gone.
+    created_in_block = {tx.id for tx in block.txns}
+
+    for utxo in (undo or []):
+        if utxo.txid not in created_in_block:
+            utxo_set[utxo.outpoint] = utxo
+            utxo_changes.append((None, utxo))
+
+    notify_utxo_changes(utxo_changes)
+
+    # Now that its inputs are back, return the block's txns to the mempool.
+    for tx in block.txns:
+        if not tx.is_coinbase:
+            add_to_mempool(tx)
 
     logger.info(f'block {block.id} disconnected')
     return chain.pop()
@@ -408,12 +1175,17 @@ def find_txout_for_txin(txin, chain):
 
 @with_lock(chain_lock)
 def reorg_if_necessary() -> bool:
+    global side_branches
+
     reorged = False
     frozen_side_branches = list(side_branches)  # May change during this call.
 
     # TODO should probably be using `chainwork` for the basis of
     # comparison here.
     for branch_idx, chain in enumerate(frozen_side_branches, 1):
+        if not chain:
+            continue
+
         fork_block, fork_idx, _ = locate_block(
             chain[0].prev_block_hash, active_chain)
         active_height = len(active_chain)
@@ -425,77 +1197,295 @@ def reorg_if_necessary() -> bool:
                 f'new height of {branch_height} (vs. {active_height})')
             reorged |= try_reorg(chain, branch_idx, fork_idx)
 
+    # Failed reorgs may have emptied out their branch.
+    side_branches = [b for b in side_branches if b]
+
     return reorged
 
 
-@with_lock(chain_lock)
-def try_reorg(branch, branch_idx, fork_idx) -> bool:
-    # Use the global keyword so that we can actually swap out the reference
-    # in case of a reorg.
-    global active_chain
-    global side_branches
+class ReorgPlan(NamedTuple):
+    """What switching the active chain over to a side branch involves."""
+    branch_idx: int
 
-    fork_block = active_chain[fork_idx]
+    # The height of the last block the active chain and branch share.
+    fork_height: int
 
-    def disconnect_to_fork():
-        while active_chain[-1].id != fork_block.id:
-            yield disconnect_block(active_chain[-1])
+    # Active chain blocks to undo, tip first.
+    disconnect: Iterable[Block]
 
-    old_active = list(disconnect_to_fork())[::-1]
+    # Branch blocks to apply, oldest first.
+    connect: Iterable[Block]
 
-    assert branch[0].prev_block_hash == active_chain[-1].id
 
-    def rollback_reorg():
-        logger.info(f'reorg of idx {branch_idx} to active_chain failed')
-        list(disconnect_to_fork())  # Force the gneerator to eval.
+class UTXOView:
+    """
+    Changes to a UTXO set which are held aside until `commit()`, so that a
+    whole reorg can be tried out and then applied (or not) at once.
 
-        for block in old_active:
-            assert connect_block(block, doing_reorg=True) == ACTIVE_CHAIN_IDX
+    #realname CCoinsViewCache
+    """
 
-    for block in branch:
-        connected_idx = connect_block(block, doing_reorg=True)
-        if connected_idx != ACTIVE_CHAIN_IDX:
-            rollback_reorg()
-            return False
+    def __init__(self, base: Dict[OutPoint, UnspentTxOut]):
+        self.base = base
 
-    # Fix up side branches: remove new active, add old active.
-    side_branches.pop(branch_idx - 1)
-    side_branches.append(old_active)
+        # None marks a spent outpoint.
+        self.changes: Dict[OutPoint, Union[UnspentTxOut, None]] = {}
 
-    logger.info(
-        'chain reorg! New height: %s, tip: %s',
-        len(active_chain), active_chain[-1].id)
+    def get(self, outpoint: OutPoint, default=None) -> UnspentTxOut:
+        utxo = (self.changes[outpoint] if outpoint in self.changes else
+                self.base.get(outpoint))
+        return default if utxo is None else utxo
 
-    return True
+    def add(self, utxo: UnspentTxOut):
+        self.changes[utxo.outpoint] = utxo
 
+    def spend(self, outpoint: OutPoint) -> UnspentTxOut:
+        utxo = self.get(outpoint)
+        self.changes[outpoint] = None
+        return utxo
 
-def get_median_time_past(num_last_blocks: int) -> int:
-    """Grep for: GetMedianTimePast."""
-    last_n_blocks = active_chain[::-1][:num_last_blocks]
+    def commit(self) -> Iterable[Tuple[UnspentTxOut, UnspentTxOut]]:
+        """Apply the changes to the base, returning each (old, new) UTXO."""
+        committed = []
 
-    if not last_n_blocks:
-        return 0
+        for outpoint, utxo in self.changes.items():
+            committed.append((self.base.get(outpoint), utxo))
 
-    return last_n_blocks[len(last_n_blocks) // 2].timestamp
+            if utxo is None:
+                self.base.pop(outpoint, None)
+            else:
+                self.base[outpoint] = utxo
 
+        self.changes = {}
+        return committed
 
-# UTXO set
-# ----------------------------------------------------------------------------
 
-utxo_set: Mapping[OutPoint, UnspentTxOut] = {}
+@with_lock(chain_lock)
+def try_reorg(branch, branch_idx, fork_idx) -> bool:
+    return apply_reorg(ReorgPlan(
+        branch_idx, fork_idx, active_chain[fork_idx + 1:][::-1], list(branch)))
 
 
-def add_to_utxo(txout, tx, idx, is_coinbase, height):
-    utxo = UnspentTxOut(
-        *txout,
-        txid=tx.id, txout_idx=idx, is_coinbase=is_coinbase, height=height)
+@with_lock(chain_lock)
+def apply_reorg(plan: ReorgPlan) -> bool:
+    """
+    Swap the active chain for a side branch. The UTXO changes of the whole
+    reorg are staged in a view and only committed, along with the chain and
+    mempool, once every branch block has checked out; nothing needs to be
+    rolled back on failure.
 
-    logger.info(f'adding tx outpoint {utxo.outpoint} to utxo_set')
-    utxo_set[utxo.outpoint] = utxo
+    Branch blocks passed their context-free checks when they joined the
+    branch and were relayed then, so neither is repeated here.
+
+    #realname ActivateBestChainStep
+    """
+    view = UTXOView(utxo_set)
+
+    for block in plan.disconnect:
+        if not block.txns:
+            logger.info(f"can't reorg past pruned block {block.id}")
+            return False
+
+        undo_block_in_view(block, view)
+
+    new_undo = {}
+
+    for i, block in enumerate(plan.connect):
+        height = plan.fork_height + 1 + i
+
+        try:
+            new_undo[block.id] = apply_block_to_view(block, height, view)
+        except BlockValidationError as e:
+            logger.info(
+                f'reorg of idx {plan.branch_idx} to active_chain failed; '
+                f'block {block.id} is invalid: {e.msg}')
+
+            # Nothing built atop an invalid block is worth keeping.
+            del side_branches[plan.branch_idx - 1][i:]
+            return False
+
+    old_active = plan.disconnect[::-1]
+
+    notify_utxo_changes(view.commit())
+    active_chain[plan.fork_height + 1:] = plan.connect
+    side_branches[plan.branch_idx - 1] = old_active
+
+    for block in plan.disconnect:
+        block_undo.pop(block.id, None)
+    block_undo.update(new_undo)
+
+    # Return txns the new chain doesn't include to the mempool (parents
+    # first), then clear out those it does and anything conflicting.
+    connected_txids = {tx.id for block in plan.connect for tx in block.txns}
+
+    for block in old_active:
+        for tx in block.txns[1:]:
+            if tx.id not in connected_txids:
+                add_to_mempool(tx)
+
+    for block in plan.connect:
+        for tx in block.txns:
+            remove_from_mempool(tx.id)
+            evict_mempool_conflicts(tx)
+
+    logger.info(
+        'chain reorg! New height: %s, tip: %s',
+        len(active_chain), active_chain[-1].id)
+
+    return True
+
+
+def undo_block_in_view(block: Block, view: UTXOView):
+    """Stage undoing an active chain block's changes to the UTXO set."""
+    undo = block_undo.get(block.id)
+
+    for tx in block.txns:
+        for i in range(len(tx.txouts)):
+            view.spend(OutPoint(tx.id, i))
+
+        if undo is None:
+            for txin in tx.txins:
+                if txin.to_spend:  # Account for degenerate coinbase txins.
+                    txout, src_tx, idx, is_coinbase, height = \
+                        find_txout_for_txin(txin, active_chain)
+                    view.add(UnspentTxOut(
+                        *txout, txid=src_tx.id, txout_idx=idx,
+                        is_coinbase=is_coinbase, height=height))
+
+    # Outputs created and spent within this block stay gone.
+    created_in_block = {tx.id for tx in block.txns}
+
+    for utxo in (undo or []):
+        if utxo.txid not in created_in_block:
+            view.add(utxo)
+
+
+def apply_block_to_view(block: Block, height: int,
+                        view: UTXOView) -> Iterable[UnspentTxOut]:
+    """
+    Check a branch block's txns against the UTXO view as of its parent and
+    stage its changes, returning its undo data.
+    """
+    if get_next_work_required(block.prev_block_hash) != block.bits:
+        raise BlockValidationError('bits is incorrect', bad_header=True)
+
+    for txn in block.txns[1:]:
+        try:
+            validate_txn(txn, siblings_in_block=block.txns[1:],
+                         allow_utxo_from_mempool=False,
+                         utxos=view, spend_height=height)
+        except TxnValidationError as e:
+            raise BlockValidationError(f'{txn.id} failed to validate: {e.msg}')
+
+    spent = []
+
+    for tx in block.txns:
+        for txin in (tx.txins if not tx.is_coinbase else []):
+            utxo = view.spend(txin.to_spend)
+
+            if not utxo:
+                raise BlockValidationError(f'{txin.to_spend} spent twice')
+            spent.append(utxo)
+
+        # Like `connect_block()`, record the chain's length with this block.
+        for i, txout in enumerate(tx.txouts):
+            view.add(UnspentTxOut(
+                *txout, txid=tx.id, txout_idx=i,
+                is_coinbase=tx.is_coinbase, height=height + 1))
+
+    return spent
+
+
+def get_median_time_past(num_last_blocks: int) -> int:
+    """Grep for: GetMedianTimePast."""
+    last_n_blocks = active_chain[-num_last_blocks:][::-1] \
+        if num_last_blocks else []
+
+    if not last_n_blocks:
+        return 0
+
+    return last_n_blocks[len(last_n_blocks) // 2].timestamp
+
+
+# UTXO set
+# ----------------------------------------------------------------------------
+
+class UTXOSet(dict):
+    """
+    UTXOs by outpoint, with the outpoints also kept in order (overall and per
+    address) so that a page of them is found without scanning the set.
+
+    Only `[]=`, `del`, `pop()` and `clear()` are to be used for changes, as
+    they keep the order up to date.
+    """
+
+    def __init__(self, utxos: Iterable[UnspentTxOut] = ()):
+        super().__init__()
+        self.outpoints = []
+        self.by_address = collections.defaultdict(list)
+
+        for utxo in utxos:
+            self[utxo.outpoint] = utxo
+
+    def __setitem__(self, outpoint: OutPoint, utxo: UnspentTxOut):
+        if outpoint in self:
+            self._unindex(self[outpoint])
+
+        super().__setitem__(outpoint, utxo)
+        bisect.insort(self.outpoints, outpoint)
+        bisect.insort(self.by_address[utxo.to_address], outpoint)
+
+    def __delitem__(self, outpoint: OutPoint):
+        self._unindex(self[outpoint])
+        super().__delitem__(outpoint)
+
+    def _unindex(self, utxo: UnspentTxOut):
+        by_address = self.by_address[utxo.to_address]
+
+        for outpoints in (self.outpoints, by_address):
+            del outpoints[bisect.bisect_left(outpoints, utxo.outpoint)]
+
+        if not by_address:
+            del self.by_address[utxo.to_address]
+
+    def pop(self, outpoint: OutPoint, *default) -> UnspentTxOut:
+        if outpoint not in self:
+            return super().pop(outpoint, *default)
+
+        utxo = self[outpoint]
+        del self[outpoint]
+        return utxo
+
+    def clear(self):
+        super().clear()
+        self.outpoints.clear()
+        self.by_address.clear()
+
+    def page(self, after: Union[OutPoint, None], limit: int,
+             to_address: str = None) -> Iterable[UnspentTxOut]:
+        """Up to `limit` UTXOs, in outpoint order, from just past `after`."""
+        outpoints = (self.outpoints if to_address is None else
+                     self.by_address.get(to_address, []))
+        start = 0 if after is None else bisect.bisect_right(outpoints, after)
+        return [self[op] for op in outpoints[start:start + limit]]
+
+
+utxo_set: Mapping[OutPoint, UnspentTxOut] = UTXOSet()
+
+
+def add_to_utxo(txout, tx, idx, is_coinbase, height):
+    utxo = UnspentTxOut(
+        *txout,
+        txid=tx.id, txout_idx=idx, is_coinbase=is_coinbase, height=height)
+
+    logger.debug('adding tx outpoint %s to utxo_set', utxo.outpoint)
+    utxo_set[utxo.outpoint] = utxo
+    notify_utxo_changes([(None, utxo)])
 
 
 def rm_from_utxo(txid, txout_idx):
-    del utxo_set[OutPoint(txid, txout_idx)]
+    utxo = utxo_set.pop(OutPoint(txid, txout_idx))
+    notify_utxo_changes([(utxo, None)])
 
 
 def find_utxo_in_list(txin, txns) -> UnspentTxOut:
@@ -509,6 +1499,252 @@ def find_utxo_in_list(txin, txns) -> UnspentTxOut:
         *txout, txid=txid, is_coinbase=False, height=-1, txout_idx=txout_idx)
 
 
+# UTXO snapshots
+# ----------------------------------------------------------------------------
+
+# Load a snapshot from this path at startup instead of replaying the chain.
+UTXO_SNAPSHOT_PATH = os.environ.get('TC_UTXO_SNAPSHOT')
+
+# Set once the history underneath a loaded snapshot has been checked.
+snapshot_verified = threading.Event()
+
+
+class UTXOSnapshot(NamedTuple):
+    # The active chain the snapshot was taken at, stripped of block bodies.
+    headers: Iterable[Block]
+
+    # The UTXO set at the tip of `headers`, sorted by outpoint.
+    utxos: Iterable[UnspentTxOut]
+
+    @property
+    def base_block_id(self) -> str: return self.headers[-1].id
+
+
+@with_lock(chain_lock.shared)
+def make_utxo_snapshot() -> UTXOSnapshot:
+    return UTXOSnapshot(
+        headers=[b._replace(txns=[]) for b in active_chain],
+        utxos=sorted(utxo_set.values(), key=lambda u: u.outpoint))
+
+
+def dump_utxo_snapshot(snapshot: UTXOSnapshot, path) -> str:
+    """Write a snapshot to disk and return the hash it should be trusted by."""
+    serialized = serialize(snapshot).encode()
+
+    with open(path, 'wb') as f:
+        f.write(zlib.compress(serialized))
+
+    return sha256d(serialized)
+
+
+@with_lock(chain_lock)
+def load_utxo_snapshot(path) -> UTXOSnapshot:
+    """
+    Replace the active chain and UTXO set with the contents of a snapshot,
+    so long as its hash matches one configured in `Params`. Only headers
+    are available beneath the snapshot's tip until the history underneath
+    it has been downloaded with `verify_snapshot_history()`.
+    """
+    global active_chain, side_branches, utxo_set, pruned_height
+
+    with open(path, 'rb') as f:
+        serialized = zlib.decompress(f.read())
+
+    snapshot = deserialize(serialized.decode())
+    expected_hash = Params.ASSUMEUTXO_SNAPSHOTS.get(snapshot.base_block_id)
+
+    if sha256d(serialized) != expected_hash:
+        raise UTXOSnapshotError(
+            f'snapshot at {snapshot.base_block_id} has unrecognized hash')
+
+    prev_block_hash = None
+    for block in snapshot.headers:
+        if block.prev_block_hash != prev_block_hash:
+            raise UTXOSnapshotError(f'header {block.id} does not connect')
+        if int(block.id, 16) > (1 << (256 - block.bits)):
+            raise UTXOSnapshotError(f"header {block.id} doesn't satisfy bits")
+        prev_block_hash = block.id
+
+    active_chain = list(snapshot.headers)
+    side_branches = []
+    utxo_set = UTXOSet(snapshot.utxos)
+
+    for block in active_chain:
+        index_block(block)
+
+    pruned_height = len(active_chain)
+    publish_chain_view()
+    snapshot_verified.clear()
+
+    logger.info(
+        f'loaded UTXO snapshot with {len(utxo_set)} UTXOs at height '
+        f'{len(active_chain) - 1} ({snapshot.base_block_id})')
+
+    return snapshot
+
+
+def verify_snapshot_history(snapshot: UTXOSnapshot, history) -> bool:
+    """
+    Replay the full blocks leading up to a snapshot's base and check they
+    produce exactly the snapshot's UTXO set, filling in the missing block
+    bodies on the active chain as we go (unless we're pruning).
+
+    `history` is consumed lazily, so it may be streamed from a peer.
+    """
+    global pruned_height
+    headers = snapshot.headers
+    backfill = not (PRUNE_DEPTH or PRUNE_TARGET_BYTES)
+    utxos = {}
+    num_replayed = 0
+
+    for height, block in enumerate(history, 1):
+        if height > len(headers):
+            break
+        elif block.id != headers[height - 1].id:
+            logger.error(f'history diverges from snapshot at {block.id}')
+            return False
+        elif not block.txns:
+            logger.error(f'history is missing the body of {block.id}')
+            return False
+        elif get_merkle_root_of_txns(block.txns).val != block.merkle_hash:
+            logger.error(f'block {block.id} has an invalid merkle root')
+            return False
+
+        for tx in block.txns:
+            for txin in (tx.txins if not tx.is_coinbase else []):
+                utxo = utxos.pop(txin.to_spend, None)
+                try:
+                    if not utxo:
+                        raise TxUnlockError('Spends a nonexistent UTXO')
+                    validate_signature_for_spend(txin, utxo, tx)
+                except TxUnlockError:
+                    logger.error(f'txn {tx.id} in history is an invalid spend')
+                    return False
+
+            for i, txout in enumerate(tx.txouts):
+                utxo = UnspentTxOut(
+                    *txout, txid=tx.id, txout_idx=i,
+                    is_coinbase=tx.is_coinbase, height=height)
+                utxos[utxo.outpoint] = utxo
+
+        # The body matches a header we already trust, so it's safe to keep
+        # regardless of how the rest of the replay goes.
+        with chain_lock:
+            if backfill and active_chain[height - 1].id == block.id:
+                active_chain[height - 1] = block
+
+        num_replayed = height
+
+    if num_replayed != len(headers):
+        logger.error('history ends before the snapshot base')
+        return False
+
+    if utxos != {u.outpoint: u for u in snapshot.utxos}:
+        logger.error('replayed history does not produce the snapshot UTXOs')
+        return False
+
+    with chain_lock:
+        if backfill:
+            pruned_height = 0
+
+    logger.info(f'verified history beneath snapshot {snapshot.base_block_id}')
+    snapshot_verified.set()
+    return True
+
+
+def verify_snapshot_from_peer(snapshot: UTXOSnapshot, peer=None):
+    """Stream the history beneath a snapshot from a peer and check it."""
+    peer = peer or random.choice(list(peer_hostnames))
+    history = request_stream_from_peer(
+        GetBlockRangeMsg(0, len(snapshot.headers)), peer)
+
+    try:
+        verified = verify_snapshot_history(snapshot, history)
+    except Exception:
+        logger.exception(f'failed to fetch snapshot history from {peer}')
+        return
+
+    if not verified:
+        logger.critical(
+            f'UTXO snapshot {snapshot.base_block_id} is NOT backed by the '
+            f'history served by {peer}; do not trust this node')
+
+
+# Pruning
+# ----------------------------------------------------------------------------
+
+# Keep block bodies for only this many of the most recent blocks (0 disables).
+PRUNE_DEPTH = int(os.environ.get('TC_PRUNE_DEPTH', 0))
+
+# Keep at most this many bytes of block bodies (0 disables).
+PRUNE_TARGET_BYTES = int(os.environ.get('TC_PRUNE_TARGET_BYTES', 0))
+
+# Blocks in the active chain beneath this height have had their bodies
+# dropped (or never had them, in the case of a UTXO snapshot) and can't be
+# served to peers.
+pruned_height = 0
+
+
+# Serialized sizes of retained block bodies, used with PRUNE_TARGET_BYTES.
+body_sizes: Dict[str, int] = {}
+
+
+def get_body_size(block: Block) -> int:
+    if block.id not in body_sizes:
+        body_sizes[block.id] = len(serialize(block))
+    return body_sizes[block.id]
+
+
+@with_lock(chain_lock)
+def prune_block_bodies() -> int:
+    """
+    Replace the bodies of active chain blocks which have fallen out of the
+    pruning window with empty txn lists and drop their undo data. Headers,
+    `block_index`, and `utxo_set` are left untouched.
+
+    #realname FindFilesToPrune
+    """
+    global pruned_height
+
+    if not (PRUNE_DEPTH or PRUNE_TARGET_BYTES):
+        return pruned_height
+
+    keep_from = len(active_chain) - Params.MIN_BLOCKS_TO_KEEP
+    prune_to = pruned_height
+
+    if PRUNE_DEPTH:
+        prune_to = max(prune_to, len(active_chain) - PRUNE_DEPTH)
+
+    if PRUNE_TARGET_BYTES:
+        retained_bytes = sum(
+            get_body_size(b) for b in active_chain[prune_to:])
+
+        while retained_bytes > PRUNE_TARGET_BYTES and prune_to < keep_from:
+            retained_bytes -= get_body_size(active_chain[prune_to])
+            prune_to += 1
+
+    prune_to = min(prune_to, keep_from)
+
+    for height in range(pruned_height, prune_to):
+        block = active_chain[height]
+        active_chain[height] = block._replace(txns=[])
+        block_undo.pop(block.id, None)
+        body_sizes.pop(block.id, None)
+
+    if prune_to > pruned_height:
+        logger.info(f'pruned block bodies beneath height {prune_to}')
+        pruned_height = prune_to
+
+        # Branches forking off beneath the pruned height could never be
+        # reorged onto, so drop them too.
+        side_branches[:] = [
+            branch for branch in side_branches
+            if get_block_index(branch[0].prev_block_hash).height >=
+            pruned_height]
+
+    return pruned_height
+
+
 # Proof of work
 # ----------------------------------------------------------------------------
 
@@ -520,40 +1756,43 @@ def get_next_work_required(prev_block_hash: str) -> int:
     if not prev_block_hash:
         return Params.INITIAL_DIFFICULTY_BITS
 
-    (prev_block, prev_height, _) = locate_block(prev_block_hash)
+    prev = get_block_index(prev_block_hash)
 
-    if (prev_height + 1) % Params.DIFFICULTY_PERIOD_IN_BLOCKS != 0:
-        return prev_block.bits
-
-    with chain_lock:
-        # #realname CalculateNextWorkRequired
-        period_start_block = active_chain[max(
-            prev_height - (Params.DIFFICULTY_PERIOD_IN_BLOCKS - 1), 0)]
+    if Params.POW_NO_RETARGETING or \
+            (prev.height + 1) % Params.DIFFICULTY_PERIOD_IN_BLOCKS != 0:
+        return prev.bits
 
-    actual_time_taken = prev_block.timestamp - period_start_block.timestamp
+    # #realname CalculateNextWorkRequired
+    actual_time_taken = (
+        prev.recent_timestamps[0] - prev.period_start_timestamp)
 
     if actual_time_taken < Params.DIFFICULTY_PERIOD_IN_SECS_TARGET:
         # Increase the difficulty
-        return prev_block.bits + 1
+        return prev.bits + 1
     elif actual_time_taken > Params.DIFFICULTY_PERIOD_IN_SECS_TARGET:
-        return prev_block.bits - 1
+        return prev.bits - 1
     else:
         # Wow, that's unlikely.
-        return prev_block.bits
+        return prev.bits
 
 
 def assemble_and_solve_block(pay_coinbase_to_addr, txns=None):
     """
     Construct a Block by pulling transactions from the mempool, then mine it.
     """
-    with chain_lock:
+    return mine(assemble_block(pay_coinbase_to_addr, txns))
+
+
+def assemble_block(pay_coinbase_to_addr, txns=None, timestamp=None) -> Block:
+    """Construct an unsolved Block atop the tip, by default of mempool txns."""
+    with chain_lock.shared:
         prev_block_hash = active_chain[-1].id if active_chain else None
 
     block = Block(
         version=0,
         prev_block_hash=prev_block_hash,
         merkle_hash='',
-        timestamp=int(time.time()),
+        timestamp=timestamp or int(time.time()),
         bits=get_next_work_required(prev_block_hash),
         nonce=0,
         txns=txns or [],
@@ -563,16 +1802,15 @@ def assemble_and_solve_block(pay_coinbase_to_addr, txns=None):
         block = select_from_mempool(block)
 
     fees = calculate_fees(block)
-    my_address = init_wallet()[2]
     coinbase_txn = Transaction.create_coinbase(
-        my_address, (get_block_subsidy() + fees), len(active_chain))
+        pay_coinbase_to_addr, (get_block_subsidy() + fees), len(active_chain))
     block = block._replace(txns=[coinbase_txn, *block.txns])
     block = block._replace(merkle_hash=get_merkle_root_of_txns(block.txns).val)
 
     if len(serialize(block)) > Params.MAX_BLOCK_SERIALIZED_SIZE:
         raise ValueError('txns specified create a block too large')
 
-    return mine(block)
+    return block
 
 
 def calculate_fees(block) -> int:
@@ -610,9 +1848,21 @@ def get_block_subsidy() -> int:
 # we've updated the chain with a new block.
 mine_interrupt = threading.Event()
 
+hashes_tried = metrics.counter(
+    'tinychain_mining_hashes_total', 'Block header hashes tried')
+mining_hashrate = metrics.gauge(
+    'tinychain_mining_hashrate', 'Hashes per second in the last mining run')
+
+
+def count_hashes(num_hashes: int, start: float):
+    hashes_tried.inc(amount=num_hashes)
+    mining_hashrate.set(
+        int(num_hashes / max(time.perf_counter() - start, 1e-6)))
+
 
 def mine(block):
     start = time.time()
+    perf_start = time.perf_counter()
     nonce = 0
     target = (1 << (256 - block.bits))
     mine_interrupt.clear()
@@ -623,8 +1873,10 @@ def mine(block):
         if nonce % 10000 == 0 and mine_interrupt.is_set():
             logger.info('[mining] interrupted')
             mine_interrupt.clear()
+            count_hashes(nonce, perf_start)
             return None
 
+    count_hashes(nonce + 1, perf_start)
     block = block._replace(nonce=nonce)
     duration = int(time.time() - start) or 0.001
     khs = (block.nonce // duration) // 1000
@@ -646,22 +1898,43 @@ def mine_forever():
 # Validation
 # ----------------------------------------------------------------------------
 
+txn_validation_us = metrics.histogram(
+    'tinychain_txn_validation_microseconds', 'Time to validate a txn')
+block_validation_us = metrics.histogram(
+    'tinychain_block_validation_microseconds', 'Time to validate a block')
+
 
+@txn_validation_us.time()
 def validate_txn(txn: Transaction,
                  as_coinbase: bool = False,
                  siblings_in_block: Iterable[Transaction] = None,
                  allow_utxo_from_mempool: bool = True,
+                 utxos: Mapping[OutPoint, UnspentTxOut] = None,
+                 spend_height: int = None,
                  ) -> Transaction:
     """
     Validate a single transaction. Used in various contexts, so the
-    parameters facilitate different uses.
+    parameters facilitate different uses: by default, it's checked against
+    `utxo_set` as of the active chain's tip, but `utxos` and `spend_height`
+    let it be checked against some other state (e.g. mid-reorg).
     """
+    utxos = utxo_set if utxos is None else utxos
+    spend_height = \
+        get_current_height() if spend_height is None else spend_height
+
     txn.validate_basics(as_coinbase=as_coinbase)
 
     available_to_spend = 0
 
     for i, txin in enumerate(txn.txins):
-        utxo = utxo_set.get(txin.to_spend)
+        if allow_utxo_from_mempool:
+            spender = mempool_spends.get(txin.to_spend)
+
+            if spender in mempool and spender != txn.id:
+                raise TxnValidationError(
+                    f'TxIn[{i}] is already spent by mempool txn {spender}')
+
+        utxo = utxos.get(txin.to_spend)
 
         if siblings_in_block:
             utxo = utxo or find_utxo_in_list(txin, siblings_in_block)
@@ -675,8 +1948,7 @@ def validate_txn(txn: Transaction,
                 to_orphan=txn)
 
         if utxo.is_coinbase and \
-                (get_current_height() - utxo.height) < \
-                Params.COINBASE_MATURITY:
+                (spend_height - utxo.height) < Params.COINBASE_MATURITY:
             raise TxnValidationError(f'Coinbase UTXO not ready for spend')
 
         try:
@@ -718,7 +1990,9 @@ def build_spend_message(to_spend, pk, sequence, txouts) -> bytes:
         binascii.hexlify(pk).decode() + serialize(txouts)).encode()
 
 
+@traced
 @with_lock(chain_lock)
+@block_validation_us.time()
 def validate_block(block: Block) -> Block:
     if not block.txns:
         raise BlockValidationError('txns empty')
@@ -727,7 +2001,13 @@ def validate_block(block: Block) -> Block:
         raise BlockValidationError('Block timestamp too far in future')
 
     if int(block.id, 16) > (1 << (256 - block.bits)):
-        raise BlockValidationError("Block header doesn't satisfy bits")
+        raise BlockValidationError(
+            "Block header doesn't satisfy bits", bad_header=True)
+
+    # Checked ahead of the merkle root, which can't tell a repeated trailing
+    # txn from the original block.
+    if len({tx.id for tx in block.txns}) != len(block.txns):
+        raise BlockValidationError('Duplicate txns')
 
     if [i for (i, tx) in enumerate(block.txns) if tx.is_coinbase] != [0]:
         raise BlockValidationError('First txn must be coinbase and no more')
@@ -742,8 +2022,10 @@ def validate_block(block: Block) -> Block:
     if get_merkle_root_of_txns(block.txns).val != block.merkle_hash:
         raise BlockValidationError('Merkle hash invalid')
 
-    if block.timestamp <= get_median_time_past(11):
-        raise BlockValidationError('timestamp too old')
+    prev_index = get_block_index(block.prev_block_hash)
+
+    if prev_index and block.timestamp <= prev_index.median_time_past:
+        raise BlockValidationError('timestamp too old', bad_header=True)
 
     if not block.prev_block_hash and not active_chain:
         # This is the genesis block.
@@ -766,7 +2048,7 @@ def validate_block(block: Block) -> Block:
             return block, prev_block_chain_idx + 1  # Non-existent
 
     if get_next_work_required(block.prev_block_hash) != block.bits:
-        raise BlockValidationError('bits is incorrect')
+        raise BlockValidationError('bits is incorrect', bad_header=True)
 
     for txn in block.txns[1:]:
         try:
@@ -786,261 +2068,2040 @@ def validate_block(block: Block) -> Block:
 # Set of yet-unmined transactions.
 mempool: Dict[str, Transaction] = {}
 
-# Set of orphaned (i.e. has inputs referencing yet non-existent UTXOs)
-# transactions.
-orphan_txns: Iterable[Transaction] = []
-
+# The id of the mempool txn spending each outpoint.
+#
+# #realname mapNextTx
+mempool_spends: Dict[OutPoint, str] = {}
 
-def find_utxo_in_mempool(txin) -> UnspentTxOut:
-    txid, idx = txin.to_spend
 
-    try:
-        txout = mempool[txid].txouts[idx]
-    except Exception:
-        logger.debug("Couldn't find utxo in mempool for %s", txin)
-        return None
+class MempoolEntry(NamedTuple):
+    """#realname CTxMemPoolEntry"""
+    fee: int
 
-    return UnspentTxOut(
-        *txout, txid=txid, is_coinbase=False, height=-1, txout_idx=idx)
+    # Serialized size in bytes.
+    size: int
 
+    # When the txn entered the mempool.
+    time: float
 
-def select_from_mempool(block: Block) -> Block:
-    """Fill a Block with transactions from the mempool."""
-    added_to_block = set()
+    @property
+    def fee_rate(self) -> int: return self.fee * 1000 // self.size
 
-    def check_block_size(b) -> bool:
-        return len(serialize(block)) < Params.MAX_BLOCK_SERIALIZED_SIZE
 
-    def try_add_to_block(block, txid) -> Block:
-        if txid in added_to_block:
-            return block
+mempool_entries: Dict[str, MempoolEntry] = {}
 
-        tx = mempool[txid]
+# (fee rate, txid) for every mempool txn; may hold entries for txns which
+# have since left the mempool, which are skipped when popped.
+mempool_fee_heap: Iterable[Tuple[int, str]] = []
 
-        # For any txin that can't be found in the main chain, find its
-        # transaction in the mempool (if it exists) and add it to the block.
-        for txin in tx.txins:
-            if txin.to_spend in utxo_set:
-                continue
+# The total serialized size of the txns in the mempool.
+mempool_bytes = 0
 
-            in_mempool = find_utxo_in_mempool(txin)
+# The fee rate needed to get into the mempool; raised by evictions.
+#
+# #realname rollingMinimumFeeRate
+rolling_min_fee_rate = 0
+last_rolling_fee_update = time.time()
 
-            if not in_mempool:
-                logger.debug(f"Couldn't find UTXO for {txin}")
-                return None
+mempool_evictions = 0
+mempool_expirations = 0
 
-            block = try_add_to_block(block, in_mempool.txid)
-            if not block:
-                logger.debug(f"Couldn't add parent")
-                return None
+# Set of orphaned (i.e. has inputs referencing yet non-existent UTXOs)
+# transactions.
+orphan_txns: Iterable[Transaction] = []
 
-        newblock = block._replace(txns=[*block.txns, tx])
 
-        if check_block_size(newblock):
-            logger.debug(f'added tx {tx.id} to block')
-            added_to_block.add(txid)
-            return newblock
-        else:
-            return block
+def add_to_mempool(txn: Transaction,
+                   fee: int = None,
+                   size: int = None,
+                   entry_time: float = None):
+    global mempool_bytes
 
-    for txid in mempool:
-        newblock = try_add_to_block(block, txid)
+    remove_from_mempool(txn.id)
+    entry = MempoolEntry(
+        fee=get_txn_fee(txn) if fee is None else fee,
+        size=size or len(serialize(txn)),
+        time=entry_time or time.time())
 
-        if check_block_size(newblock):
-            block = newblock
-        else:
-            break
+    mempool[txn.id] = txn
+    mempool_entries[txn.id] = entry
+    mempool_bytes += entry.size
+    heapq.heappush(mempool_fee_heap, (entry.fee_rate, txn.id))
 
-    return block
+    for txin in txn.txins:
+        mempool_spends[txin.to_spend] = txn.id
 
+    notify_mempool(txn, added=True)
 
-def add_txn_to_mempool(txn: Transaction):
-    if txn.id in mempool:
-        logger.info(f'txn {txn.id} already seen')
-        return
 
-    try:
-        txn = validate_txn(txn)
-    except TxnValidationError as e:
-        if e.to_orphan:
-            logger.info(f'txn {e.to_orphan.id} submitted as orphan')
-            orphan_txns.append(e.to_orphan)
-        else:
-            logger.exception(f'txn rejected')
-    else:
-        logger.info(f'txn {txn.id} added to mempool')
-        mempool[txn.id] = txn
+def remove_from_mempool(txid: str, with_descendants=False) -> Iterable[str]:
+    """Remove a txn (and optionally its descendants), returning what went."""
+    global mempool_bytes
+    txn = mempool.pop(txid, None)
+    entry = mempool_entries.pop(txid, None)
+    mempool_bytes -= entry.size if entry else 0
 
-        for peer in peer_hostnames:
-            send_to_peer(txn, peer)
+    if not txn:
+        return []
 
+    for txin in txn.txins:
+        if mempool_spends.get(txin.to_spend) == txid:
+            del mempool_spends[txin.to_spend]
 
-# Merkle trees
-# ----------------------------------------------------------------------------
+    notify_mempool(txn, added=False)
 
-class MerkleNode(NamedTuple):
-    val: str
-    children: Iterable = None
+    removed = [txid]
 
+    if with_descendants:
+        for i in range(len(txn.txouts)):
+            child_txid = mempool_spends.get(OutPoint(txid, i))
+            if child_txid:
+                removed.extend(remove_from_mempool(child_txid, True))
 
-def get_merkle_root_of_txns(txns):
-    return get_merkle_root(*[t.id for t in txns])
+    return removed
+
+
+def evict_mempool_conflicts(txn: Transaction) -> Iterable[str]:
+    """
+    Remove mempool txns (and their descendants) which spend any of the same
+    outputs as `txn`, e.g. because `txn` was just confirmed.
+    """
+    evicted = []
+
+    for txin in txn.txins:
+        spender = mempool_spends.get(txin.to_spend)
+
+        if spender and spender != txn.id:
+            evicted.extend(remove_from_mempool(spender, with_descendants=True))
+
+    if evicted:
+        logger.info(f'evicted {len(evicted)} txns conflicting with {txn.id}')
+
+    return evicted
+
+
+def get_txn_fee(txn: Transaction) -> int:
+    spent = 0
+
+    for txin in txn.txins:
+        utxo = utxo_set.get(txin.to_spend) or find_utxo_in_mempool(txin)
+        spent += utxo.value if utxo else 0
+
+    return spent - sum(o.value for o in txn.txouts)
+
+
+def get_mempool_min_fee_rate() -> int:
+    """
+    The fee rate a txn must pay to enter the mempool. This decays back
+    towards zero, and faster the emptier the mempool is.
+
+    #realname CTxMemPool::GetMinFee
+    """
+    global rolling_min_fee_rate, last_rolling_fee_update
+    now = time.time()
+
+    if rolling_min_fee_rate:
+        halflife = Params.ROLLING_FEE_HALFLIFE_SECS
+
+        if mempool_bytes < Params.MAX_MEMPOOL_SIZE_BYTES / 4:
+            halflife /= 4
+        elif mempool_bytes < Params.MAX_MEMPOOL_SIZE_BYTES / 2:
+            halflife /= 2
+
+        rolling_min_fee_rate *= 0.5 ** ((now - last_rolling_fee_update) /
+                                        halflife)
+
+        if rolling_min_fee_rate < Params.INCREMENTAL_RELAY_FEE_RATE / 2:
+            rolling_min_fee_rate = 0
+
+    last_rolling_fee_update = now
+    return int(rolling_min_fee_rate)
+
+
+def trim_mempool() -> Iterable[str]:
+    """
+    Evict the lowest fee-rate txns, along with their descendants, until the
+    mempool fits within Params.MAX_MEMPOOL_SIZE_BYTES.
+
+    #realname CTxMemPool::TrimToSize
+    """
+    global rolling_min_fee_rate, mempool_evictions
+    evicted = []
+
+    while mempool_bytes > Params.MAX_MEMPOOL_SIZE_BYTES and mempool_fee_heap:
+        fee_rate, txid = heapq.heappop(mempool_fee_heap)
+        entry = mempool_entries.get(txid)
+
+        if not entry or entry.fee_rate != fee_rate:
+            continue  # Stale heap entry.
+
+        package = remove_from_mempool(txid, with_descendants=True)
+        evicted.extend(package)
+        mempool_evictions += len(package)
+
+        get_mempool_min_fee_rate()  # Apply any decay before raising.
+        rolling_min_fee_rate = max(
+            rolling_min_fee_rate,
+            fee_rate + Params.INCREMENTAL_RELAY_FEE_RATE)
+
+    if evicted:
+        logger.info(
+            f'evicted {len(evicted)} txns to trim mempool; min fee rate is '
+            f'now {int(rolling_min_fee_rate)}')
+
+    # Drop stale entries from the heap every so often.
+    if len(mempool_fee_heap) > 2 * len(mempool) + 1000:
+        mempool_fee_heap[:] = [
+            (e.fee_rate, txid) for txid, e in mempool_entries.items()]
+        heapq.heapify(mempool_fee_heap)
+
+    return evicted
+
+
+def expire_mempool() -> Iterable[str]:
+    """
+    Drop txns (and their descendants) older than Params.MEMPOOL_EXPIRY_SECS.
+
+    #realname CTxMemPool::Expire
+    """
+    global mempool_expirations
+    cutoff = time.time() - Params.MEMPOOL_EXPIRY_SECS
+    expired = []
+
+    # Entries are kept in the order they were added, so the oldest are first.
+    while mempool_entries:
+        txid, entry = next(iter(mempool_entries.items()))
+        if entry.time >= cutoff:
+            break
+        expired.extend(remove_from_mempool(txid, with_descendants=True))
+
+    if expired:
+        mempool_expirations += len(expired)
+        logger.info(f'expired {len(expired)} txns from the mempool')
+
+    return expired
+
+
+def find_utxo_in_mempool(txin) -> UnspentTxOut:
+    txid, idx = txin.to_spend
+    txn = mempool.get(txid)
+
+    if not txn or idx >= len(txn.txouts):
+        logger.debug("Couldn't find utxo in mempool for %s", txin)
+        return None
+
+    return UnspentTxOut(
+        *txn.txouts[idx],
+        txid=txid, is_coinbase=False, height=-1, txout_idx=idx)
+
+
+@traced
+def select_from_mempool(block: Block) -> Block:
+    """Fill a Block with transactions from the mempool."""
+    added_to_block = set()
+
+    def check_block_size(b) -> bool:
+        return len(serialize(block)) < Params.MAX_BLOCK_SERIALIZED_SIZE
+
+    def try_add_to_block(block, txid) -> Block:
+        if txid in added_to_block:
+            return block
+
+        tx = mempool[txid]
+
+        # For any txin that can't be found in the main chain, find its
+        # transaction in the mempool (if it exists) and add it to the block.
+        for txin in tx.txins:
+            if txin.to_spend in utxo_set:
+                continue
+
+            in_mempool = find_utxo_in_mempool(txin)
+
+            if not in_mempool:
+                logger.debug("Couldn't find UTXO for %s", txin)
+                return None
+
+            block = try_add_to_block(block, in_mempool.txid)
+            if not block:
+                logger.debug("Couldn't add parent")
+                return None
+
+        newblock = block._replace(txns=[*block.txns, tx])
+
+        if check_block_size(newblock):
+            logger.debug('added tx %s to block', txid)
+            added_to_block.add(txid)
+            return newblock
+        else:
+            return block
+
+    for txid in mempool:
+        newblock = try_add_to_block(block, txid)
+
+        if check_block_size(newblock):
+            block = newblock
+        else:
+            break
+
+    return block
+
+
+@with_lock(chain_lock)
+def accept_to_mempool(txn: Transaction,
+                      entry_time: float = None,
+                      keep_orphans: bool = True,
+                      ) -> Union[None, str]:
+    """
+    Validate a txn and add it to the mempool without relaying it. Returns
+    None if the txn was accepted, otherwise the reason it wasn't.
+
+    #realname AcceptToMemoryPool
+    """
+    txid = txn.id
+
+    if txid in mempool:
+        return 'already in mempool'
+
+    try:
+        txn = validate_txn(txn)
+        fee, size = get_txn_fee(txn), len(serialize(txn))
+
+        if fee * 1000 // size < get_mempool_min_fee_rate():
+            raise TxnValidationError('mempool min fee not met')
+    except TxnValidationError as e:
+        if e.to_orphan and keep_orphans:
+            logger.debug('txn %s submitted as orphan', txid)
+            orphan_txns.append(e.to_orphan)
+        elif not e.to_orphan:
+            logger.debug('txn %s rejected: %s', txid, e.msg)
+            recent_rejects.add(txid)
+        return e.msg
+
+    add_to_mempool(txn, fee, size, entry_time)
+
+    if txid in trim_mempool():
+        logger.debug('txn %s evicted on entry to full mempool', txid)
+        recent_rejects.add(txid)
+        return 'mempool full'
+
+    recently_seen.add(txid)
+    return None
+
+
+def add_txn_to_mempool(txn: Transaction):
+    txid = txn.id
+
+    if txid in mempool or txid in recent_rejects:
+        logger.debug('txn %s already seen', txid)
+        return
+
+    expire_mempool()
+
+    if accept_to_mempool(txn) is None:
+        logger.debug('txn %s added to mempool', txid)
+        relay_inventory(txids=[txid])
+
+
+def add_txns_to_mempool(txns: Iterable[Transaction]) -> Iterable['TxnResult']:
+    """
+    Admit a batch of txns, parents before children, under a single hold of
+    the chain lock, then announce those accepted to each peer in one message.
+    Results are returned in the order the txns were given.
+    """
+    expire_mempool()
+    rejections = {}
+    accepted = []
+
+    with chain_lock:
+        for txn in sort_txns_topologically(txns):
+            rejections[txn.id] = (
+                'recently rejected' if txn.id in recent_rejects else
+                accept_to_mempool(txn))
+
+            if rejections[txn.id] is None:
+                accepted.append(txn)
+
+    logger.info(
+        f'added {len(accepted)} of {len(txns)} batched txns to mempool')
+
+    if accepted:
+        relay_inventory(txids=[txn.id for txn in accepted])
+
+    return [TxnResult(txn.id, rejections[txn.id]) for txn in txns]
+
+
+def sort_txns_topologically(txns: Iterable[Transaction]) -> Iterable[
+        Transaction]:
+    """
+    Order txns so that each comes after any of the others that it spends,
+    otherwise preserving their order.
+    """
+    by_id = {tx.id: tx for tx in txns}
+    ordered = []
+    placed = set()
+
+    for tx in by_id.values():
+        stack = [tx]
+
+        while stack:
+            tx = stack[-1]
+
+            if tx.id in placed:
+                stack.pop()
+                continue
+
+            unplaced_parents = [
+                by_id[txin.to_spend.txid] for txin in tx.txins
+                if txin.to_spend and txin.to_spend.txid in by_id and
+                txin.to_spend.txid not in placed]
+
+            if unplaced_parents:
+                stack.extend(unplaced_parents)
+            else:
+                placed.add(tx.id)
+                ordered.append(tx)
+                stack.pop()
+
+    return ordered
+
+
+# Mempool persistence
+# ----------------------------------------------------------------------------
+
+MEMPOOL_PATH = os.environ.get('TC_MEMPOOL_PATH', 'mempool.dat')
+
+# How often to write the mempool to disk while running.
+MEMPOOL_DUMP_INTERVAL_SECS = int(
+    os.environ.get('TC_MEMPOOL_DUMP_INTERVAL', 5 * 60))
+
+
+class MempoolDumpEntry(NamedTuple):
+    txn: Transaction
+
+    # When the txn entered the mempool, so that it still expires on time.
+    time: int
+
+
+def dump_mempool(path=None) -> int:
+    """
+    Write the mempool to disk, oldest txns first.
+
+    #realname DumpMempool
+    """
+    path = path or MEMPOOL_PATH
+    entries = [
+        MempoolDumpEntry(mempool[txid], int(entry.time))
+        for txid, entry in list(mempool_entries.items()) if txid in mempool]
+
+    # Write then rename so a crash mid-dump leaves the last dump intact.
+    with open(f'{path}.new', 'wb') as f:
+        f.write(zlib.compress(serialize(entries).encode()))
+    os.replace(f'{path}.new', path)
+
+    logger.debug(f'dumped {len(entries)} mempool txns to {path}')
+    return len(entries)
+
+
+def load_mempool(path=None) -> int:
+    """
+    Revalidate txns dumped by `dump_mempool()` against the current UTXO set
+    and readmit those which still hold up. Returns the number readmitted.
+
+    #realname LoadMempool
+    """
+    path = path or MEMPOOL_PATH
+
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb') as f:
+        entries = deserialize(zlib.decompress(f.read()).decode())
+
+    cutoff = time.time() - Params.MEMPOOL_EXPIRY_SECS
+    entry_times = {e.txn.id: e.time for e in entries if e.time >= cutoff}
+    txns = [e.txn for e in entries if e.txn.id in entry_times]
+    accepted = 0
+
+    with chain_lock:
+        for txn in sort_txns_topologically(txns):
+            # Txns whose inputs have been spent since the dump are confirmed
+            # or conflicted; don't hold onto them as orphans.
+            if accept_to_mempool(
+                    txn, entry_times[txn.id], keep_orphans=False) is None:
+                accepted += 1
+
+    logger.info(
+        f'loaded {accepted} of {len(entries)} mempool txns from {path}')
+    return accepted
+
+
+def dump_mempool_forever():
+    while True:
+        time.sleep(MEMPOOL_DUMP_INTERVAL_SECS)
+
+        try:
+            dump_mempool()
+        except Exception:
+            logger.exception('failed to dump mempool')
+
+
+# Merkle trees
+# ----------------------------------------------------------------------------
+
+class MerkleNode(NamedTuple):
+    val: str
+    children: Iterable = None
+
+
+def get_merkle_root_of_txns(txns):
+    return get_merkle_root(*[t.id for t in txns])
 
 
 @lru_cache(maxsize=1024)
 def get_merkle_root(*leaves: Tuple[str]) -> MerkleNode:
     """Builds a Merkle tree and returns the root given some leaf values."""
-    if len(leaves) % 2 == 1:
-        leaves = leaves + (leaves[-1],)
+    def find_root(nodes):
+        # Pair the last node with itself on any level with an odd number.
+        if len(nodes) % 2 == 1:
+            nodes = nodes + [nodes[-1]]
+
+        newlevel = [
+            MerkleNode(sha256d(i1.val + i2.val), children=[i1, i2])
+            for [i1, i2] in _chunks(nodes, 2)
+        ]
+
+        return find_root(newlevel) if len(newlevel) > 1 else newlevel[0]
+
+    return find_root([MerkleNode(sha256d(l)) for l in leaves])
+
+
+# Peer-to-peer
+# ----------------------------------------------------------------------------
+
+peer_hostnames = {p for p in os.environ.get('TC_PEERS', '').split(',') if p}
+
+# Signal when the initial block download has completed.
+ibd_done = threading.Event()
+
+# The most ids we'll remember a single peer having.
+MAX_KNOWN_INVENTORY = 50_000
+
+# Don't ask another peer for an object we've requested within this long.
+GETDATA_TIMEOUT_SECS = 30
+
+
+class RollingBloomFilter:
+    """
+    A probabilistic set of strings in fixed memory which remembers at least
+    the last `capacity` added. Items go into the newer of two generations;
+    once that fills, the older is cleared and takes its place.
+
+    #realname CRollingBloomFilter
+    """
+
+    def __init__(self, capacity: int, fp_rate: float = 1e-6):
+        self.capacity = capacity
+        self.num_bits = max(
+            8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.num_hashes = max(
+            1, round(self.num_bits / capacity * math.log(2)))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.generations = [
+                bytearray((self.num_bits + 7) // 8) for _ in range(2)]
+            self.count = 0
+            self.key = os.urandom(16)
+
+    def _bit_indexes(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(
+            item.encode(), key=self.key, digest_size=16).digest()
+
+        # Derive all the hashes from two; see Kirsch & Mitzenmacher.
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item: str):
+        with self.lock:
+            if self.count >= self.capacity:
+                self.generations = [
+                    bytearray(len(self.generations[0])), self.generations[0]]
+                self.count = 0
+
+            current = self.generations[0]
+            for i in self._bit_indexes(item):
+                current[i >> 3] |= 1 << (i & 7)
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        with self.lock:
+            indexes = self._bit_indexes(item)
+            return any(
+                all(gen[i >> 3] & (1 << (i & 7)) for i in indexes)
+                for gen in self.generations)
+
+
+class KnownInventory:
+    """A set of ids which forgets the oldest once it's over `max_size`."""
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or MAX_KNOWN_INVENTORY
+        self.ids = collections.OrderedDict()
+
+    def __contains__(self, id_): return id_ in self.ids
+
+    def __len__(self): return len(self.ids)
+
+    def add(self, id_):
+        self.ids[id_] = None
+        self.ids.move_to_end(id_)
+
+        if len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+
+# The block and txn ids each peer (by hostname) is known to have, whether
+# because they sent or announced it to us or we did to them. Nothing is
+# announced to a peer twice.
+#
+# #realname CNode::filterInventoryKnown
+peer_inventory: Dict[str, KnownInventory] = collections.defaultdict(
+    KnownInventory)
+peer_inventory_lock = threading.Lock()
+
+# Ids of the blocks and txns we've most recently accepted, or found invalid,
+# so copies from other peers can be dropped without validating them again.
+recently_seen = RollingBloomFilter(120_000)
+
+# Ids of txns rejected from the mempool, which may be valid atop a later tip;
+# cleared whenever the tip changes.
+#
+# #realname m_recent_rejects
+recent_rejects = RollingBloomFilter(120_000)
+
+# When we last asked any peer for each object we're waiting on.
+#
+# #realname mapAlreadyAskedFor
+requested_inventory: Dict[str, float] = {}
+
+
+def mark_inventory_known(peer: str, ids: Iterable[str]):
+    with peer_inventory_lock:
+        known = peer_inventory[peer]
+        for id_ in ids:
+            known.add(id_)
+
+
+def claim_unknown_inventory(peer: str, ids: Iterable[str]) -> Iterable[str]:
+    """Of `ids`, those `peer` isn't known to have; they now are."""
+    with peer_inventory_lock:
+        known = peer_inventory[peer]
+        new_ids = [i for i in ids if i not in known]
+
+        for id_ in new_ids:
+            known.add(id_)
+
+    return new_ids
+
+
+def relay_inventory(block_ids: Iterable[str] = (), txids: Iterable[str] = ()):
+    """Announce new objects to each peer which isn't known to have them."""
+    for peer in list(peer_hostnames):
+        new_block_ids = claim_unknown_inventory(peer, block_ids)
+        new_txids = claim_unknown_inventory(peer, txids)
+
+        if new_block_ids or new_txids:
+            send_to_peer(InvMsg(
+                [], pruned_height, new_block_ids or None, new_txids or None),
+                peer)
+
+
+def relay_block(block: Block):
+    """Push a new block, compacted, to each peer which doesn't have it."""
+    compact_block = None
+
+    for peer in list(peer_hostnames):
+        if claim_unknown_inventory(peer, [block.id]):
+            compact_block = compact_block or CompactBlockMsg.from_block(block)
+            send_to_peer(compact_block, peer)
+
+
+def claim_inventory_request(id_: str) -> bool:
+    """Whether to request `id_`, i.e. we're not already waiting on it."""
+    now = time.time()
+
+    with peer_inventory_lock:
+        if now - requested_inventory.get(id_, 0) < GETDATA_TIMEOUT_SECS:
+            return False
+
+        if len(requested_inventory) >= MAX_KNOWN_INVENTORY:
+            for stale_id, asked_at in list(requested_inventory.items()):
+                if now - asked_at >= GETDATA_TIMEOUT_SECS:
+                    del requested_inventory[stale_id]
+
+        requested_inventory[id_] = now
+        return True
+
+
+def have_block(block_id: str) -> bool:
+    return block_id in block_index or bool(locate_block(block_id)[0]) or \
+        any(b.id == block_id for b in orphan_blocks)
+
+
+def have_txn(txid: str) -> bool:
+    return txid in mempool or txid in recent_rejects or \
+        any(tx.id == txid for tx in orphan_txns)
+
+
+class GetBlocksMsg(NamedTuple):  # Request blocks during initial sync
+    """
+    See https://bitcoin.org/en/developer-guide#blocks-first
+    """
+    from_blockid: str
+
+    CHUNK_SIZE = 50
+
+    def handle(self, sock, peer_hostname):
+        logger.debug('[p2p] recv getblocks from %s', peer_hostname)
+
+        # The peer is caught up; no need to look at the chain itself.
+        if self.from_blockid == get_chain_view().tip_id:
+            sock.sendall(encode_socket_data(InvMsg([], pruned_height)))
+            return
+
+        _, height, _ = locate_block(self.from_blockid, active_chain)
+
+        # If we don't recognize the requested hash as part of the active
+        # chain, start at the genesis block.
+        height = height or 1
+
+        if height < pruned_height:
+            logger.debug(
+                f"[p2p] can't serve pruned blocks to {peer_hostname}")
+            sock.sendall(encode_socket_data(InvMsg([], pruned_height)))
+            return
+
+        with chain_lock.shared:
+            blocks = active_chain[height:(height + self.CHUNK_SIZE)]
+
+        logger.debug(f"[p2p] sending {len(blocks)} to {peer_hostname}")
+        sock.sendall(encode_socket_data(InvMsg(blocks, pruned_height)))
+
+
+class InvMsg(NamedTuple):  # Convey blocks during initial sync, or announce ids
+    blocks: Iterable[str]
+
+    # The sender can't serve blocks beneath this height.
+    pruned_height: int = 0
+
+    # Ids of blocks and txns the sender has newly accepted; see
+    # `relay_inventory()`.
+    block_ids: Iterable[str] = None
+    txids: Iterable[str] = None
+
+    def handle(self, sock, peer_hostname):
+        if self.block_ids or self.txids:
+            return self.handle_announcement(sock, peer_hostname)
+
+        logger.debug('[p2p] recv inv from %s', peer_hostname)
+        mark_inventory_known(peer_hostname, [b.id for b in self.blocks])
+
+        new_blocks = [b for b in self.blocks if not locate_block(b.id)[0]]
+        other_peers = list(peer_hostnames - {peer_hostname})
+
+        if not new_blocks and \
+                self.pruned_height > get_current_height() and other_peers:
+            logger.info(
+                f'[p2p] {peer_hostname} has pruned the blocks we need; '
+                f'trying another peer')
+            send_to_peer(
+                GetBlocksMsg(active_chain[-1].id), random.choice(other_peers))
+            return
+
+        if not new_blocks:
+            logger.info('[p2p] initial block download complete')
+            ibd_done.set()
+            return
+
+        for block in new_blocks:
+            connect_block(block)
+
+        new_tip_id = active_chain[-1].id
+        logger.info(f'[p2p] continuing initial block download at {new_tip_id}')
+
+        # "Recursive" call to continue the initial block sync.
+        sock.sendall(encode_socket_data(GetBlocksMsg(new_tip_id)))
+
+    def handle_announcement(self, sock, peer_hostname):
+        announced_block_ids = self.block_ids or []
+        announced_txids = self.txids or []
+        logger.debug(
+            f'[p2p] recv inv of {len(announced_block_ids)} blocks and '
+            f'{len(announced_txids)} txns from {peer_hostname}')
+        mark_inventory_known(
+            peer_hostname, [*announced_block_ids, *announced_txids])
+
+        block_ids = [i for i in announced_block_ids
+                     if not have_block(i) and claim_inventory_request(i)]
+        txids = [i for i in announced_txids
+                 if not have_txn(i) and claim_inventory_request(i)]
+
+        if block_ids or txids:
+            sock.sendall(encode_socket_data(
+                GetDataMsg(block_ids or None, txids or None)))
+
+
+class GetDataMsg(NamedTuple):  # Request objects announced by an InvMsg
+    block_ids: Iterable[str] = None
+    txids: Iterable[str] = None
+
+    def handle(self, sock, peer_hostname):
+        block_ids, txids = self.block_ids or [], self.txids or []
+        mark_inventory_known(peer_hostname, [*block_ids, *txids])
+
+        for block_id in block_ids:
+            block = locate_block(block_id)[0]
+
+            # Pruned bodies can't be served.
+            if block and block.txns:
+                sock.sendall(encode_socket_data(block))
+
+        txns = [tx for tx in map(mempool.get, txids) if tx]
+
+        if txns:
+            sock.sendall(encode_socket_data(TxBatchMsg(txns, reply=False)))
+
+
+# Compact blocks refer to txns by this many leading hex digits of their id.
+#
+# Bitcoin uses 6-byte SipHashes keyed per block so that collisions can't be
+# engineered against every node at once; here a collision just means
+# falling back to fetching the whole block.
+SHORT_TXID_LEN = 12
+
+# Most compact blocks we'll hold onto while waiting on their missing txns.
+MAX_PARTIAL_BLOCKS = 16
+
+# Compact blocks awaiting a BlockTxnMsg, keyed by block id, with None in
+# place of each txn we couldn't find.
+partial_blocks: Dict[str, Tuple[Block, Iterable[Transaction]]] = {}
+partial_blocks_lock = threading.Lock()
+
+
+def short_txid(txid: str) -> str: return txid[:SHORT_TXID_LEN]
+
+
+class CompactBlockMsg(NamedTuple):  # Relay a block whose txns peers may have
+    """
+    A block's header and coinbase, with the rest of its txns abbreviated to
+    short ids for the receiver to fill in from its mempool.
+
+    See https://github.com/bitcoin/bips/blob/master/bip-0152.mediawiki
+    #realname cmpctblock
+    """
+    header: Block  # With no txns.
+    coinbase: Transaction
+    short_txids: Iterable[str]
+
+    @classmethod
+    def from_block(cls, block: Block) -> 'CompactBlockMsg':
+        return cls(
+            block._replace(txns=[]),
+            block.txns[0],
+            [short_txid(tx.id) for tx in block.txns[1:]])
+
+    def handle(self, sock, peer_hostname):
+        block_id = self.header.id
+        mark_inventory_known(peer_hostname, [block_id])
+
+        if have_block(block_id):
+            return
+
+        mempool_by_short_id = {}
+        for txn in list(mempool.values()):
+            sid = short_txid(txn.id)
+            # Colliding ids are ambiguous, so treat them as missing.
+            mempool_by_short_id[sid] = \
+                None if sid in mempool_by_short_id else txn
+
+        txns = [self.coinbase] + [
+            mempool_by_short_id.get(sid) for sid in self.short_txids]
+        missing = [i for i, tx in enumerate(txns) if tx is None]
+
+        logger.info(
+            f'[p2p] recv compact block {block_id} from {peer_hostname}; '
+            f'missing {len(missing)} of {len(txns)} txns')
+
+        if missing:
+            with partial_blocks_lock:
+                partial_blocks[block_id] = (self.header, txns)
+
+                while len(partial_blocks) > MAX_PARTIAL_BLOCKS:
+                    partial_blocks.pop(next(iter(partial_blocks)))
+
+            sock.sendall(encode_socket_data(GetBlockTxnMsg(block_id, missing)))
+            return
+
+        connect_compact_block(self.header, txns, sock)
+
+
+class GetBlockTxnMsg(NamedTuple):  # Request txns missing from a compact block
+    block_id: str
+    indexes: Iterable[int]
+
+    def handle(self, sock, peer_hostname):
+        block = locate_block(self.block_id)[0]
+
+        if not (block and block.txns):
+            return
+
+        if not all(isinstance(i, int) and 0 <= i < len(block.txns)
+                   for i in self.indexes):
+            logger.info(f'[p2p] bad getblocktxn for {self.block_id} '
+                        f'from {peer_hostname}')
+            return
+
+        sock.sendall(encode_socket_data(BlockTxnMsg(
+            self.block_id, [block.txns[i] for i in self.indexes])))
+
+
+class BlockTxnMsg(NamedTuple):  # Supply txns missing from a compact block
+    block_id: str
+    txns: Iterable[Transaction]
+
+    def handle(self, sock, peer_hostname):
+        with partial_blocks_lock:
+            header, txns = partial_blocks.pop(self.block_id, (None, None))
+
+        if not header:
+            return
+
+        missing = [i for i, tx in enumerate(txns) if tx is None]
+
+        if len(missing) != len(self.txns):
+            logger.info(f'[p2p] bad blocktxn for {self.block_id}')
+            return
+
+        for i, txn in zip(missing, self.txns):
+            txns[i] = txn
+
+        connect_compact_block(header, txns, sock)
+
+
+def connect_compact_block(header: Block, txns: Iterable[Transaction], sock):
+    """Connect a reconstructed block, else fetch it whole from the sender."""
+    if get_merkle_root_of_txns(txns).val != header.merkle_hash:
+        logger.info(
+            f'[p2p] short id collision rebuilding {header.id}; '
+            f'fetching the full block')
+        sock.sendall(encode_socket_data(GetDataMsg([header.id])))
+        return
+
+    connect_block(header._replace(txns=txns))
+
+
+class PingMsg(NamedTuple):  # Keep an idle session alive
+    nonce: int
+
+    def handle(self, sock, peer_hostname):
+        sock.sendall(encode_socket_data(PongMsg(self.nonce)))
+
+
+class PongMsg(NamedTuple):
+    nonce: int
+
+    def handle(self, sock, peer_hostname):
+        pass  # Hearing anything at all is enough to keep a session alive.
+
+
+class GetUTXOsMsg(NamedTuple):  # List all UTXOs
+    def handle(self, sock, peer_hostname):
+        with chain_lock.shared:
+            utxos = list(utxo_set.items())
+
+        sock.sendall(encode_socket_data(utxos))
+
+
+class TxnResult(NamedTuple):
+    txid: str
+
+    # None if the txn was accepted into the mempool, otherwise why it wasn't.
+    rejection: Union[str, None] = None
+
+
+class TxBatchMsg(NamedTuple):  # Submit or relay many txns at once
+    txns: Iterable[Transaction]
+
+    # Whether the sender wants a TxnResult for each txn back.
+    reply: bool = True
+
+    def handle(self, sock, peer_hostname):
+        logger.debug('[p2p] recv batch of %d txns from %s',
+                     len(self.txns), peer_hostname)
+        mark_inventory_known(peer_hostname, [txn.id for txn in self.txns])
+        results = add_txns_to_mempool(self.txns)
+
+        if self.reply:
+            sock.sendall(encode_socket_data(results))
+
+
+class GetMempoolMsg(NamedTuple):  # List the mempool
+    def handle(self, sock, peer_hostname):
+        sock.sendall(encode_socket_data(list(mempool.keys())))
+
+
+class MempoolStats(NamedTuple):
+    size: int
+    bytes: int
+    max_bytes: int
+    min_fee_rate: int
+    evictions: int
+    expirations: int
+
+
+class GetMempoolStatsMsg(NamedTuple):  # Summarize the mempool
+    def handle(self, sock, peer_hostname):
+        sock.sendall(encode_socket_data(MempoolStats(
+            size=len(mempool),
+            bytes=mempool_bytes,
+            max_bytes=Params.MAX_MEMPOOL_SIZE_BYTES,
+            min_fee_rate=get_mempool_min_fee_rate(),
+            evictions=mempool_evictions,
+            expirations=mempool_expirations)))
+
+
+class GetActiveChainMsg(NamedTuple):  # Get the active chain in its entirety.
+    def handle(self, sock, peer_hostname):
+        with chain_lock.shared:
+            blocks = list(active_chain)
+
+        sock.sendall(encode_socket_data(blocks))
+
+
+class GetChainViewMsg(NamedTuple):  # Get the tip, without waiting on a lock.
+    def handle(self, sock, peer_hostname):
+        sock.sendall(encode_socket_data(get_chain_view()))
+
+
+class GetStatsMsg(NamedTuple):  # Collect every metric we keep
+    def handle(self, sock, peer_hostname):
+        sock.sendall(encode_socket_data(metrics.collect()))
+
+
+class ProfileMsg(NamedTuple):  # Profile the node, writing results to disk
+    seconds: int = 10  # At most MAX_PROFILE_SECS.
+    trace: bool = False
+
+    def handle(self, sock, peer_hostname):
+        # Replied to once done, without holding up the rest of the session.
+        start_profile(min(max(self.seconds, 1), MAX_PROFILE_SECS),
+                      on_done=sock.send, trace=self.trace)
+
+
+class GetLockStatsMsg(NamedTuple):  # How long we've waited on `chain_lock`
+    def handle(self, sock, peer_hostname):
+        sock.sendall(encode_socket_data(chain_lock.stats()))
+
+
+class GetBlockRangeMsg(NamedTuple):  # Stream active chain blocks by height.
+    start_height: int = 0
+
+    # Exclusive; by default, stream through to the tip.
+    end_height: int = None
+
+    CHUNK_SIZE = 50
+
+    def handle(self, sock, peer_hostname):
+        height = max(self.start_height, 0)
+
+        while True:
+            with chain_lock.shared:
+                end_height = min(
+                    len(active_chain) if self.end_height is None
+                    else self.end_height,
+                    height + self.CHUNK_SIZE)
+                blocks = active_chain[height:end_height]
+
+            if not blocks:
+                break
+
+            sock.sendall(encode_socket_data(blocks))
+            height += len(blocks)
+
+        sock.sendall(encode_socket_data([]))  # Signal end of stream.
+
+
+class UTXOPage(NamedTuple):
+    utxos: Iterable[UnspentTxOut]
+
+    # Pass this as `after` to fetch the next page; None on the last page.
+    next_cursor: Union[OutPoint, None] = None
+
+
+class GetUTXOPageMsg(NamedTuple):  # Page through UTXOs in outpoint order.
+    after: Union[OutPoint, None] = None
+    limit: int = 1000
+    to_address: Union[str, None] = None
+
+    MAX_LIMIT = 5000
+
+    def handle(self, sock, peer_hostname):
+        limit = min(max(self.limit, 1), self.MAX_LIMIT)
+
+        with chain_lock.shared:
+            utxos = utxo_set.page(self.after, limit, self.to_address)
+
+        sock.sendall(encode_socket_data(UTXOPage(
+            utxos, utxos[-1].outpoint if len(utxos) == limit else None)))
+
+
+class GetUTXOSnapshotMsg(NamedTuple):  # Snapshot the UTXO set at the tip.
+    def handle(self, sock, peer_hostname):
+        sock.sendall(encode_socket_data(make_utxo_snapshot()))
+
+
+class AddPeerMsg(NamedTuple):
+    peer_hostname: str
+
+    def handle(self, sock, peer_hostname):
+        peer_hostnames.add(self.peer_hostname)
+
+
+# Our protocol is: first 4 bytes signify msg length (big-endian).
+FRAME_HEADER = struct.Struct('>I')
+
+# Refuse to buffer any message longer than this.
+MAX_MESSAGE_SIZE = int(os.environ.get('TC_MAX_MESSAGE_SIZE', 32 * 2**20))
+
+
+def decode_frame_header(header: bytes) -> int:
+    (msg_len,) = FRAME_HEADER.unpack(header)
+
+    if msg_len > MAX_MESSAGE_SIZE:
+        raise ProtocolError(
+            f'message of {msg_len} bytes exceeds {MAX_MESSAGE_SIZE}')
+
+    return msg_len
+
+
+def recv_exactly(req, num_bytes: int) -> bytearray:
+    """
+    Read exactly `num_bytes` into a single preallocated buffer, or return
+    None if the socket is closed before any of them arrive.
+    """
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    got = 0
+
+    while got < num_bytes:
+        nbytes = req.recv_into(view[got:])
+
+        if not nbytes:
+            if got == 0:
+                return None
+            raise ProtocolError(
+                f'connection closed {got} bytes into a {num_bytes} byte read')
+
+        got += nbytes
+
+    return buf
+
 
-    def find_root(nodes):
-        newlevel = [
-            MerkleNode(sha256d(i1.val + i2.val), children=[i1, i2])
-            for [i1, i2] in _chunks(nodes, 2)
-        ]
+def read_frame(req) -> bytearray:
+    """Read one framed message's payload, never reading into the next one."""
+    header = recv_exactly(req, FRAME_HEADER.size)
+    if header is None:
+        return None
 
-        return find_root(newlevel) if len(newlevel) > 1 else newlevel[0]
+    msg_len = decode_frame_header(header)
+    payload = recv_exactly(req, msg_len) if msg_len else None
+    return payload and decode_payload(payload)
 
-    return find_root([MerkleNode(sha256d(l)) for l in leaves])
 
+def read_all_from_socket(req) -> object:
+    payload = read_frame(req)
+    return deserialize(payload) if payload else None
 
-# Peer-to-peer
-# ----------------------------------------------------------------------------
 
-peer_hostnames = {p for p in os.environ.get('TC_PEERS', '').split(',') if p}
+# Every serialized Transaction, and nothing else, starts with this.
+TXN_PAYLOAD_PREFIX = b'{"_type":"Transaction",'
 
-# Signal when the initial block download has completed.
-ibd_done = threading.Event()
 
+def is_known_txn_payload(payload: bytes) -> bool:
+    """
+    Whether a payload is a txn we've recently dealt with. A txn's id is the
+    hash of its serialization, so this needn't decode it.
+    """
+    if not payload.startswith(TXN_PAYLOAD_PREFIX):
+        return False
+
+    txid = sha256d(payload)
+    return txid in mempool or txid in recently_seen or txid in recent_rejects
 
-class GetBlocksMsg(NamedTuple):  # Request blocks during initial sync
+
+@traced
+def send_to_peer(data, peer=None):
     """
-    See https://bitcoin.org/en/developer-guide#blocks-first
+    Queue a message for a (by default) random peer. This never blocks on
+    the network, so it's safe to call while holding `chain_lock`.
     """
-    from_blockid: str
+    peer = peer or random.choice(list(peer_hostnames))
+    get_peer_session(peer).enqueue(data)
 
-    CHUNK_SIZE = 50
 
-    def handle(self, sock, peer_hostname):
-        logger.debug("[p2p] recv getblocks from {peer_hostname}")
+def request_from_peer(data, peer) -> object:
+    """Send a message to a peer and wait for its response."""
+    with socket.create_connection((peer, PORT)) as s:
+        s.sendall(encode_socket_data(data))
+        return read_all_from_socket(s)
 
-        _, height, _ = locate_block(self.from_blockid, active_chain)
 
-        # If we don't recognize the requested hash as part of the active
-        # chain, start at the genesis block.
-        height = height or 1
+def read_stream_from_socket(req) -> Iterable[object]:
+    """Yield items from a stream of chunks ended by an empty chunk."""
+    while True:
+        chunk = read_all_from_socket(req)
 
-        with chain_lock:
-            blocks = active_chain[height:(height + self.CHUNK_SIZE)]
+        if not chunk:
+            return
 
-        logger.debug(f"[p2p] sending {len(blocks)} to {peer_hostname}")
-        send_to_peer(InvMsg(blocks), peer_hostname)
+        yield from chunk
 
 
-class InvMsg(NamedTuple):  # Convey blocks to a peer who is doing initial sync
-    blocks: Iterable[str]
+def request_stream_from_peer(data, peer) -> Iterable[object]:
+    """Send a message to a peer and lazily yield the items it streams back."""
+    with socket.create_connection((peer, PORT)) as s:
+        s.sendall(encode_socket_data(data))
+        yield from read_stream_from_socket(s)
 
-    def handle(self, sock, peer_hostname):
-        logger.info(f"[p2p] recv inv from {peer_hostname}")
 
-        new_blocks = [b for b in self.blocks if not locate_block(b.id)[0]]
+def encode_socket_data(data: object) -> bytes:
+    """Our protocol is: first 4 bytes signify msg length."""
+    to_send = serialize(data).encode()
+    count_message('sent', type(data).__name__, len(to_send))
+    return FRAME_HEADER.pack(len(to_send)) + to_send
 
-        if not new_blocks:
-            logger.info('[p2p] initial block download complete')
-            ibd_done.set()
-            return
 
-        for block in new_blocks:
-            connect_block(block)
+# Optional protocol features we speak, exchanged in a FeaturesMsg as each
+# session starts. Nothing is sent compressed to a peer that doesn't list
+# 'zlib'.
+SUPPORTED_FEATURES = (
+    ['zlib'] if os.environ.get('TC_COMPRESSION', '1') != '0' else [])
 
-        new_tip_id = active_chain[-1].id
-        logger.info(f'[p2p] continuing initial block download at {new_tip_id}')
+# Payloads shorter than this aren't worth compressing.
+COMPRESSION_THRESHOLD_BYTES = 1024
 
-        with chain_lock:
-            # "Recursive" call to continue the initial block sync.
-            send_to_peer(GetBlocksMsg(new_tip_id))
+# Every zlib stream (at the default window size) starts with this byte, and
+# no JSON does, so compressed payloads needn't be flagged otherwise.
+ZLIB_HEADER_BYTE = 0x78
 
+# Bytes sent and received, as framed on the wire and before compression.
+net_stats = collections.Counter()
+net_stats_lock = threading.Lock()
 
-class GetUTXOsMsg(NamedTuple):  # List all UTXOs
-    def handle(self, sock, peer_hostname):
-        sock.sendall(encode_socket_data(list(utxo_set.items())))
 
+messages_counted = metrics.counter(
+    'tinychain_messages_total', 'Messages encoded to send, or received',
+    labels=('direction', 'type'))
+message_bytes = metrics.counter(
+    'tinychain_message_bytes_total',
+    'Serialized size of messages, before compression',
+    labels=('direction', 'type'))
 
-class GetMempoolMsg(NamedTuple):  # List the mempool
-    def handle(self, sock, peer_hostname):
-        sock.sendall(encode_socket_data(list(mempool.keys())))
 
+def count_net_bytes(direction: str, wire_bytes: int, raw_bytes: int):
+    with net_stats_lock:
+        net_stats[f'bytes_{direction}'] += wire_bytes
+        net_stats[f'bytes_{direction}_uncompressed'] += raw_bytes
+
+
+def count_message(direction: str, msg_type: str, num_bytes: int):
+    messages_counted.inc(direction, msg_type)
+    message_bytes.inc(direction, msg_type, amount=num_bytes)
+
+
+def compress_frame(frame: bytes) -> bytes:
+    """Compress a framed message's payload, if that makes it smaller."""
+    payload = memoryview(frame)[FRAME_HEADER.size:]
+
+    if len(payload) < COMPRESSION_THRESHOLD_BYTES:
+        return frame
+
+    compressed = zlib.compress(payload)
+
+    if len(compressed) >= len(payload):
+        return frame
+
+    return FRAME_HEADER.pack(len(compressed)) + compressed
+
+
+def decode_payload(payload: bytearray) -> bytes:
+    """Decompress a payload read off the wire if it was compressed."""
+    wire_bytes = FRAME_HEADER.size + len(payload)
+
+    if payload[0] == ZLIB_HEADER_BYTE:
+        decompressor = zlib.decompressobj()
+
+        try:
+            payload = decompressor.decompress(payload, MAX_MESSAGE_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f'bad compressed payload: {e}')
+
+        if decompressor.unconsumed_tail:
+            raise ProtocolError(
+                f'decompressed message exceeds {MAX_MESSAGE_SIZE} bytes')
+
+    count_net_bytes('recv', wire_bytes, FRAME_HEADER.size + len(payload))
+    return payload
+
+
+class FeaturesMsg(NamedTuple):  # Declare which optional features we speak
+    features: Iterable[str]
 
-class GetActiveChainMsg(NamedTuple):  # Get the active chain in its entirety.
     def handle(self, sock, peer_hostname):
-        sock.sendall(encode_socket_data(list(active_chain)))
+        if not isinstance(sock, PeerSession):
+            return
 
+        sock.peer_features = set(self.features)
+
+        # Inbound sessions answer in kind; outbound ones led with theirs.
+        if not sock.sent_features:
+            sock.sent_features = True
+            sock.send(FeaturesMsg(SUPPORTED_FEATURES))
 
-class AddPeerMsg(NamedTuple):
-    peer_hostname: str
 
+class NetStats(NamedTuple):
+    bytes_sent: int
+    bytes_sent_uncompressed: int
+    bytes_recv: int
+    bytes_recv_uncompressed: int
+
+
+class GetNetStatsMsg(NamedTuple):  # Summarize traffic with peers
     def handle(self, sock, peer_hostname):
-        peer_hostnames.add(self.peer_hostname)
+        with net_stats_lock:
+            stats = NetStats(**{k: net_stats[k] for k in NetStats._fields})
 
+        sock.sendall(encode_socket_data(stats))
 
-def read_all_from_socket(req) -> object:
-    data = b''
-    # Our protocol is: first 4 bytes signify msg length.
-    msg_len = int(binascii.hexlify(req.recv(4) or b'\x00'), 16)
 
-    while msg_len > 0:
-        data += req.recv(1024)
-        msg_len -= 1024
+# Ping a session we haven't heard from in this long...
+PING_INTERVAL_SECS = 30
 
-    return deserialize(data.decode()) if data else None
+# ...and give up on it if we go this long without hearing anything.
+SESSION_TIMEOUT_SECS = 3 * PING_INTERVAL_SECS
 
+# Bounds on how long to wait before reconnecting a dropped outbound session.
+RECONNECT_BACKOFF_SECS = (1, 60)
 
-def send_to_peer(data, peer=None):
-    """Send a message to a (by default) random peer."""
-    peer = peer or random.choice(list(peer_hostnames))
-    tries_left = 3
+# Give up on connecting to, or writing a message to, a peer after this long.
+CONNECT_TIMEOUT_SECS = 5
+SEND_TIMEOUT_SECS = 10
 
-    while tries_left > 0:
-        try:
-            with socket.create_connection((peer, PORT)) as s:
-                s.sendall(encode_socket_data(data))
-        except Exception:
-            logger.exception(f'failed to send to peer {peer}')
-            tries_left -= 1
-            time.sleep(2)
+# The most messages we'll queue up for a peer; past this, older messages are
+# dropped to make room (txns before blocks).
+RELAY_QUEUE_DEPTH = 1000
+
+# Queued messages which haven't gone out within this long are dropped.
+RELAY_MSG_TTL_SECS = 60
+
+
+class PeerSession:
+    """
+    A long-lived connection to a peer carrying framed messages in both
+    directions. Messages read off the session are handled on its own thread
+    and handlers may reply over the same session via `sendall()`.
+
+    Outbound sessions (those we dial) reconnect on demand after being
+    dropped, backing off exponentially while the peer stays unreachable.
+    Relayed messages are `enqueue()`d and written by a background sender
+    thread, so a slow or dead peer never holds up the caller.
+    """
+
+    def __init__(self, hostname: str, sock: socket.socket = None):
+        self.hostname = hostname
+        self.outbound = sock is None
+        self.sock = sock
+        self.last_recv = time.time()
+        self.connect_failures = 0
+        self.next_connect_at = 0.
+
+        # Held while writing a frame or (re)connecting.
+        self.lock = threading.RLock()
+
+        # (time queued, msg) pairs waiting on the sender thread.
+        self.send_queue = collections.deque()
+        self.send_ready = threading.Condition()
+        self.sender = None
+        self.sending = False
+        self.num_dropped = 0
+
+        # What the peer said it speaks in its FeaturesMsg, once it has.
+        self.peer_features = None
+        self.sent_features = False
+
+    @property
+    def connected(self) -> bool: return self.sock is not None
+
+    def connect(self):
+        with self.lock:
+            if self.sock:
+                return
+            elif not self.outbound:
+                raise PeerUnavailableError('inbound session closed')
+            elif time.time() < self.next_connect_at:
+                raise PeerUnavailableError('backing off reconnect')
+
+            try:
+                sock = socket.create_connection(
+                    (self.hostname, PORT), timeout=CONNECT_TIMEOUT_SECS)
+                sock.settimeout(None)
+
+                # Bound writes only; the reader blocks until a frame arrives.
+                sock.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                    struct.pack('ll', SEND_TIMEOUT_SECS, 0))
+            except OSError:
+                self._back_off()
+                raise
+
+            self._connected(sock)
+
+            try:
+                sock.sendall(self._features_frame())
+            except OSError:
+                self.disconnect(sock)
+                raise
+
+        threading.Thread(
+            target=self.read_forever, args=(sock,), daemon=True).start()
+
+    def _back_off(self):
+        self.connect_failures += 1
+        min_backoff, max_backoff = RECONNECT_BACKOFF_SECS
+        self.next_connect_at = time.time() + min(
+            min_backoff * 2 ** (self.connect_failures - 1), max_backoff)
+
+    def _connected(self, sock):
+        logger.info(f'[p2p] connected to {self.hostname}')
+        self.sock = sock
+        self.connect_failures = 0
+        self.last_recv = time.time()
+        self.peer_features = None
+
+    def _features_frame(self) -> bytes:
+        self.sent_features = True
+        return encode_socket_data(FeaturesMsg(SUPPORTED_FEATURES))
+
+    def _to_wire(self, frame: bytes) -> bytes:
+        """Compress a frame if the peer can take it, and count it."""
+        if 'zlib' in (self.peer_features or ()) and 'zlib' in \
+                SUPPORTED_FEATURES:
+            wire_frame = compress_frame(frame)
         else:
-            break
+            wire_frame = frame
+
+        count_net_bytes('sent', len(wire_frame), len(frame))
+        return wire_frame
+
+    def disconnect(self, sock: socket.socket = None):
+        """Close the session's socket (if it's still `sock`, when given)."""
+        with self.lock:
+            if self.sock and (sock is None or sock is self.sock):
+                logger.info(f'[p2p] disconnected from {self.hostname}')
+                self.sock.close()
+                self.sock = None
+
+    def sendall(self, data: bytes):
+        with self.lock:
+            self.connect()
+
+            try:
+                self.sock.sendall(self._to_wire(data))
+            except OSError:
+                self.disconnect()
+                raise
+
+    def send(self, msg):
+        self.sendall(encode_socket_data(msg))
+
+    def enqueue(self, msg):
+        """Queue a message for the sender thread, dropping if we must."""
+        with self.send_ready:
+            if len(self.send_queue) >= RELAY_QUEUE_DEPTH:
+                self._drop_one()
+
+            self.send_queue.append((time.time(), msg))
+
+            if not self.sender:
+                self.sender = self.start_sender()
+
+            self.send_ready.notify_all()
+
+    def start_sender(self):
+        sender = threading.Thread(target=self.send_forever, daemon=True)
+        sender.start()
+        return sender
+
+    def _drop_one(self):
+        # Blocks are worth more to a peer than txns, so drop txns first.
+        for i, (_, msg) in enumerate(self.send_queue):
+            if not isinstance(msg, Block):
+                del self.send_queue[i]
+                break
+        else:
+            _, msg = self.send_queue.popleft()
 
+        self._dropped(msg, 'send queue full')
 
-def int_to_8bytes(a: int) -> bytes: return binascii.unhexlify(f"{a:0{8}x}")
+    def _dropped(self, msg, reason):
+        self.num_dropped += 1
+        logger.debug(f'[p2p] dropped {type(msg).__name__} '
+                     f'for {self.hostname}: {reason}')
 
+    def flush(self, timeout: float = None) -> bool:
+        """Wait for queued messages to go out (or be dropped)."""
+        with self.send_ready:
+            return self.send_ready.wait_for(
+                lambda: not (self.send_queue or self.sending), timeout)
 
-def encode_socket_data(data: object) -> bytes:
-    """Our protocol is: first 4 bytes signify msg length."""
-    to_send = serialize(data).encode()
-    return int_to_8bytes(len(to_send)) + to_send
+    def _pop_queued(self):
+        """Take the next unexpired message off the queue, if there is one."""
+        with self.send_ready:
+            while self.send_queue:
+                queued_at, msg = self.send_queue.popleft()
+
+                if time.time() - queued_at <= RELAY_MSG_TTL_SECS:
+                    self.sending = True
+                    return msg
+
+                self._dropped(msg, 'expired in queue')
+
+            self.send_ready.notify_all()
+
+        return None
+
+    def _done_sending(self):
+        with self.send_ready:
+            self.sending = False
+            self.send_ready.notify_all()
+
+    def send_forever(self):
+        while True:
+            with self.send_ready:
+                self.send_ready.wait_for(lambda: self.send_queue)
+
+            msg = self._pop_queued()
+            if msg is None:
+                continue
+
+            try:
+                self.send(msg)
+            except Exception as e:
+                self._dropped(msg, getattr(e, 'msg', e))
+            finally:
+                self._done_sending()
+
+    def decode(self, payload: bytes) -> object:
+        """Deserialize a message, or return None if it's not worth handling."""
+        if is_known_txn_payload(payload):
+            count_message('recv', 'Transaction', len(payload))
+            logger.debug('[p2p] dropped known txn from %s', self.hostname)
+            return None
+
+        data = deserialize(payload)
+        count_message('recv', type(data).__name__, len(payload))
+        return data
+
+    def read_forever(self, sock: socket.socket):
+        """Handle each message read off `sock` until it closes."""
+        while True:
+            try:
+                payload = read_frame(sock)
+                data = payload and self.decode(payload)
+            except Exception:
+                logger.debug(f'[p2p] bad read from {self.hostname}')
+                payload = None
+
+            if payload is None:
+                break
+
+            self.last_recv = time.time()
+
+            if data is None:
+                continue
+
+            try:
+                handle_msg(data, self, self.hostname)
+            except Exception:
+                logger.exception(f'[p2p] failed to handle {type(data)}')
+
+        self.disconnect(sock)
+
+
+# One outbound session per peer, keyed by hostname.
+peer_sessions: Dict[str, PeerSession] = {}
+peer_sessions_lock = threading.Lock()
+
+
+def get_peer_session(peer: str) -> PeerSession:
+    with peer_sessions_lock:
+        if peer not in peer_sessions:
+            peer_sessions[peer] = (
+                AsyncPeerSession if USE_ASYNCIO else PeerSession)(peer)
+        return peer_sessions[peer]
+
+
+def keep_sessions_alive_forever():
+    while True:
+        time.sleep(PING_INTERVAL_SECS)
+
+        with peer_sessions_lock:
+            sessions = list(peer_sessions.values())
+
+        for session in sessions:
+            idle_secs = time.time() - session.last_recv
+
+            if not session.connected or idle_secs < PING_INTERVAL_SECS:
+                continue
+            elif idle_secs > SESSION_TIMEOUT_SECS:
+                logger.info(f'[p2p] session with {session.hostname} timed out')
+                session.disconnect()
+                continue
+
+            try:
+                session.send(PingMsg(random.getrandbits(32)))
+            except Exception:
+                logger.debug(f'[p2p] failed to ping {session.hostname}')
+
+
+def handle_msg(data, sock, peer_hostname):
+    # Logged lazily, as formatting a whole message isn't free.
+    if hasattr(data, 'handle') and isinstance(data.handle, Callable):
+        logger.debug('received msg %s from peer %s', data, peer_hostname)
+        data.handle(sock, peer_hostname)
+    elif isinstance(data, Transaction):
+        txid = data.id
+        logger.debug('received txn %s from peer %s', txid, peer_hostname)
+        mark_inventory_known(peer_hostname, [txid])
+        add_txn_to_mempool(data)
+    elif isinstance(data, Block):
+        block_id = data.id
+        mark_inventory_known(peer_hostname, [block_id])
+
+        if block_id in recently_seen:
+            logger.debug('ignore block already seen: %s', block_id)
+            return
+
+        logger.info(f"received block {block_id} from peer {peer_hostname}")
+        connect_block(data)
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+    # Sessions are long-lived; don't wait on them when shutting down.
+    daemon_threads = True
+    block_on_close = False
 
 
 class TCPHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
-        data = read_all_from_socket(self.request)
         peer_hostname = self.request.getpeername()[0]
         peer_hostnames.add(peer_hostname)
 
-        if hasattr(data, 'handle') and isinstance(data.handle, Callable):
-            logger.info(f'received msg {data} from peer {peer_hostname}')
-            data.handle(self.request, peer_hostname)
-        elif isinstance(data, Transaction):
-            logger.info(f"received txn {data.id} from peer {peer_hostname}")
-            add_txn_to_mempool(data)
-        elif isinstance(data, Block):
-            logger.info(f"received block {data.id} from peer {peer_hostname}")
-            connect_block(data)
+        # Serve every message the peer sends until it hangs up.
+        PeerSession(peer_hostname, sock=self.request).read_forever(
+            self.request)
+
+
+# Asyncio transport
+# ----------------------------------------------------------------------------
+
+# Serve every peer from a single event loop rather than a thread apiece.
+USE_ASYNCIO = os.environ.get('TC_ASYNCIO', '0') not in ('', '0')
+
+# Handlers take `chain_lock` and validate signatures, so they run on this
+# pool rather than stalling the event loop.
+HANDLER_THREADS = int(os.environ.get('TC_HANDLER_THREADS', 8))
+handler_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=HANDLER_THREADS, thread_name_prefix='handler')
+
+# The loop all asyncio sessions run on; see `start_event_loop()`.
+event_loop: asyncio.AbstractEventLoop = None
+
+
+def start_event_loop() -> asyncio.AbstractEventLoop:
+    global event_loop
+
+    if not event_loop:
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        event_loop = loop
+
+    return event_loop
+
+
+async def read_frame_async(reader: asyncio.StreamReader) -> bytes:
+    """`read_frame()` for a stream on the event loop."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+
+    try:
+        data = await reader.readexactly(decode_frame_header(header))
+    except asyncio.IncompleteReadError as e:
+        raise ProtocolError(
+            f'connection closed {len(e.partial)} bytes into a message')
+
+    return data and decode_payload(data) or None
+
+
+class AsyncPeerSession(PeerSession):
+    """
+    A `PeerSession` whose connecting, reading and writing happen on
+    `event_loop`. Only message handling leaves the loop, for
+    `handler_executor`.
+
+    The synchronous methods it inherits (`sendall()`, `enqueue()`, ...) are
+    safe to call from any thread other than the loop's, so handlers and the
+    rest of the node needn't care which transport they're talking over.
+    """
+
+    def __init__(self, hostname: str,
+                 reader: asyncio.StreamReader = None,
+                 writer: asyncio.StreamWriter = None):
+        super().__init__(hostname)
+        self.outbound = writer is None
+        self.sock = writer
+
+        # Serializes frames written to `self.sock`, and signals the sender.
+        # Before Python 3.7 these bind to whichever loop is current where
+        # they're made, so they're made on the loop; see `_init_on_loop()`.
+        self.write_lock: asyncio.Lock = None
+        self.queued: asyncio.Event = None
+
+    def _init_on_loop(self):
+        if self.write_lock is None:
+            self.write_lock = asyncio.Lock()
+            self.queued = asyncio.Event()
+
+    def _set_queued(self):
+        self._init_on_loop()
+        self.queued.set()
+
+    async def connect_async(self):
+        if self.sock:
+            return
+        elif not self.outbound:
+            raise PeerUnavailableError('inbound session closed')
+        elif time.time() < self.next_connect_at:
+            raise PeerUnavailableError('backing off reconnect')
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.hostname, PORT),
+                CONNECT_TIMEOUT_SECS)
+        except (OSError, asyncio.TimeoutError):
+            self._back_off()
+            raise
+
+        self._connected(writer)
+        writer.write(self._features_frame())
+        asyncio.ensure_future(self.read_forever_async(reader, writer))
+
+    def disconnect(self, sock: asyncio.StreamWriter = None):
+        with self.lock:
+            if self.sock and (sock is None or sock is self.sock):
+                logger.info(f'[p2p] disconnected from {self.hostname}')
+                event_loop.call_soon_threadsafe(self.sock.close)
+                self.sock = None
+
+    async def sendall_async(self, data: bytes):
+        self._init_on_loop()
+
+        async with self.write_lock:
+            await self.connect_async()
+            writer = self.sock
+
+            try:
+                writer.write(self._to_wire(data))
+                await asyncio.wait_for(writer.drain(), SEND_TIMEOUT_SECS)
+            except (OSError, asyncio.TimeoutError):
+                self.disconnect(writer)
+                raise
+
+    def sendall(self, data: bytes):
+        asyncio.run_coroutine_threadsafe(
+            self.sendall_async(data), event_loop).result()
+
+    def start_sender(self):
+        return asyncio.run_coroutine_threadsafe(
+            self.send_forever_async(), start_event_loop())
+
+    def enqueue(self, msg):
+        super().enqueue(msg)
+        start_event_loop().call_soon_threadsafe(self._set_queued)
+
+    async def send_forever_async(self):
+        self._init_on_loop()
+
+        while True:
+            await self.queued.wait()
+
+            msg = self._pop_queued()
+            if msg is None:
+                self.queued.clear()
+                continue
+
+            try:
+                await self.sendall_async(encode_socket_data(msg))
+            except Exception as e:
+                self._dropped(msg, getattr(e, 'msg', e))
+            finally:
+                self._done_sending()
+
+    async def read_forever_async(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter):
+        loop = asyncio.get_event_loop()  # The running loop, on 3.6 too.
+
+        while True:
+            try:
+                payload = await read_frame_async(reader)
+                data = payload and self.decode(payload)
+            except Exception:
+                logger.debug(f'[p2p] bad read from {self.hostname}')
+                payload = None
+
+            if payload is None:
+                break
+
+            self.last_recv = time.time()
+
+            if data is None:
+                continue
+
+            # Like the threaded transport, handle a session's messages in
+            # the order they arrive.
+            try:
+                await loop.run_in_executor(
+                    handler_executor, handle_msg, data, self, self.hostname)
+            except Exception:
+                logger.exception(f'[p2p] failed to handle {type(data)}')
+
+        self.disconnect(writer)
+
+
+async def serve_peer_async(reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter):
+    peer_hostname = writer.get_extra_info('peername')[0]
+    peer_hostnames.add(peer_hostname)
+
+    await AsyncPeerSession(peer_hostname, reader, writer).read_forever_async(
+        reader, writer)
+
+
+def start_async_server(host: str, port) -> asyncio.AbstractServer:
+    """Start listening for peers on the event loop."""
+    return asyncio.run_coroutine_threadsafe(
+        asyncio.start_server(serve_peer_async, host, port),
+        start_event_loop()).result()
+
+
+# Subscriptions
+# ----------------------------------------------------------------------------
+
+# Events are pushed over a subscriber's session as they happen, each
+# numbered in sequence per subscription. Sessions drop messages they can't
+# get out in time (see `PeerSession.enqueue()`), so a gap in the numbering
+# means the subscriber has missed something and should resync.
+
+class TipEvent(NamedTuple):  # The active chain's tip changed
+    seq: int
+    header: Block  # With no txns.
+    height: int
+
+
+class MempoolEvent(NamedTuple):  # A watched txn entered or left the mempool
+    seq: int
+    txid: str
+    txn: Transaction  # None once it's left.
+
+
+class UTXOEvent(NamedTuple):  # A watched address gained or lost a UTXO
+    seq: int
+    utxo: UnspentTxOut
+    spent: bool
+
+
+class Subscription:
+
+    def __init__(self, session: PeerSession, tips: bool,
+                 txids: Iterable[str], addresses: Iterable[str]):
+        self.session = session
+        self.tips = tips
+        self.txids = set(txids)
+        self.addresses = set(addresses)
+        self.seq = 0
+
+    @property
+    def alive(self) -> bool:
+        # Inbound sessions are gone for good once they disconnect.
+        return self.session.outbound or self.session.connected
+
+    def watches_txn(self, txn: Transaction) -> bool:
+        return txn.id in self.txids or any(
+            txout.to_address in self.addresses for txout in txn.txouts)
+
+    def push(self, event_cls, *args):
+        self.seq += 1
+        self.session.enqueue(event_cls(self.seq, *args))
+
+
+# What each session has subscribed to, keyed by session.
+subscriptions: Dict[PeerSession, Subscription] = {}
+subscriptions_lock = threading.Lock()
+
+
+class SubscribeMsg(NamedTuple):  # Push events over this session from now on
+    """
+    Subscribe to new tips, to watched txids entering and leaving the mempool
+    (along with any txn paying a watched address), and to watched addresses'
+    UTXOs being created and spent. Replaces what the session subscribed to
+    before; subscribing to nothing unsubscribes.
+
+    The reply is the ChainView as of subscribing, which events follow on
+    from, so fetch any initial state (e.g. with GetUTXOPageMsg) after it.
+    """
+    tips: bool = True
+    txids: Iterable[str] = ()
+    addresses: Iterable[str] = ()
+
+    def handle(self, sock, peer_hostname):
+        # The chain can't change in between the view and subscribing, so
+        # no event is missed or applies to state the view already has.
+        with chain_lock.shared:
+            view = get_chain_view()
+
+            with subscriptions_lock:
+                if self.tips or self.txids or self.addresses:
+                    subscriptions[sock] = Subscription(
+                        sock, self.tips, self.txids, self.addresses)
+                else:
+                    subscriptions.pop(sock, None)
+
+                # Queued rather than sent so it goes out ahead of events.
+                sock.enqueue(view)
+
+
+def live_subscriptions() -> Iterable[Subscription]:
+    """Subscriptions whose sessions are still up; call with the lock held."""
+    for session, sub in list(subscriptions.items()):
+        if sub.alive:
+            yield sub
+        else:
+            del subscriptions[session]
+
+
+def notify_tip(tip: Block, height: int):
+    if not subscriptions:
+        return
+
+    header = tip._replace(txns=[])
+
+    with subscriptions_lock:
+        for sub in live_subscriptions():
+            if sub.tips:
+                sub.push(TipEvent, header, height)
+
+
+def notify_mempool(txn: Transaction, added: bool):
+    if not subscriptions:
+        return
+
+    with subscriptions_lock:
+        for sub in live_subscriptions():
+            if sub.watches_txn(txn):
+                sub.push(MempoolEvent, txn.id, txn if added else None)
+
+
+def notify_utxo_changes(
+        changes: Iterable[Tuple[UnspentTxOut, UnspentTxOut]]):
+    """Tell subscribers about (old, new) UTXOs at their watched addresses."""
+    if not subscriptions:
+        return
+
+    with subscriptions_lock:
+        subs = [sub for sub in live_subscriptions() if sub.addresses]
+
+        for old, new in changes:
+            if old == new:
+                continue
+
+            for sub in subs:
+                if old and old.to_address in sub.addresses:
+                    sub.push(UTXOEvent, old, True)
+                if new and new.to_address in sub.addresses:
+                    sub.push(UTXOEvent, new, False)
+
+
+# Nodes
+# ----------------------------------------------------------------------------
+
+# Blocks and txns pass between nodes as is, so nodes share these (along with
+# the exceptions) rather than each having its own.
+NODE_SHARED_NAMES = (
+    'OutPoint', 'TxIn', 'TxOut', 'UnspentTxOut', 'Transaction', 'Block',
+    'genesis_block', 'regtest_genesis_block')
+
+
+@lru_cache()
+def node_module_code():
+    with open(__file__, 'rb') as f:
+        return compile(f.read(), __file__, 'exec')
+
+
+class Node:
+    """
+    A node of its own, so that many nodes can share a process (see
+    sim_tinychain.py).
+
+    Everything in this module works on its globals, so each node runs its
+    own instance of the module: its own chain, mempool and peers, but also
+    its own `chain_lock`, metrics and threads, so nodes run side by side.
+    Whatever isn't found on the node is looked up in its module, e.g.
+    `node.connect_block(block)` or `node.active_chain`. Messages for a node
+    have to be its own (e.g. `node.InvMsg`), as their handlers work on the
+    module they're from.
+    """
+
+    def __init__(self, name: str, genesis: Block = None,
+                 filter_capacity: int = 120_000, params: type = None):
+        self.name = name
+        self.module = types.ModuleType('tinychain')
+        self.module.__file__ = __file__
+        exec(node_module_code(), vars(self.module))
+
+        vars(self.module).update(
+            (attr, obj) for attr, obj in globals().items()
+            if attr in NODE_SHARED_NAMES or (
+                isinstance(obj, type) and issubclass(obj, BaseException)))
+
+        self.module.Params = params or Params
+        self.module.active_chain = [genesis or genesis_block]
+        self.module.recently_seen = self.RollingBloomFilter(filter_capacity)
+        self.module.recent_rejects = self.RollingBloomFilter(filter_capacity)
+
+    def __repr__(self):
+        return f'Node({self.name!r})'
+
+    def __getattr__(self, name):
+        if name == 'module':  # Not set up yet.
+            raise AttributeError(name)
+
+        return getattr(self.module, name)
 
 
 # Wallet
@@ -1098,9 +4159,23 @@ class TxnValidationError(BaseException):
 
 
 class BlockValidationError(BaseException):
-    def __init__(self, *args, to_orphan: Block = None, **kwargs):
+    def __init__(self, *args, to_orphan: Block = None, bad_header=False,
+                 **kwargs):
         super().__init__(*args, **kwargs)
         self.to_orphan = to_orphan
+        self.bad_header = bad_header
+
+
+class UTXOSnapshotError(BaseException):
+    pass
+
+
+class ProtocolError(BaseException):
+    pass
+
+
+class PeerUnavailableError(BaseException):
+    pass
 
 
 def serialize(obj) -> str:
@@ -1125,7 +4200,7 @@ def serialize(obj) -> str:
         contents_to_primitive(obj), sort_keys=True, separators=(',', ':'))
 
 
-def deserialize(serialized: str) -> object:
+def deserialize(serialized: Union[str, bytes, bytearray]) -> object:
     """NamedTuple-flavored serialization from JSON."""
     gs = globals()
 
@@ -1150,9 +4225,9 @@ def deserialize(serialized: str) -> object:
     return contents_to_objs(json.loads(serialized))
 
 
-def sha256d(s: Union[str, bytes]) -> str:
+def sha256d(s: Union[str, bytes, bytearray]) -> str:
     """A double SHA-256 hash."""
-    if not isinstance(s, bytes):
+    if isinstance(s, str):
         s = s.encode()
 
     return hashlib.sha256(hashlib.sha256(s).digest()).hexdigest()
@@ -1167,17 +4242,37 @@ def _chunks(l, n) -> Iterable[Iterable]:
 
 PORT = os.environ.get('TC_PORT', 9999)
 
+# Mine blocks of our own. Turn this off to, say, replay a generated workload
+# into a regtest node, where our blocks would be found at once.
+MINE = os.environ.get('TC_MINE', '1') != '0'
+
 
 def main():
     workers = []
-    server = ThreadedTCPServer(('0.0.0.0', PORT), TCPHandler)
 
     def start_worker(fnc):
-        workers.append(threading.Thread(target=fnc, daemon=True))
+        # Named so that their stacks can be told apart in profiles.
+        workers.append(threading.Thread(
+            target=fnc, name=fnc.__name__, daemon=True))
         workers[-1].start()
 
+    if UTXO_SNAPSHOT_PATH:
+        snapshot = load_utxo_snapshot(UTXO_SNAPSHOT_PATH)
+
     logger.info(f'[p2p] listening on {PORT}')
-    start_worker(server.serve_forever)
+
+    if METRICS_PORT:
+        logger.info(f'serving metrics on {METRICS_PORT}')
+        start_metrics_server('0.0.0.0', METRICS_PORT)
+
+    if USE_ASYNCIO:
+        start_async_server('0.0.0.0', PORT)
+    else:
+        server = ThreadedTCPServer(('0.0.0.0', PORT), TCPHandler)
+        start_worker(server.serve_forever)
+
+    if UTXO_SNAPSHOT_PATH and peer_hostnames:
+        start_worker(lambda: verify_snapshot_from_peer(snapshot))
 
     if peer_hostnames:
         logger.info(
@@ -1185,8 +4280,22 @@ def main():
         send_to_peer(GetBlocksMsg(active_chain[-1].id))
         ibd_done.wait(60.)  # Wait a maximum of 60 seconds for IBD to complete.
 
-    start_worker(mine_forever)
-    [w.join() for w in workers]
+    load_mempool()
+    start_worker(dump_mempool_forever)
+    start_worker(keep_sessions_alive_forever)
+
+    if MINE:
+        start_worker(mine_forever)
+
+    # Exit cleanly on `docker stop` so the mempool gets dumped.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # `kill -USR1` profiles a running node for PROFILE_SECS.
+    signal.signal(signal.SIGUSR1, lambda *_: start_profile(trace=True))
+
+    try:
+        [w.join() for w in workers]
+    finally:
+        dump_mempool()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+⛼  tinychain workload generator
+
+Usage:
+  workload_tinychain.py generate <dir> [options]
+  workload_tinychain.py replay <dir> [--host HOST] [--port PORT]
+
+Options:
+  -h --help           Show help
+  -n, --blocks N      Blocks to build atop the genesis block [default: 100]
+  -m, --txns N        Signed txns in each block [default: 10]
+  --fan-in N          Inputs to each txn [default: 1]
+  --fan-out N         Outputs from each txn [default: 2]
+  --depth N           Txns in each run of txns which each spend an output of
+                      the one before, within a block [default: 1]
+  --mempool N         Signed txns to leave unmined [default: 0]
+  --fork N            Also build a branch which overtakes the last N blocks
+                      [default: 0]
+  --keys N            Keys to pay coins between [default: 16]
+  --seed N            Seed for the keys and payments [default: 0]
+  --host HOST         Node to replay into [default: localhost]
+  --port PORT         [default: 9999]
+
+`generate` builds a chain on the regtest network (see `RegtestParams`),
+checking every block against a node in this process as it goes, and writes
+it to files in <dir>, one serialized object per line:
+
+  blocks.jsonl    The chain, from height 1.
+  mempool.jsonl   Txns spending coins from the chain, in dependency order.
+  fork.jsonl      A branch off the chain which overtakes it.
+
+The same options and seed always produce the same files.
+
+`replay` sends them, in that order, over one connection to a node started
+with TC_NETWORK=regtest (and TC_MINE=0, so that it doesn't build a chain of
+its own), then waits for it to get through them.
+
+"""
+import logging
+import os
+import random
+import socket
+from typing import NamedTuple, Iterable
+
+import ecdsa
+from docopt import docopt
+
+import tinychain as t
+
+
+# What each generated txn pays in fees.
+TXN_FEE = 1000
+
+# The most txns `replay` sends in one TxBatchMsg.
+REPLAY_BATCH_SIZE = 500
+
+
+class Coin(NamedTuple):  # A txout one of our keys can spend
+    outpoint: t.OutPoint
+    value: int
+    key_idx: int
+
+
+class Workload(NamedTuple):  # In the order to replay them
+    blocks: Iterable[t.Block]
+    mempool: Iterable[t.Transaction]
+    fork: Iterable[t.Block]
+
+
+class WorkloadGenerator:
+
+    def __init__(self, num_keys: int, fan_in: int, fan_out: int, depth: int,
+                 seed: int = 0):
+        self.rng = random.Random(seed)
+        self.fan_in = fan_in
+        self.fan_out = fan_out
+        self.depth = depth
+
+        self.keys = [
+            ecdsa.SigningKey.from_secret_exponent(
+                self.rng.randrange(1, ecdsa.SECP256k1.order),
+                curve=ecdsa.SECP256k1)
+            for _ in range(num_keys)]
+        self.pks = [k.get_verifying_key().to_string() for k in self.keys]
+        self.addresses = [t.pubkey_to_address(pk) for pk in self.pks]
+
+        # Confirmed coins we've yet to spend.
+        self.coins: [Coin] = []
+        self.node = t.Node('workload', t.regtest_genesis_block,
+                           params=t.RegtestParams)
+
+    def take_coins(self, num: int) -> [Coin]:
+        taken = []
+
+        while self.coins and len(taken) < num:
+            i = self.rng.randrange(len(self.coins))
+            self.coins[i], self.coins[-1] = self.coins[-1], self.coins[i]
+            taken.append(self.coins.pop())
+
+        return taken
+
+    def make_txn(self, inputs: [Coin]) -> (t.Transaction, [Coin]):
+        to_spend = sum(c.value for c in inputs) - TXN_FEE
+        num_outputs = max(1, min(self.fan_out, to_spend))
+        values = [to_spend // num_outputs] * num_outputs
+        values[0] += to_spend % num_outputs
+        key_idxs = [self.rng.randrange(len(self.keys)) for _ in values]
+
+        txouts = [t.TxOut(value=v, to_address=self.addresses[k])
+                  for v, k in zip(values, key_idxs)]
+        txins = []
+
+        for coin in inputs:
+            pk = self.pks[coin.key_idx]
+            spend_msg = t.build_spend_message(coin.outpoint, pk, 0, txouts)
+            txins.append(t.TxIn(
+                to_spend=coin.outpoint, unlock_pk=pk, sequence=0,
+                unlock_sig=self.keys[coin.key_idx].sign_deterministic(
+                    spend_msg)))
+
+        txn = t.Transaction(txins=txins, txouts=txouts, locktime=0)
+        return txn, [Coin(t.OutPoint(txn.id, i), v, k)
+                     for i, (v, k) in enumerate(zip(values, key_idxs))]
+
+    def make_txns(self, num_txns: int) -> ([t.Transaction], [Coin]):
+        """Txns spending our coins, and the coins they create."""
+        txns = []
+        new_coins = []
+
+        while len(txns) < num_txns:
+            # Each txn in a run spends one output of the txn before it.
+            parent_coins = []
+
+            for _ in range(min(self.depth, num_txns - len(txns))):
+                inputs = parent_coins[:1]
+                new_coins.extend(parent_coins[1:])
+                inputs += self.take_coins(self.fan_in - len(inputs))
+
+                if sum(c.value for c in inputs) <= TXN_FEE:
+                    self.coins.extend(inputs)
+                    break
+
+                txn, parent_coins = self.make_txn(inputs)
+                txns.append(txn)
+
+            new_coins.extend(parent_coins)
+
+            if not parent_coins:
+                break  # We're out of coins.
+
+        return txns, new_coins
+
+    def mine_block(self, num_txns: int) -> t.Block:
+        txns, new_coins = self.make_txns(num_txns)
+        key_idx = self.rng.randrange(len(self.keys))
+
+        node = self.node
+        timestamp = node.active_chain[-1].timestamp + \
+            node.Params.TIME_BETWEEN_BLOCKS_IN_SECS_TARGET
+        block = node.mine(node.assemble_block(
+            self.addresses[key_idx], txns=txns, timestamp=timestamp))
+
+        if node.connect_block(block) != t.ACTIVE_CHAIN_IDX:
+            raise ValueError(f'generated an invalid block {block.id}')
+
+        coinbase = block.txns[0]
+        self.coins.extend(new_coins)
+        self.coins.append(Coin(
+            t.OutPoint(coinbase.id, 0), coinbase.txouts[0].value, key_idx))
+
+        return block
+
+    def mine_fork(self, depth: int) -> [t.Block]:
+        """Coinbase-only blocks which overtake the last `depth` blocks."""
+        node = self.node
+        chain = list(node.active_chain)
+        fork_height = len(chain) - 1 - depth
+        branch = [chain[fork_height]]
+
+        # `reorg_if_necessary()` doesn't count the fork block toward the
+        # branch's length, so it needs two more blocks to overtake.
+        for height in range(fork_height + 1, fork_height + depth + 3):
+            coinbase = t.Transaction.create_coinbase(
+                'fork', node.get_block_subsidy(), height)
+            branch.append(node.mine(t.Block(
+                version=0, prev_block_hash=branch[-1].id,
+                merkle_hash=t.get_merkle_root_of_txns([coinbase]).val,
+                timestamp=branch[-1].timestamp + 1,
+                bits=node.Params.INITIAL_DIFFICULTY_BITS, nonce=0,
+                txns=[coinbase])))
+
+        for block in branch[1:]:
+            node.connect_block(block)
+
+        if node.active_chain[-1] != branch[-1]:
+            raise ValueError('generated fork failed to reorg the chain')
+
+        return branch[1:]
+
+
+def generate(num_blocks: int, num_txns: int, fan_in: int = 1,
+             fan_out: int = 2, depth: int = 1, num_mempool: int = 0,
+             fork_depth: int = 0, num_keys: int = 16,
+             seed: int = 0) -> Workload:
+    gen = WorkloadGenerator(num_keys, fan_in, fan_out, depth, seed)
+    blocks = [gen.mine_block(num_txns) for _ in range(num_blocks)]
+    mempool = gen.make_txns(num_mempool)[0]
+    fork = gen.mine_fork(fork_depth) if fork_depth else []
+
+    return Workload(blocks, mempool, fork)
+
+
+def write_workload(workload: Workload, dirname: str):
+    os.makedirs(dirname, exist_ok=True)
+
+    for name, objs in workload._asdict().items():
+        with open(os.path.join(dirname, f'{name}.jsonl'), 'w') as f:
+            for obj in objs:
+                f.write(t.serialize(obj) + '\n')
+
+
+def read_workload(dirname: str) -> Workload:
+    def read(name):
+        with open(os.path.join(dirname, f'{name}.jsonl')) as f:
+            return [t.deserialize(line) for line in f]
+
+    return Workload(*(read(name) for name in Workload._fields))
+
+
+def replay(workload: Workload, host: str, port: int) -> t.ChainView:
+    with socket.create_connection((host, port)) as s:
+        for block in workload.blocks:
+            s.sendall(t.encode_socket_data(block))
+
+        for batch in t._chunks(workload.mempool, REPLAY_BATCH_SIZE):
+            s.sendall(t.encode_socket_data(t.TxBatchMsg(batch, reply=False)))
+
+        for block in workload.fork:
+            s.sendall(t.encode_socket_data(block))
+
+        # A node handles a connection's messages in order, so this comes
+        # back once it's done with the rest.
+        s.sendall(t.encode_socket_data(t.GetChainViewMsg()))
+        return t.read_all_from_socket(s)
+
+
+def main(args):
+    # Every block is otherwise logged at INFO.
+    t.logger.setLevel(logging.WARNING)
+
+    if args['generate']:
+        workload = generate(
+            num_blocks=int(args['--blocks']),
+            num_txns=int(args['--txns']),
+            fan_in=int(args['--fan-in']),
+            fan_out=int(args['--fan-out']),
+            depth=int(args['--depth']),
+            num_mempool=int(args['--mempool']),
+            fork_depth=int(args['--fork']),
+            num_keys=int(args['--keys']),
+            seed=int(args['--seed']),
+        )
+        write_workload(workload, args['<dir>'])
+        print(f'wrote {len(workload.blocks)} blocks '
+              f'({sum(len(b.txns) - 1 for b in workload.blocks)} txns), '
+              f'{len(workload.fork)} fork blocks and '
+              f'{len(workload.mempool)} mempool txns to {args["<dir>"]}')
+    elif args['replay']:
+        view = replay(read_workload(args['<dir>']),
+                      args['--host'], int(args['--port']))
+        print(f'node is at height {view.height}, tip {view.tip_id}')
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))